@@ -0,0 +1,470 @@
+#
+# Micro-benchmarks for the gcode to RML-1 conversion of mdx15_print_gerber.py,
+# and a benchmark suite on synthetic jobs (--suite) with JSON results for comparing versions.
+# --verify checks that the per-line, batch and parallel conversions give the same output.
+#
+#
+# MIT License
+#
+# Copyright (c) 2018 Charles Donohue
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import re
+import os
+import sys
+import time
+import contextlib
+import io
+import json
+import random
+import itertools
+import tempfile
+import multiprocessing
+try:
+	import resource
+except ImportError:
+	resource = None # not available on Windows
+
+from mdx15_print_gerber import GCode2RmlConverter
+
+
+class LegacyLineParser(GCode2RmlConverter):
+	# digestLine and processMoveCommand as they were before the dispatch table (without leveling), for comparison
+
+	def __init__(self,*args):
+		GCode2RmlConverter.__init__(self,*args)
+		self.moveCommandParseRegex = re.compile(r'G0([01])\s(X([-+]?\d*\.*\d+\s*))?(Y([-+]?\d*\.*\d+\s*))?(Z([-+]?\d*\.*\d+\s*))?')
+
+	def digestLine(self,line):
+		outputCommands = []
+		if self.isFirstCommand :
+			self.isFirstCommand = False
+			outputCommands.append('^DF') # set to defaults
+		line = line.rstrip() # strip line endings
+		if line == None or len(line) == 0 :
+			pass # empty line
+		elif line.startswith('(') :
+			pass # comment line
+		elif line == 'G20' : # units as inches
+			self.inputConversionFactor = 25.4
+		elif line == 'G21' : # units as mm
+			self.inputConversionFactor = 1.0
+		elif line == 'G90' : # absolute mode
+			pass # implied
+		elif line == 'G94' : # Feed rate units per minute mode
+			pass # implied
+		elif line == 'M03' : # spindle on
+			pass
+		elif line == 'M05' : # spindle off
+			outputCommands.append('^DF;!MC0;')
+			outputCommands.append('H')
+		elif line.startswith('G01 F'): # in flatcam 2018, the feed rate is set in a move command
+			self.feedrate = float(line[5:])
+		elif line.startswith('G00') or line.startswith('G01'): # move
+			outputCommands.extend( self.processMoveCommand(line) )
+		elif line.startswith('G4 P'): # dwell
+			dwelltime = int(line[4:])
+			outputCommands.append('W {}'.format( dwelltime ) )
+		elif line.startswith('F'): # feed rate
+			self.feedrate = float(line[1:])
+		else :
+			print('Unrecognized command: ' + line)
+		return outputCommands
+
+	def processMoveCommand(self, line):
+		outputCommands = []
+		g = self.moveCommandParseRegex.match(line)
+		if self.speedmode != g.group(1) :
+			self.speedmode = g.group(1)
+			f = self.feedrate * self.inputConversionFactor * self.feedspeedfactor / 60.0 # convert to mm per second
+			if self.speedmode == '0' : f = 16.0 # fast mode
+			outputCommands.append('V {0:.2f};F {0:.2f}'.format(f))
+		if g.group(3) != None : self.X = float(g.group(3)) * self.inputConversionFactor
+		if g.group(5) != None : self.Y = float(g.group(5)) * self.inputConversionFactor
+		if g.group(7) != None : self.Z = float(g.group(7)) * self.inputConversionFactor
+		outputScale = 1 / 0.025
+		z_correction = 0.0
+
+		# Backlash handling in X
+		if abs(self.backlashX) > self.epsilon :
+			deltaX = self.X - self.last_x
+			if abs(deltaX) > self.epsilon : # non-zero move in that axis
+				if deltaX * self.last_displacement_x < 0 : # direction changed
+					self.backlash_compensation_x = 0.0 if deltaX > 0 else -self.backlashX
+					outputCommands.append('Z {:.0f},{:.0f},{:.0f}'.format(self.last_x*outputScale+self.offset_x+self.backlash_compensation_x,self.last_y*outputScale+self.offset_y+self.backlash_compensation_y,self.last_z*outputScale+self.backlash_compensation_z+z_correction))
+				self.last_displacement_x = deltaX
+
+		# Backlash handling in Y
+		if abs(self.backlashY) > self.epsilon :
+			deltaY = self.Y - self.last_y
+			if abs(deltaY) > self.epsilon : # non-zero move in that axis
+				if deltaY * self.last_displacement_y < 0 : # direction changed
+					self.backlash_compensation_y = 0.0 if deltaY > 0 else -self.backlashY
+					outputCommands.append('Z {:.0f},{:.0f},{:.0f}'.format(self.last_x*outputScale+self.offset_x+self.backlash_compensation_x,self.last_y*outputScale+self.offset_y+self.backlash_compensation_y,self.last_z*outputScale+self.backlash_compensation_z+z_correction))
+				self.last_displacement_y = deltaY
+
+		# Backlash handling in Z
+		if abs(self.backlashZ) > self.epsilon :
+			deltaZ = self.Z - self.last_z
+			if abs(deltaZ) > self.epsilon : # non-zero move in that axis
+				if deltaZ * self.last_displacement_z < 0 : # direction changed
+					self.backlash_compensation_z = 0.0 if deltaZ > 0 else -self.backlashZ
+					outputCommands.append('Z {:.0f},{:.0f},{:.0f}'.format(self.last_x*outputScale+self.offset_x+self.backlash_compensation_x,self.last_y*outputScale+self.offset_y+self.backlash_compensation_y,self.last_z*outputScale+self.backlash_compensation_z+z_correction))
+				self.last_displacement_z = deltaZ
+
+		self.last_x = self.X
+		self.last_y = self.Y
+		self.last_z = self.Z
+
+		# Send move command
+		outputCommands.append('Z {:.0f},{:.0f},{:.0f}'.format(self.X*outputScale+self.offset_x+self.backlash_compensation_x, self.Y*outputScale+self.offset_y+self.backlash_compensation_y, self.Z*outputScale+self.backlash_compensation_z+z_correction))
+		return outputCommands
+
+
+def getSampleLines(filenames):
+	lines = []
+	for filename in filenames :
+		with open(filename) as f :
+			lines.extend( f.read().split('\n') )
+	return lines
+
+def timeLineParser(parserClass, lines):
+	# Time of one run over the lines, in seconds
+	converter = parserClass(0.0, 0.0, 1.0, 0.0, 0.0, 0.0, None, None)
+	with contextlib.redirect_stdout(io.StringIO()) : # unrecognized commands
+		start = time.perf_counter()
+		for line in lines :
+			converter.digestLine(line)
+		return time.perf_counter() - start
+
+def benchmarkLineParsers(lines, repeat):
+	# Best time of each parser, the runs alternate so that both see the same machine load
+	print('{} lines'.format(len(lines)))
+	parsers = ( ('startswith chain', LegacyLineParser), ('dispatch table', GCode2RmlConverter) )
+	results = {}
+	for k in range(repeat) :
+		for (name, parserClass) in parsers :
+			elapsed = timeLineParser(parserClass, lines)
+			if name not in results or elapsed < results[name] : results[name] = elapsed
+	for (name, parserClass) in parsers :
+		print('  {:<20}{:8.3f} s  {:12.0f} lines/s'.format(name, results[name], len(lines) / results[name]))
+	print('  speedup: {:.2f}x'.format( results['startswith chain'] / results['dispatch table'] ))
+	return results
+
+
+def getOutputSize(filename, packLength):
+	# Bytes and commands of the RML output for a gcode file
+	converter = GCode2RmlConverter(0.0, 0.0, 1.0, 0.0, 0.0, 0.0, None, None)
+	converter.packLength = packLength
+	with open(filename) as f :
+		lines = f.read().splitlines()
+	with contextlib.redirect_stdout(io.StringIO()) :
+		blocks = converter.iterateStreamText(lines)
+		if packLength != None :
+			blocks = converter.iteratePackedText(blocks)
+		text = ''.join(blocks)
+	return (len(text), text.count('\n'))
+
+def compareOutputSizes(filenames, packLengths=(None, 64, 128, 256)):
+	# Output size with and without Z command packing, and the transfer time at 9600 baud (8N1)
+	print('{:<20}{:>10}{:>10}{:>10}{:>10}'.format('file', 'packing', 'bytes', 'commands', 'seconds'))
+	for filename in filenames :
+		for packLength in packLengths :
+			(size, commands) = getOutputSize(filename, packLength)
+			print('{:<20}{:>10}{:>10}{:>10}{:>10.1f}'.format( os.path.basename(filename)[:19], packLength or 'off', size, commands, size / 960.0 ))
+
+
+##################################################
+# Benchmark suite on synthetic jobs
+
+def iterateSyntheticGcode(moveCount, seed=0, pathLength=32, size=(2.0,2.0)):
+	# Lines of a FlatCam-like isolation job in inches with about moveCount moves: paths of pathLength cutting moves
+	# (a random walk) separated by a retract, a rapid move and a plunge
+	rng = random.Random(seed)
+	for line in ('G20', 'G90', 'G94', 'G01 F3.00', 'G00 Z0.1000', 'M03', 'G4 P1') :
+		yield line
+	moves = 0
+	while moves < moveCount :
+		x = rng.uniform(0.0, size[0])
+		y = rng.uniform(0.0, size[1])
+		yield 'G00 X{:.4f} Y{:.4f}'.format(x, y)
+		yield 'G01 F3.00'
+		yield 'G01 Z-0.0040'
+		for k in range(pathLength) :
+			x = min( max( x + rng.uniform(-0.02, 0.02), 0.0 ), size[0] )
+			y = min( max( y + rng.uniform(-0.02, 0.02), 0.0 ), size[1] )
+			yield 'G01 X{:.4f} Y{:.4f}'.format(x, y)
+		yield 'G00 Z0.1000'
+		moves += pathLength + 3
+	for line in ('M05', 'G00 Z2.00', 'G00 X0Y0') :
+		yield line
+
+def writeSyntheticGcode(filename, moveCount, seed=0):
+	with open(filename, 'w') as f :
+		lines = []
+		for line in iterateSyntheticGcode(moveCount, seed) :
+			lines.append(line)
+			if len(lines) >= 1 << 16 :
+				f.write( '\n'.join(lines) + '\n' )
+				lines = []
+		f.write( '\n'.join(lines) + '\n' )
+
+def getSyntheticLevelingData(count=8, size=(2.0,2.0), seed=0):
+	# Autoleveling grid (levelingData[i][j] = (x,y,height) in machine steps) over the job area, a tilted and warped surface
+	rng = random.Random(seed)
+	scale = 25.4 * GCode2RmlConverter.OUTPUT_SCALE
+	return [ [ ( i * size[0] * scale / (count-1), j * size[1] * scale / (count-1), 0.02 * i * j + 2.0 * i - 1.5 * j + rng.uniform(-1.0,1.0) ) for j in range(count) ] for i in range(count) ]
+
+# Converter settings of the suite: name -> (backlash x,y,z in steps, leveling grid, leveling tolerance)
+BENCHMARK_CASES = {
+	'plain' : ( (0.0, 0.0, 0.0), False, None ),
+	'backlash' : ( (3.0, 2.0, 4.0), False, None ),
+	'leveling' : ( (0.0, 0.0, 0.0), True, None ),
+	'levelingtolerance' : ( (0.0, 0.0, 0.0), True, 1.0 ),
+}
+MAX_MEMORY_LINES = 2000000 # lines held in memory by the digestLine and processMoveCommand benchmarks
+
+def getBenchmarkConverter(case):
+	(backlash, leveling, tolerance) = BENCHMARK_CASES[case]
+	converter = GCode2RmlConverter(0.0, 0.0, 1.0, backlash[0], backlash[1], backlash[2], getSyntheticLevelingData() if leveling else None, None)
+	converter.levelingTolerance = tolerance
+	return converter
+
+def getPeakRss():
+	# Peak resident memory of this process in MB, None if unknown
+	if resource == None : return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss / ( 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0 )
+
+def runBenchmark(task):
+	# Runs one benchmark (in a new process, for its peak memory), returns its result record
+	(benchmark, case, moveCount, repeat, filename) = task
+	result = { 'benchmark' : benchmark, 'case' : case, 'moves' : moveCount }
+	best = None
+	if benchmark == 'convertFile' :
+		outfile = filename + '.' + case + '.prn'
+		with open(filename) as f :
+			lineCount = sum( 1 for line in f )
+		for k in range(repeat) :
+			converter = getBenchmarkConverter(case)
+			with contextlib.redirect_stdout(io.StringIO()) :
+				start = time.perf_counter()
+				converter.convertFile(filename, outfile)
+				elapsed = time.perf_counter() - start
+			if best == None or elapsed < best : best = elapsed
+		result['outputBytes'] = os.path.getsize(outfile)
+		os.remove(outfile)
+	else :
+		lines = list( itertools.islice( iterateSyntheticGcode(moveCount), MAX_MEMORY_LINES ) )
+		if benchmark == 'processMoveCommand' :
+			parser = GCode2RmlConverter(0.0, 0.0, 1.0, 0.0, 0.0, 0.0, None, None)
+			moves = []
+			for line in lines :
+				(commands, words, recognized) = parser.splitWords(line)
+				if len(commands) == 1 and ( commands[0] == 'G0' or commands[0] == 'G1' ) and 'F' not in words :
+					moves.append( (commands[0], words) )
+		lineCount = len(lines) if benchmark == 'digestLine' else len(moves)
+		for k in range(repeat) :
+			converter = getBenchmarkConverter(case)
+			converter.inputConversionFactor = 25.4
+			outputBytes = 0
+			with contextlib.redirect_stdout(io.StringIO()) :
+				start = time.perf_counter()
+				if benchmark == 'digestLine' :
+					for line in lines :
+						for cmd in converter.digestLine(line) : outputBytes += len(cmd) + 1
+				else :
+					for (command, words) in moves :
+						for cmd in converter.processMoveCommand(command, words) : outputBytes += len(cmd) + 1
+				elapsed = time.perf_counter() - start
+			if best == None or elapsed < best : best = elapsed
+		result['outputBytes'] = outputBytes
+	result['lines'] = lineCount
+	result['seconds'] = best
+	result['linesPerSecond'] = lineCount / best if best > 0 else None
+	result['peakRssMB'] = getPeakRss()
+	return result
+
+def runBenchmarkSuite(moveCounts, cases, repeat, folder):
+	# Every benchmark for each job size and converter setting, each in its own process
+	tasks = []
+	for moveCount in moveCounts :
+		filename = os.path.join(folder, 'synthetic_{}.nc'.format(moveCount))
+		writeSyntheticGcode(filename, moveCount)
+		for case in cases :
+			tasks.append( ('digestLine', case, moveCount, repeat, filename) )
+			if case != 'levelingtolerance' : # only digestLine splits the moves
+				tasks.append( ('processMoveCommand', case, moveCount, repeat, filename) )
+			tasks.append( ('convertFile', case, moveCount, repeat, filename) )
+	print('{:<20}{:<20}{:>10}{:>12}{:>10}{:>14}{:>10}{:>14}'.format('benchmark', 'case', 'moves', 'lines', 'seconds', 'lines/s', 'RSS MB', 'output bytes'))
+	results = []
+	with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool :
+		for result in pool.imap(runBenchmark, tasks) :
+			print('{benchmark:<20}{case:<20}{moves:>10}{lines:>12}{seconds:>10.3f}{linesPerSecond:>14.0f}{rss:>10}{outputBytes:>14}'.format(
+				rss = '-' if result['peakRssMB'] == None else '{:.0f}'.format(result['peakRssMB']), **result ))
+			results.append(result)
+	return results
+
+def writeBenchmarkResults(filename, results):
+	with open(filename, 'w') as f :
+		json.dump( { 'time' : time.strftime('%Y-%m-%d %H:%M:%S'), 'python' : sys.version.split()[0], 'platform' : sys.platform, 'results' : results }, f, indent=1 )
+
+def compareBenchmarkResults(filename, results, threshold=0.1):
+	# Prints the change in lines/s against a previous results file, flagging slowdowns above the threshold
+	with open(filename) as f :
+		previous = dict( ( (r['benchmark'], r['case'], r['moves']), r ) for r in json.load(f)['results'] )
+	print('Compared to {}:'.format(filename))
+	slower = 0
+	for result in results :
+		old = previous.get( (result['benchmark'], result['case'], result['moves']) )
+		if old == None or not old['linesPerSecond'] or not result['linesPerSecond'] : continue
+		ratio = result['linesPerSecond'] / old['linesPerSecond']
+		flag = ''
+		if ratio < 1.0 - threshold :
+			flag = '  SLOWER'
+			slower += 1
+		if old.get('outputBytes') != result.get('outputBytes') :
+			flag += '  output {} -> {} bytes'.format( old.get('outputBytes'), result.get('outputBytes') )
+		print('  {:<20}{:<20}{:>10}{:>8.2f}x{}'.format( result['benchmark'], result['case'], result['moves'], ratio, flag ))
+	print('{} benchmark(s) slower by more than {:.0f}%'.format(slower, threshold * 100))
+	return slower
+
+
+##################################################
+# Equivalence of the conversion paths
+
+def iterateVerificationGcode(moveCount, seed=0):
+	# Synthetic job lines mixed with the less regular lines that the batch engine hands to digestLine(): unit changes,
+	# feed rates, comments, dwells, odd spacing, repeated positions and single axis moves
+	rng = random.Random(seed)
+	extras = ( 'G20', 'G21', 'F30', 'G01 F12.5', '(comment)', '', 'G4 P1', 'F+5', 'G01 F.5', 'G00\tX0.5', 'G01 X0.25 (comment)',
+		'G01 Y1.0 X0.2', 'G00 X-0.0001', '   ', 'G01 Z-0.0000001', 'G01 Z-0.004', 'G00 Z0.1' )
+	previous = None
+	for line in iterateSyntheticGcode(moveCount, seed) :
+		r = rng.random()
+		if r < 0.03 :
+			yield rng.choice(extras)
+		elif r < 0.06 and previous != None :
+			yield previous
+		if line.startswith('G01 X') and rng.random() < 0.2 :
+			line = line.replace(' Y', 'Y') # no space between the words
+		yield line
+		previous = line
+
+# Converter settings checked by --verify: name -> (offset x,y in steps, feed speed factor, backlash x,y,z in steps,
+# leveling grid, manual leveling points in steps, manual leveling surface model)
+VERIFY_CASES = {
+	'plain' : ( (0.0, 0.0), 1.0, (0.0, 0.0, 0.0), False, None, 'plane' ),
+	'offsets' : ( (125.5, -40.25), 1.3, (0.0, 0.0, 0.0), False, None, 'plane' ),
+	'backlash' : ( (10.0, 20.0), 1.0, (3.0, 2.0, 4.0), False, None, 'plane' ),
+	'leveling' : ( (-30.0, 15.0), 1.0, (2.5, 0.0, 1.0), True, None, 'plane' ),
+	'manualleveling' : ( (5.0, 7.0), 1.0, (0.0, 3.0, 0.0), False, [ (0.0,0.0,0.0), (2000.0,30.0,5.0), (20.0,2000.0,-3.0) ], 'plane' ),
+	'quadraticleveling' : ( (0.0, 0.0), 1.0, (0.0, 0.0, 0.0), False,
+		[ (0.0,0.0,0.0), (2000.0,0.0,4.0), (0.0,2000.0,-2.0), (2000.0,2000.0,3.0), (1000.0,1000.0,1.0), (500.0,1500.0,-1.0) ], 'quadratic' ),
+}
+VERIFY_MODES = ( 'per-line', 'batch', 'parallel' )
+
+def getVerificationOutput(filename, case, mode, jobs):
+	# RML output of convertFile() for the file with the case settings and conversion mode
+	(offset, feedspeedfactor, backlash, leveling, manualPoints, surfaceModel) = VERIFY_CASES[case]
+	converter = GCode2RmlConverter(offset[0], offset[1], feedspeedfactor, backlash[0], backlash[1], backlash[2], getSyntheticLevelingData() if leveling else None, manualPoints)
+	converter.setLevelingSurfaceModel(surfaceModel)
+	converter.batchMode = mode != 'per-line'
+	if mode == 'parallel' :
+		converter.parallelJobs = jobs
+		converter.PARALLEL_CHUNK_SIZE = 1 << 12 # several chunks even for small jobs
+	outfile = filename + '.' + case + '.' + mode + '.prn'
+	with contextlib.redirect_stdout(io.StringIO()) : # unrecognized commands
+		converter.convertFile(filename, outfile)
+	with open(outfile) as f :
+		output = f.read()
+	os.remove(outfile)
+	return output
+
+def verifyConversionModes(moveCounts, seeds, jobs, folder):
+	# Converts synthetic jobs with every case setting in each mode, reports the first difference with the per-line output.
+	# Returns the number of mismatches.
+	mismatches = 0
+	for moveCount in moveCounts :
+		for seed in seeds :
+			filename = os.path.join(folder, 'verify_{}_{}.nc'.format(moveCount, seed))
+			with open(filename, 'w') as f :
+				f.write( '\n'.join( iterateVerificationGcode(moveCount, seed) ) + '\n' )
+			for case in VERIFY_CASES :
+				outputs = dict( (mode, getVerificationOutput(filename, case, mode, jobs)) for mode in VERIFY_MODES )
+				reference = outputs['per-line'].split('\n')
+				result = 'ok'
+				for mode in VERIFY_MODES[1:] :
+					if outputs[mode] == outputs['per-line'] : continue
+					mismatches += 1
+					lines = outputs[mode].split('\n')
+					k = next( ( k for (k, (a, b)) in enumerate(zip(reference, lines)) if a != b ), min(len(reference), len(lines)) )
+					result = '{} differs at line {}: {!r} instead of {!r}'.format( mode, k+1, lines[k] if k < len(lines) else None, reference[k] if k < len(reference) else None )
+					break
+				print('{:>10} moves  seed {:<4}{:<20}{:>10} bytes  {}'.format( moveCount, seed, case, len(outputs['per-line']), result ))
+	print('{} mismatch(es)'.format(mismatches))
+	return mismatches
+
+
+def main():
+
+	import optparse
+	parser = optparse.OptionParser('usage%prog [gcode files]')
+	parser.add_option('-r', '--repeat', dest='repeat', default=5, help='Number of runs, the best time is reported. (Default: 5)')
+	parser.add_option('-c', '--copies', dest='copies', default=20, help='Number of times the input lines are repeated. (Default: 20)')
+	parser.add_option('-s', '--suite', dest='suite', action="store_true", default=False, help='Run the benchmark suite on synthetic jobs instead.')
+	parser.add_option('-m', '--moves', dest='moves', default='10000,100000', help='Suite and --verify job sizes, in moves. (Default: 10000,100000)')
+	parser.add_option('--cases', dest='cases', default=','.join(BENCHMARK_CASES), help='Suite converter settings. (Default: {})'.format(','.join(BENCHMARK_CASES)))
+	parser.add_option('--json', dest='json', default='', help='Write the suite results to this JSON file.')
+	parser.add_option('--compare', dest='compare', default='', help='Compare the suite results with a previous JSON file.')
+	parser.add_option('--verify', dest='verify', action="store_true", default=False, help='Check that the per-line, batch and parallel conversions give the same output on synthetic jobs.')
+	parser.add_option('--seeds', dest='seeds', default=3, help='Number of synthetic jobs per size checked by --verify. (Default: 3)')
+	parser.add_option('-j', '--jobs', dest='jobs', default=3, help='Processes of the parallel conversion checked by --verify. (Default: 3)')
+	(options,args) = parser.parse_args()
+
+	if options.verify :
+		with tempfile.TemporaryDirectory() as folder :
+			mismatches = verifyConversionModes( [ int(n) for n in options.moves.split(',') ], range(int(options.seeds)), int(options.jobs), folder )
+		sys.exit(1 if mismatches > 0 else 0)
+
+	if options.suite :
+		with tempfile.TemporaryDirectory() as folder :
+			results = runBenchmarkSuite( [ int(n) for n in options.moves.split(',') ], options.cases.split(','), int(options.repeat), folder )
+		if options.json != '' :
+			writeBenchmarkResults(options.json, results)
+		if options.compare != '' :
+			compareBenchmarkResults(options.compare, results)
+		return
+
+	if len(args) == 0 :
+		folder = os.path.dirname(os.path.abspath(__file__))
+		args = [ os.path.join(folder, name) for name in ('cam_out.nc', 'mdx15_tests.nc', 'test_cnc.nc') ]
+	lines = getSampleLines(args) * int(options.copies)
+	benchmarkLineParsers(lines, int(options.repeat))
+	print('')
+	compareOutputSizes(args)
+
+
+if __name__ == "__main__":
+	if sys.version_info[0] < 3 :
+		print("This script requires Python version 3")
+		sys.exit(1)
+	main()
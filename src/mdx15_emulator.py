@@ -0,0 +1,463 @@
+#
+# Virtual Roland MODELA MDX-15, in process or on a pseudo-terminal, for testing and benchmarking without the machine
+#
+#
+# MIT License
+#
+# Copyright (c) 2018 Charles Donohue
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import os
+import sys
+import math
+import time
+import select
+import threading
+import collections
+
+from mdx15_print_gerber import RmlJobSimulator, RmlSender, ModelaZeroControl
+
+
+class VirtualModela:
+	# Emulates the MDX-15 for testing and benchmarking without the machine.
+	# The host writes through connect() (VirtualSerialPort, in the same process) or through a pseudo-terminal (openPty(),
+	# Linux only). Bytes go over the emulated line at the baud rate into an input buffer of bufferSize bytes, only while
+	# the buffer has room: that is the machine's CTS (cts), which the VirtualSerialPort shows to the writer. A pty has no
+	# CTS: its writer only blocks once the kernel buffer (a few KB) is full too.
+	# Commands run one after the other, each move taking the time found by stepping the motors (getMoveTime()) with the
+	# emulated machine's acceleration, maximum speed and settle time, divided by timeScale. This is independent of the
+	# MotionModel that the control uses to estimate the same times. A baudrate of 0 sends as fast as possible.
+	# The tool position trace (time, x, y, z, spindle) is recorded in steps, Z including the !ZO offset.
+
+	BUFFER_SIZE = 1024 # bytes
+	LINE_SIZE = 64 # bytes moved over the line at once, at most
+	ACCELERATION = 100.0 # mm per second squared
+	MAX_SPEED = 15.0 # mm per second
+	SETTLE_TIME = 0.0 # seconds
+	TIME_STEP = 0.0005 # seconds, motion integration step
+
+	def __init__(self, bufferSize=BUFFER_SIZE, baudrate=9600, timeScale=1.0, acceleration=ACCELERATION, maxSpeed=MAX_SPEED, settleTime=SETTLE_TIME):
+		self.bufferSize = bufferSize
+		self.baudrate = baudrate
+		self.timeScale = timeScale
+		self.acceleration = acceleration
+		self.maxSpeed = maxSpeed
+		self.settleTime = settleTime
+		self.port = None
+		self.master = None
+		self.slave = None
+
+		self.condition = threading.Condition()
+		self.pending = bytearray() # written by the host, not on the line yet
+		self.sending = 0 # bytes on the line
+		self.commands = collections.deque() # (command, time its last byte arrived)
+		self.partial = b'' # command being received
+		self.buffered = 0 # bytes in the input buffer
+		self.busy = False
+		self.running = False
+		self.threads = []
+
+		self.reset()
+		self.zOffset = 0.0
+		self.position = (0.0, 0.0, 0.0)
+		self.trace = []
+		self.bytesReceived = 0
+		self.commandsExecuted = 0
+		self.ctsOffTime = 0.0 # seconds with data waiting while CTS is off
+		self.waits = [] # seconds from the arrival of each command to its start
+		self.unknownCommands = collections.Counter()
+		self.started = None
+		self.lastActivity = None
+
+	def reset(self):
+		# ^IN and ^DF defaults
+		self.xySpeed = RmlJobSimulator.DEFAULT_SPEED
+		self.zSpeed = RmlJobSimulator.DEFAULT_SPEED
+		self.spindle = False
+
+	@property
+	def cts(self):
+		with self.condition :
+			return self.buffered < self.bufferSize
+
+	def connect(self):
+		# A port for RmlSender or SerialCommandWriter
+		return VirtualSerialPort(self)
+
+	def openPty(self):
+		# Pseudo-terminal for another process, returns its name. Call before start().
+		import tty
+		(self.master, self.slave) = os.openpty()
+		tty.setraw(self.master)
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+		return self.port
+
+	def start(self):
+		self.running = True
+		self.started = time.perf_counter()
+		loops = [ self.lineLoop, self.executeLoop ]
+		if self.master != None : loops.append( self.ptyLoop )
+		for target in loops :
+			thread = threading.Thread(target=target, daemon=True)
+			thread.start()
+			self.threads.append(thread)
+
+	def stop(self):
+		with self.condition :
+			self.running = False
+			self.condition.notify_all()
+		for thread in self.threads :
+			thread.join()
+		if self.master != None :
+			os.close(self.master)
+			os.close(self.slave)
+
+	def isIdle(self):
+		with self.condition :
+			return len(self.pending) == 0 and self.sending == 0 and len(self.commands) == 0 and not self.busy and len(self.partial) == 0
+
+	def waitIdle(self, timeout=None):
+		# Blocks until every command written has run (and, with a pty, no data arrived for a moment)
+		end = None if timeout == None else time.perf_counter() + timeout
+		while True :
+			if self.isIdle() and ( self.master == None or len(select.select([self.master], [], [], 0.1)[0]) == 0 ) :
+				return True
+			if end != None and time.perf_counter() > end :
+				return False
+			time.sleep(0.01)
+
+	def write(self, data):
+		# Bytes from the host, see VirtualSerialPort
+		with self.condition :
+			self.pending.extend(data)
+			self.condition.notify_all()
+
+	def lineLoop(self):
+		# Moves the pending bytes over the line into the input buffer while there is room (CTS on). A piece ends at a
+		# command end, so that the command arrives on time, and the line keeps its own clock so that short sleeps add no delay.
+		byteTime = 10.0 / self.baudrate if self.baudrate > 0 else 0.0 # seconds per byte (8N1)
+		lineClock = 0.0 # when the line is done with the bytes taken so far
+		while True :
+			with self.condition :
+				waited = None
+				while self.running and ( len(self.pending) == 0 or self.buffered >= self.bufferSize ) :
+					if len(self.pending) > 0 and waited == None : waited = time.perf_counter()
+					self.condition.wait()
+				if waited != None : self.ctsOffTime += time.perf_counter() - waited
+				if not self.running : break
+				data = bytes( self.pending[:min( self.LINE_SIZE, self.bufferSize - self.buffered )] )
+				ends = [ k for k in ( data.find(b';'), data.find(b'\n') ) if k >= 0 ]
+				if len(ends) > 0 : data = data[:min(ends)+1]
+				del self.pending[:len(data)]
+				self.sending = len(data)
+			lineClock = max( lineClock, time.perf_counter() ) + len(data) * byteTime
+			time.sleep( max( 0.0, lineClock - time.perf_counter() ) )
+			self.receive(data)
+
+	def ptyLoop(self):
+		# Reads the pty as the line takes the bytes, the rest waits in the kernel buffer
+		while self.running :
+			with self.condition :
+				while self.running and len(self.pending) >= self.LINE_SIZE :
+					self.condition.wait()
+			if len( select.select([self.master], [], [], 0.05)[0] ) == 0 :
+				continue
+			try :
+				self.write( os.read(self.master, self.LINE_SIZE) )
+			except OSError :
+				break
+
+	def receive(self, data):
+		now = time.perf_counter()
+		with self.condition :
+			self.sending = 0
+			self.bytesReceived += len(data)
+			self.buffered += len(data)
+			self.lastActivity = now
+			pieces = (self.partial + data).replace(b'\n', b';').replace(b'\r', b';').split(b';')
+			self.partial = pieces.pop()
+			for piece in pieces :
+				self.commands.append( ( piece, now ) )
+			self.condition.notify_all()
+
+	def executeLoop(self):
+		while True :
+			with self.condition :
+				while self.running and len(self.commands) == 0 :
+					self.condition.wait()
+				if not self.running : break
+				(cmd, received) = self.commands.popleft()
+				self.busy = True
+			self.waits.append( time.perf_counter() - received )
+			self.execute( cmd.decode('ascii','replace').strip() )
+			with self.condition :
+				self.buffered -= len(cmd) + 1
+				self.busy = False
+				self.commandsExecuted += 1
+				self.lastActivity = time.perf_counter()
+				self.condition.notify_all()
+
+	def execute(self, cmd):
+		if len(cmd) == 0 :
+			return
+		try :
+			if cmd.startswith('^IN') :
+				self.reset()
+				self.zOffset = 0.0
+			elif cmd.startswith('^DF') :
+				self.reset()
+			elif cmd.startswith('!MC') :
+				self.spindle = cmd[3:].strip() == '1'
+				self.record()
+			elif cmd.startswith('!ZO') :
+				self.zOffset = float(cmd[3:])
+			elif cmd.startswith('!PZ') :
+				pass # pen up/down heights, not used by the Z command
+			elif cmd[0] == 'V' :
+				self.zSpeed = float(cmd[1:])
+			elif cmd[0] == 'F' :
+				self.xySpeed = float(cmd[1:])
+			elif cmd[0] == 'Z' :
+				values = [ float(v) for v in cmd[1:].split(',') ]
+				for k in range(0, len(values) - 2, 3) :
+					self.moveTo( values[k], values[k+1], values[k+2] )
+			elif cmd[0] == 'H' :
+				self.moveTo( 0.0, 0.0, self.position[2] )
+			elif cmd[0] == 'W' :
+				time.sleep( float(cmd[1:]) / 1000.0 / self.timeScale )
+			else :
+				self.unknownCommands[cmd.split()[0][:3]] += 1
+		except ValueError :
+			self.unknownCommands[cmd[:3]] += 1
+
+	def getAxisTime(self, distance, speed):
+		# Steps an axis through the move: it speeds up while it can still stop in the distance left, then brakes
+		distance = abs(distance) / RmlJobSimulator.STEPS_PER_MM
+		speed = min(speed, self.maxSpeed)
+		if distance == 0.0 or speed <= 0.0 : return 0.0
+		if self.acceleration <= 0.0 : return distance / speed
+		dv = self.acceleration * self.TIME_STEP
+		(t, v, covered) = (0.0, 0.0, 0.0)
+		while covered < distance :
+			left = distance - covered
+			v1 = max( min( v + dv, speed, math.sqrt( 2.0 * self.acceleration * left ) ), dv ) # limited to stop at the end
+			step = 0.5 * (v + v1) * self.TIME_STEP
+			if step >= left :
+				t += left / ( 0.5 * (v + v1) )
+				break
+			t += self.TIME_STEP
+			covered += step
+			v = v1
+		return t
+
+	def getMoveTime(self, dx, dy, dz):
+		t = max( self.getAxisTime( math.hypot(dx,dy), self.xySpeed ), self.getAxisTime( dz, self.zSpeed ) )
+		return t + self.settleTime if t > 0.0 else 0.0
+
+	def moveTo(self, x, y, z):
+		(x0, y0, z0) = self.position
+		time.sleep( self.getMoveTime( x - x0, y - y0, z - z0 ) / self.timeScale )
+		self.position = (x, y, z)
+		self.record()
+
+	def record(self):
+		(x, y, z) = self.position
+		self.trace.append( ( time.perf_counter() - self.started, x, y, z + self.zOffset, self.spindle ) )
+
+	def getReport(self):
+		waits = sorted(self.waits)
+		elapsed = ( self.lastActivity or self.started ) - self.started
+		return {
+			'bytes' : self.bytesReceived,
+			'commands' : self.commandsExecuted,
+			'seconds' : elapsed,
+			'bytesPerSecond' : self.bytesReceived / elapsed if elapsed > 0 else 0.0,
+			'ctsOffTime' : self.ctsOffTime,
+			'medianWait' : waits[len(waits)//2] if len(waits) > 0 else None,
+			'maxWait' : waits[-1] if len(waits) > 0 else None,
+			'unknownCommands' : dict(self.unknownCommands),
+		}
+
+	def printReport(self):
+		r = self.getReport()
+		print('Received {bytes} bytes, ran {commands} commands in {seconds:.2f} s ({bytesPerSecond:.0f} bytes/s), CTS held off for {ctsOffTime:.2f} s'.format(**r))
+		if r['medianWait'] != None :
+			print('Command wait in buffer: median {:.1f} ms, max {:.1f} ms'.format( 1000.0 * r['medianWait'], 1000.0 * r['maxWait'] ))
+		if len(r['unknownCommands']) > 0 :
+			print('Unknown commands: {}'.format(r['unknownCommands']))
+
+	def writeTrace(self, filename):
+		with open(filename, 'w') as f :
+			f.write('time,x,y,z,spindle\n')
+			for (t, x, y, z, spindle) in self.trace :
+				f.write( '{:.4f},{:.0f},{:.0f},{:.0f},{}\n'.format( t, x, y, z, 1 if spindle else 0 ) )
+
+
+class VirtualSerialPort:
+	# Serial port to a VirtualModela in the same process, with RTS/CTS flow control: write() queues the bytes in the
+	# driver's output buffer (blocking while it holds OUTPUT_BUFFER_SIZE bytes), which the emulated line empties only
+	# while the machine's CTS is on. flush() returns once every byte is in the machine's input buffer.
+
+	OUTPUT_BUFFER_SIZE = 4096 # bytes
+
+	def __init__(self, emulator):
+		self.emulator = emulator
+		self.baudrate = emulator.baudrate
+		self.is_open = True
+
+	def __str__(self):
+		return 'virtual MDX-15'
+
+	@property
+	def cts(self):
+		return self.emulator.cts
+
+	def write(self, data):
+		condition = self.emulator.condition
+		for k in range(0, len(data), self.OUTPUT_BUFFER_SIZE) :
+			with condition :
+				condition.wait_for( lambda : len(self.emulator.pending) < self.OUTPUT_BUFFER_SIZE or not self.emulator.running )
+			self.emulator.write( data[k:k+self.OUTPUT_BUFFER_SIZE] )
+		return len(data)
+
+	def flush(self):
+		with self.emulator.condition :
+			self.emulator.condition.wait_for( lambda : ( len(self.emulator.pending) == 0 and self.emulator.sending == 0 ) or not self.emulator.running )
+
+	def reset_output_buffer(self):
+		with self.emulator.condition :
+			self.emulator.pending.clear()
+			self.emulator.condition.notify_all()
+
+	def close(self):
+		self.is_open = False
+
+
+##################################################
+# End-to-end measurements
+
+def benchmarkSend(emulator, filename):
+	# Streams an RML file to the emulator with RmlSender, compares the time with the estimate
+	estimate = RmlJobSimulator().simulateFile(filename)['total']['totalTime'] / emulator.timeScale
+	sender = RmlSender(emulator.connect())
+	started = time.perf_counter()
+	try :
+		sender.sendFile(filename, progress=lambda *args : None)
+	finally :
+		sender.close()
+	sent = time.perf_counter() - started
+	emulator.waitIdle()
+	total = time.perf_counter() - started
+	print('Sent {} in {:.2f} s, job done in {:.2f} s (estimate {:.2f} s)'.format( os.path.basename(filename), sent, total, estimate ))
+
+def benchmarkJog(emulator, count, interval):
+	# Jogs like holding a key, then waits for the last target; reports the writer latency and the time to reach the target
+	control = ModelaZeroControl(emulator.connect())
+	control.spindleEnabled = False
+	started = time.perf_counter()
+	for k in range(count) :
+		control.x += control.XY_INCREMENTS
+		control.sendMoveCommand()
+		time.sleep(interval)
+	control.writer.waitSent()
+	emulator.waitIdle()
+	reached = time.perf_counter() - started - count * interval
+	control.writer.printLatencyReport()
+	control.close()
+	print('Jog target reached {:.1f} ms after the last keypress, at x={:.0f}'.format( 1000.0 * reached, emulator.position[0] ))
+
+def benchmarkWaits(emulator, count, heightpoints):
+	# Probes like getAutolevelingData() on a count x count grid, compares when each waited move returns with when the
+	# emulator reached its target: a wait that returns early samples the focus before the move is done.
+	# The control waits by its MotionModel estimate, the emulator moves by its own motion (see VirtualModela).
+	control = ModelaZeroControl(emulator.connect())
+	control.spindleEnabled = False
+	errors = []
+	started = time.perf_counter()
+	for i in range(count) :
+		for j in range(count) :
+			for k in range(heightpoints) :
+				target = ( i * 100.0, j * 100.0, heightpoints/2 - k * 1.0 )
+				first = len(emulator.trace)
+				control.moveTo( target[0], target[1], target[2], wait=True )
+				done = time.perf_counter() - emulator.started
+				reached = None
+				while reached == None and time.perf_counter() - emulator.started < done + 5.0 :
+					reached = next( ( t for (t, x, y, z, spindle) in emulator.trace[first:] if (x, y, z - emulator.zOffset) == target ), None )
+					time.sleep(0.001)
+				if reached != None :
+					errors.append( done - reached )
+	total = time.perf_counter() - started
+	control.close()
+	errors.sort()
+	print('{} waited moves in {:.2f} s'.format( len(errors), total ))
+	if len(errors) > 0 :
+		print('Wait end after the move end: min {:.1f} ms, median {:.1f} ms, max {:.1f} ms, {} early'.format(
+			1000.0 * errors[0], 1000.0 * errors[len(errors)//2], 1000.0 * errors[-1], len([ e for e in errors if e < 0.0 ]) ))
+
+
+def main():
+
+	import optparse
+	parser = optparse.OptionParser('usage%prog [options]')
+	parser.add_option('-b', '--buffer', dest='buffer', default=VirtualModela.BUFFER_SIZE, help='Input buffer size in bytes. (Default: {})'.format(VirtualModela.BUFFER_SIZE))
+	parser.add_option('--baudrate', dest='baudrate', default=9600, help='Serial line rate, 0 for no limit. (Default: 9600)')
+	parser.add_option('-t', '--timescale', dest='timescale', default=1.0, help='Motion runs this many times faster than real time. (Default: 1)')
+	parser.add_option('--trace', dest='trace', default='', help='Write the tool position trace to this CSV file.')
+	parser.add_option('--send', dest='send', default='', help='Stream this RML file to the emulator and report the job time.')
+	parser.add_option('--jog', dest='jog', default=0, help='Send this many jog moves (one per 10 ms) and report the latency.')
+	parser.add_option('--probe', dest='probe', default=0, help='Probe a grid of this many points per side with waited moves and report how the waits match the motion.')
+	parser.add_option('--acceleration', dest='acceleration', default=VirtualModela.ACCELERATION, help='Emulated axis acceleration in mm/s^2, 0 for none. (Default: {})'.format(VirtualModela.ACCELERATION))
+	parser.add_option('--maxspeed', dest='maxspeed', default=VirtualModela.MAX_SPEED, help='Emulated maximum speed in mm/s. (Default: {})'.format(VirtualModela.MAX_SPEED))
+	parser.add_option('--settle', dest='settle', default=VirtualModela.SETTLE_TIME, help='Emulated settle time after each move in seconds. (Default: {})'.format(VirtualModela.SETTLE_TIME))
+	(options,args) = parser.parse_args()
+
+	emulator = VirtualModela( int(options.buffer), int(options.baudrate), float(options.timescale), float(options.acceleration), float(options.maxspeed), float(options.settle) )
+	interactive = options.send == '' and int(options.jog) == 0 and int(options.probe) == 0
+	if interactive :
+		emulator.openPty()
+	emulator.start()
+	try :
+		if options.send != '' :
+			benchmarkSend(emulator, options.send)
+		elif int(options.jog) > 0 :
+			benchmarkJog(emulator, int(options.jog), 0.01)
+		elif int(options.probe) > 0 :
+			benchmarkWaits(emulator, int(options.probe), 10)
+		else :
+			print('Virtual MDX-15 on {} (CTRL-C to stop)'.format(emulator.port))
+			while True :
+				time.sleep(1.0)
+	except KeyboardInterrupt :
+		pass
+	emulator.printReport()
+	if options.trace != '' :
+		emulator.writeTrace(options.trace)
+	emulator.stop()
+
+
+if __name__ == "__main__":
+	if sys.version_info[0] < 3 :
+		print("This script requires Python version 3")
+		sys.exit(1)
+	main()
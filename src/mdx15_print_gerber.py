@@ -35,12 +35,39 @@ import sys
 import threading
 import traceback
 import math
-
-import msvcrt 
+import itertools
+import collections
+import bisect
+import copy
+import contextlib
+import io
+import multiprocessing
+import hashlib
+import json
+import shutil
+import glob
+
+try:
+	import msvcrt # keyboard input, windows only
+except ImportError:
+	msvcrt = None
 import serial
-import cv2
+try:
+	import cv2 # only needed for the microscope
+except ImportError:
+	cv2 = None
 import numpy
 
+def readKey(echo=False):
+	# One keypress with msvcrt, otherwise the first character of a line typed on the console (no arrow keys): an empty
+	# line is ENTER ('\r', as msvcrt reports it) and the end of the input is 'q' (quit)
+	if msvcrt == None :
+		try :
+			return input()[:1] or '\r'
+		except EOFError :
+			return 'q'
+	return msvcrt.getwche() if echo else msvcrt.getwch()
+
 class GCode2RmlConverter:
 
 	# stateful variables
@@ -71,10 +98,61 @@ class GCode2RmlConverter:
 	epsilon = 0.001
 
 	levelingData = None
+	levelingHeightMap = None
+	levelingTolerance = None # steps, feed rate moves are split where the leveled surface deviates more from a straight line
 	manualLevelingPoints = None
+	levelingSurface = None # LevelingSurface of the manual leveling points, when there are at least 3
+
+	# Toolpath optimization, see ToolpathOptimizer
+	optimizeToolpaths = False
+	reversePaths = False
+	simplifyTolerance = None # steps, see PolylineSimplifier
+	packLength = None # characters per Z command when packing moves, see RmlCommandPacker
+
+	stats = None # ConversionStats to collect, None to disable
+
+	# Parallel conversion, see iterateParallelText()
+	parallelJobs = None # processes
+	PARALLEL_CHUNK_SIZE = 1 << 20 # minimum characters per chunk
+	MODAL_STATE = ( 'inputConversionFactor', 'X', 'Y', 'Z', 'speedmode', 'feedrate', 'isFirstCommand', 'last_x', 'last_y', 'last_z',
+		'last_displacement_x', 'last_displacement_y', 'last_displacement_z', 'backlash_compensation_x', 'backlash_compensation_y', 'backlash_compensation_z' )
+
+	# Streaming conversion
+	INPUT_CHUNK_SIZE = 1 << 20 # characters read per block
+	STREAM_CHUNK_LINES = 1 << 14 # lines per block when converting a line iterator
+	OUTPUT_BUFFER_SIZE = 1 << 16 # bytes
+
+	# Batch conversion of runs of moves, see convertText()
+	batchMode = True
+	MIN_BATCH_LINES = 16 # shorter runs use the per-line path
+	POW10 = numpy.array([ float(10**k) for k in range(23) ]) # exact powers of ten
+	CHAR_SPACE, CHAR_NEWLINE, CHAR_LETTER, CHAR_DOT, CHAR_SIGN, CHAR_DIGIT = range(1,7) # numeric classes last
+	CHARACTER_CLASSES = numpy.zeros(256, dtype=numpy.uint8) # 0 for characters not expected in a move line
+	CHARACTER_CLASSES[ [ord(c) for c in ' \t\r'] ] = CHAR_SPACE
+	CHARACTER_CLASSES[ord('\n')] = CHAR_NEWLINE
+	CHARACTER_CLASSES[ord('A'):ord('Z')+1] = CHAR_LETTER
+	CHARACTER_CLASSES[ord('.')] = CHAR_DOT
+	CHARACTER_CLASSES[ [ord('-'),ord('+')] ] = CHAR_SIGN
+	CHARACTER_CLASSES[ord('0'):ord('9')+1] = CHAR_DIGIT
+	CHARACTER_CLASSES = CHARACTER_CLASSES.tobytes() # translation table for bytes.translate()
+
+	RAPID_SPEED = 16.0 # mm per second
+	MAX_SPEED = 15.0 # mm per second, MDX-15 maximum feed rate: rapid moves run at this speed
+
+	#OUTPUT_SCALE = 1 / 0.01
+	OUTPUT_SCALE = 1 / 0.025 # mm to machine steps
 
 	def __init__(self,offset_x,offset_y,feedspeedfactor,backlashX,backlashY,backlashZ,levelingData,manualLevelingPoints):
-		self.moveCommandParseRegex = re.compile(r'G0([01])\s(X([-+]?\d*\.*\d+\s*))?(Y([-+]?\d*\.*\d+\s*))?(Z([-+]?\d*\.*\d+\s*))?')
+		# G-code words (a letter and a number), any other non-space character ends up in the last group
+		self.wordRegex = re.compile(r'([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))|(\S)')
+		# Fast path of digestLine() for moves in the 'G0[01] X.. Y.. Z..' layout, with the same numbers as wordRegex
+		self.moveLineRegex = re.compile(r'G0([01])[ \t]+(?:X([-+]?(?:\d+\.?\d*|\.\d+))[ \t]*)?(?:Y([-+]?(?:\d+\.?\d*|\.\d+))[ \t]*)?(?:Z([-+]?(?:\d+\.?\d*|\.\d+))[ \t]*)?')
+		self.commentRegex = re.compile(r'\(.*?(?:\)|$)|;.*')
+		self.commandHandlers = self.getCommandHandlers()
+		# Moves in the 'G0[01] X.. Y.. Z..' layout, applied to a whole run of move lines at once (fallback for parseMoveData)
+		self.moveBatchParseRegex = re.compile(r'^G0([01])[ \t](?:X([-+]?\d*\.*\d+)[ \t]*)?(?:Y([-+]?\d*\.*\d+)[ \t]*)?(?:Z([-+]?\d*\.*\d+)[ \t]*)?$', re.MULTILINE)
+		self.feedLineRegex = re.compile(r'^(?:F|G01 F)', re.MULTILINE)
+		self.unitsRegex = re.compile(r'[Gg]\s*0*2[01](?![\d.])') # candidate lines for getUnitChanges()
 		self.offset_x = offset_x
 		self.offset_y = offset_y
 		self.feedspeedfactor = feedspeedfactor
@@ -82,15 +160,43 @@ class GCode2RmlConverter:
 		self.backlashY = backlashY
 		self.backlashZ = backlashZ
 		self.levelingData = levelingData
+		if levelingData != None : self.levelingHeightMap = LevelingHeightMap(levelingData)
 		self.manualLevelingPoints = manualLevelingPoints
+		self.setLevelingSurfaceModel('plane')
+
+	def setLevelingSurfaceModel(self, model):
+		# See LevelingSurface.MODELS
+		if self.manualLevelingPoints != None and len(self.manualLevelingPoints) >= 3 :
+			self.levelingSurface = LevelingSurface(self.manualLevelingPoints, model)
+
+	def getOutputSettings(self):
+		# Every setting that changes the output for a given input (see ConversionCache)
+		return ( self.offset_x, self.offset_y, self.feedspeedfactor, self.backlashX, self.backlashY, self.backlashZ,
+			self.levelingData, self.manualLevelingPoints, self.levelingSurface.model if self.levelingSurface != None else None, self.levelingTolerance,
+			self.optimizeToolpaths, self.reversePaths, self.simplifyTolerance, self.packLength, self.OUTPUT_SCALE )
+
+	def iterateStream(self, lineIterator):
+		# Generator version of digestStream, only holds the commands of one block of lines at a time
+		for text in self.iterateStreamText(lineIterator) :
+			for cmd in text.split('\n')[:-1] :
+				yield cmd
+
+	def iterateStreamText(self, lineIterator):
+		# Converts the lines in blocks of STREAM_CHUNK_LINES, yields the RML text of each block
+		lineIterator = iter(lineIterator)
+		while True :
+			lines = list( itertools.islice(lineIterator, self.STREAM_CHUNK_LINES) )
+			if len(lines) == 0 : break
+			yield self.convertText( '\n'.join( map(str.rstrip, lines) ) + '\n' )
 
 	def digestStream(self, lineIterator):
-		outputCommands = []
-		for line in lineIterator :
-			outputCommands.extend( self.digestLine(line) )
-		return outputCommands
+		return list( self.iterateStream(lineIterator) )
 
 	def digestLine(self,line):
+		line = line.rstrip() # strip line endings
+		g = self.moveLineRegex.fullmatch(line)
+		if g != None and g.lastindex > 1 and self.stats == None and not self.isFirstCommand :
+			return self.processMove( *g.groups() ) # most lines
 		outputCommands = []
 
 		if self.isFirstCommand :
@@ -99,115 +205,150 @@ class GCode2RmlConverter:
 			outputCommands.append('^DF') # set to defaults
 			#outputCommands.append('! 1;Z 0,0,813') # not sure what this does. Maybe starts the spindle? TODO: Try without.
 
-		line = line.rstrip() # strip line endings
 		#print('cmd: '+line)
-		if line == None or len(line) == 0 :
-			pass # empty line
-		elif line.startswith('(') :
-			pass # comment line
-		elif line == 'G20' : # units as inches
-			self.inputConversionFactor = 25.4
-		elif line == 'G21' : # units as mm
-			self.inputConversionFactor = 1.0
-		elif line == 'G90' : # absolute mode
-			pass # implied
-		elif line == 'G94' : # Feed rate units per minute mode
-			pass # implied
-		elif line == 'M03' : # spindle on
-			pass
-		elif line == 'M05' : # spindle off
-			outputCommands.append('^DF;!MC0;')
-			outputCommands.append('H')
-		elif line.startswith('G01 F'): # in flatcam 2018, the feed rate is set in a move command
-			self.feedrate = float(line[5:]) 
-		elif line.startswith('G00') or line.startswith('G01'): # move
-			outputCommands.extend( self.processMoveCommand(line) )	
-		elif line.startswith('G4 P'): # dwell
-			dwelltime = int(line[4:])
-			outputCommands.append('W {}'.format( dwelltime ) )
-		elif line.startswith('F'): # feed rate
-			self.feedrate = float(line[1:]) 
-		# ...
-		else :
+		stats = self.stats
+		if stats != None : started = time.perf_counter()
+		if g != None and g.lastindex > 1 :
+			if stats != None : stats.lap('parsing', started)
+			outputCommands.extend( self.processMove( *g.groups() ) )
+			return outputCommands
+		(commands, words, recognized) = self.splitWords(line)
+		if stats != None : stats.lap('parsing', started)
+		if recognized and len(commands) == 0 and len(words) == 0 :
+			return outputCommands # empty or comment line
+
+		# The F word applies to the commands on the same line
+		if 'F' in words : # feed rate
+			self.feedrate = float(words['F'])
+		elif len(commands) == 0 :
+			recognized = False
+
+		for command in commands :
+			handler = self.commandHandlers.get(command)
+			if handler != None :
+				outputCommands.extend( handler(command, words) )
+			else :
+				recognized = False
+		if not recognized :
 			print('Unrecognized command: ' + line)
-			pass
+			if stats != None : stats.addUnrecognized(line, commands, words, self.commandHandlers)
 		return outputCommands
 
-	def getHeightFor3PointPlane( self, p1,p2,p3, x, y ):
-		x1, y1, z1 = p1
-		x2, y2, z2 = p2
-		x3, y3, z3 = p3
-		v1 = [x3 - x1, y3 - y1, z3 - z1]
-		v2 = [x2 - x1, y2 - y1, z2 - z1]
-		cp = [v1[1] * v2[2] - v1[2] * v2[1],  v1[2] * v2[0] - v1[0] * v2[2],  v1[0] * v2[1] - v1[1] * v2[0]]
-		a, b, c = cp
-		d = a * x1 + b * y1 + c * z1
-		z = (d - a * x - b * y) / float(c)
-		return z
+	def getCommandHandlers(self):
+		# Handlers by command word ('G' or 'M' and the number without leading zeros), see digestLine()
+		return {
+			'G0' : self.processMoveCommand, # rapid move
+			'G1' : self.processMoveCommand, # move at feed rate
+			'G4' : self.processDwellCommand, # dwell
+			'G20' : self.processUnitsCommand, # units as inches
+			'G21' : self.processUnitsCommand, # units as mm
+			'G90' : self.processImpliedCommand, # absolute mode
+			'G94' : self.processImpliedCommand, # Feed rate units per minute mode
+			'M3' : self.processImpliedCommand, # spindle on
+			'M5' : self.processSpindleOffCommand, # spindle off
+		}
+
+	def splitWords(self, line):
+		# Returns the command words ('G' or 'M' and the number without leading zeros), the other words by letter
+		# and whether the whole line is made of words
+		text = line
+		if '(' in text or ';' in text :
+			text = self.commentRegex.sub('', text)
+		commands = []
+		words = {}
+		recognized = True
+		for (letter, value, other) in self.wordRegex.findall(text) :
+			if other :
+				recognized = False
+			elif letter == 'G' or letter == 'M' or letter == 'g' or letter == 'm' :
+				commands.append( letter.upper() + (value.lstrip('0') or '0') )
+			else :
+				words[letter.upper()] = value
+		return (commands, words, recognized)
+
+	def processUnitsCommand(self, command, words):
+		self.inputConversionFactor = 25.4 if command == 'G20' else 1.0
+		return []
+
+	def processImpliedCommand(self, command, words):
+		return []
+
+	def processSpindleOffCommand(self, command, words):
+		return ['^DF;!MC0;', 'H']
+
+	def processDwellCommand(self, command, words):
+		dwelltime = int(float(words.get('P', '0')))
+		return ['W {}'.format( dwelltime )]
 
-	def processMoveCommand(self, line):
-		#print(line)
+	def getSpeedCommand(self):
+		f = self.feedrate * self.inputConversionFactor * self.feedspeedfactor / 60.0 # convert to mm per second
+		if self.speedmode == '0' : f = self.RAPID_SPEED # fast mode
+		return 'V {0:.2f};F {0:.2f}'.format(f)
+
+	def processMoveCommand(self, command, words):
+		#print(command, words)
+		if not ('X' in words or 'Y' in words or 'Z' in words) :
+			return [] # in flatcam 2018, the feed rate is set in a move command
+		return self.processMove( command[1:], words.get('X'), words.get('Y'), words.get('Z') )
+
+	def processMove(self, speedmode, x, y, z):
+		# Move in speed mode '0' or '1' to the coordinates given as text, None for the axes that do not move
 		outputCommands = []
-		g = self.moveCommandParseRegex.match(line)
-		if self.speedmode != g.group(1) :
-			self.speedmode = g.group(1)
+		if self.stats != None : self.stats.counts['moves'] += 1
+		if self.speedmode != speedmode :
+			self.speedmode = speedmode
 			#print( 'speed changed: ' + self.speedmode )
-			f = self.feedrate * self.inputConversionFactor * self.feedspeedfactor / 60.0 # convert to mm per second
-			if self.speedmode == '0' : f = 16.0 # fast mode
-			outputCommands.append('V {0:.2f};F {0:.2f}'.format(f)) 
-		if g.group(3) != None : self.X = float(g.group(3)) * self.inputConversionFactor
-		if g.group(5) != None : self.Y = float(g.group(5)) * self.inputConversionFactor
-		if g.group(7) != None : self.Z = float(g.group(7)) * self.inputConversionFactor
-		#outputScale = 1 / 0.01
-		outputScale = 1 / 0.025
+			outputCommands.append(self.getSpeedCommand())
+		split = self.levelingTolerance != None and self.levelingHeightMap != None and speedmode == '1'
+		if split : start = (self.X, self.Y, self.Z)
+		factor = self.inputConversionFactor
+		if x != None : self.X = float(x) * factor
+		if y != None : self.Y = float(y) * factor
+		if z != None : self.Z = float(z) * factor
+
+		# Split the move where the leveling correction is not linear enough
+		if split :
+			end = (self.X, self.Y, self.Z)
+			outputScale = self.OUTPUT_SCALE
+			if self.stats != None : started = time.perf_counter()
+			splits = self.levelingHeightMap.getSplitParameters( start[0]*outputScale, start[1]*outputScale, end[0]*outputScale, end[1]*outputScale, self.levelingTolerance )
+			if self.stats != None :
+				self.stats.lap('leveling', started)
+				self.stats.counts['leveling splits'] += len(splits)
+			for t in splits :
+				(self.X, self.Y, self.Z) = ( start[0] + (end[0] - start[0]) * t, start[1] + (end[1] - start[1]) * t, start[2] + (end[2] - start[2]) * t )
+				outputCommands.extend( self.getMoveCommands() )
+			(self.X, self.Y, self.Z) = end
+
+		if len(outputCommands) == 0 :
+			return self.getMoveCommands()
+		outputCommands.extend( self.getMoveCommands() )
+		return outputCommands
+
+	def getMoveCommands(self):
+		# Commands moving to the current position, with leveling and backlash compensation
+		outputCommands = []
+		outputScale = self.OUTPUT_SCALE
+		stats = self.stats
+		if stats != None : started = time.perf_counter()
 
 		# Z height correction
 		z_correction = 0.0
-		if self.levelingData != None :
-			n = len( self.levelingData[0] )
+		if self.levelingHeightMap != None :
 			px = self.X*outputScale #+self.offset_x
 			py = self.Y*outputScale #+self.offset_y
-
-			# Find quadrant in which point lies
-			i = 0
-			j = 0
-			while i < (n-2) :
-				if px >= (self.levelingData[i][j][0]-self.epsilon) and px < self.levelingData[i+1][j][0] : break
-				i = i+1
-			while j < (n-2) :
-				if py >= (self.levelingData[i][j][1]-self.epsilon) and py < self.levelingData[i][j+1][1] : break
-				j = j+1
-
-			# interpolate values
-			
-			px0 = self.levelingData[i][j][0]
-			px1 = self.levelingData[i+1][j][0]
-			fx = (px - px0) / (px1 - px0)
-			h00 = self.levelingData[i][j][2]
-			h10 = self.levelingData[i+1][j][2]
-			h0 = h00 + (h10 - h00) * fx
-			h01 = self.levelingData[i][j+1][2]
-			h11 = self.levelingData[i+1][j+1][2]
-			h1 = h01 + (h11 - h01) * fx
-			py0 = self.levelingData[i][j][1]
-			py1 = self.levelingData[i][j+1][1]
-			fy = (py - py0) / (py1 - py0)
-			h = h0 + (h1 - h0) * fy
-			#print(px,py,i,j,fx,fy,self.Z,h,h/outputScale)
+			h = self.levelingHeightMap.getHeight(px, py)
+			#print(px,py,self.Z,h,h/outputScale)
 			z_correction = -h
 			# Apply compensation to Z
 			#self.Z = self.Z - h/outputScale
 
-		# Manual leveling points	
-		elif self.manualLevelingPoints != None :
-			if len(self.manualLevelingPoints) < 3 :
-				pass # At least 3 points required
-			else :
-				px = self.X*outputScale #+self.offset_x
-				py = self.Y*outputScale #+self.offset_y
-				h = self.getHeightFor3PointPlane( self.manualLevelingPoints[0], self.manualLevelingPoints[1], self.manualLevelingPoints[2], px, py )
-				z_correction = +h
-				pass
+		# Manual leveling points (at least 3 required)
+		elif self.levelingSurface != None :
+			px = self.X*outputScale #+self.offset_x
+			py = self.Y*outputScale #+self.offset_y
+			z_correction = +self.levelingSurface.getHeight(px, py)
+		if stats != None : started = stats.lap('leveling', started)
 
 		# Backlash handling in X
 		if abs(self.backlashX) > self.epsilon :
@@ -236,26 +377,2118 @@ class GCode2RmlConverter:
 				if deltaZ * self.last_displacement_z < 0 : # direction changed
 					# move to last position with offset in new move dir
 					self.backlash_compensation_z = 0.0 if deltaZ > 0 else -self.backlashZ
-					outputCommands.append('Z {:.0f},{:.0f},{:.0f}'.format(self.last_x*outputScale+self.offset_x+self.backlash_compensation_x,self.last_y*outputScale+self.offset_y+self.backlash_compensation_y,self.last_z*outputScale+self.backlash_compensation_+z_correction))
+					outputCommands.append('Z {:.0f},{:.0f},{:.0f}'.format(self.last_x*outputScale+self.offset_x+self.backlash_compensation_x,self.last_y*outputScale+self.offset_y+self.backlash_compensation_y,self.last_z*outputScale+self.backlash_compensation_z+z_correction))
 				self.last_displacement_z = deltaZ;
 
 		self.last_x = self.X		
 		self.last_y = self.Y
 		self.last_z = self.Z
+		if stats != None :
+			stats.counts['backlash corrections'] += len(outputCommands)
+			started = stats.lap('backlash', started)
 
 		# Send move command
 		outputCommands.append('Z {:.0f},{:.0f},{:.0f}'.format(self.X*outputScale+self.offset_x+self.backlash_compensation_x, self.Y*outputScale+self.offset_y+self.backlash_compensation_y, self.Z*outputScale+self.backlash_compensation_z+z_correction))
+		if stats != None : stats.lap('formatting', started)
 		return outputCommands
 
+	def convertText(self, text):
+		# Converts a block of complete lines, returns the RML commands as text (one command per line).
+		# Runs of move and feed rate lines go through the vectorized batch engine, everything else through digestLine().
+		pieces = []
+		if self.isFirstCommand and len(text) > 0 :
+			self.isFirstCommand = False
+			pieces.append('^DF\n') # set to defaults
+		if self.stats != None : self.stats.counts['lines'] += text.count('\n')
+
+		if not self.batchMode :
+			for line in text.split('\n')[:-1] :
+				for cmd in self.digestLine(line) :
+					pieces.append(cmd + '\n')
+			return ''.join(pieces)
+
+		encoded = text.encode('ascii','replace')
+		data = numpy.frombuffer( encoded, dtype=numpy.uint8 )
+		lineStarts = numpy.concatenate(( [0], numpy.flatnonzero(data == 10) + 1 ))
+		lineStarts = lineStarts[ lineStarts < len(data) ]
+		padded = numpy.concatenate(( data, numpy.zeros(3, dtype=numpy.uint8) ))
+		c0, c1, c2 = ( padded[lineStarts+k] for k in range(3) )
+		isBatchLine = ( (c0 == ord('G')) & (c1 == ord('0')) & ( (c2 == ord('0')) | (c2 == ord('1')) ) ) | (c0 == ord('F')) | (c0 == 10)
+
+		lineStarts = lineStarts.tolist() + [len(data)]
+		start = 0
+		for k in numpy.flatnonzero(~isBatchLine).tolist() + [len(lineStarts)-1] :
+			if k - start >= self.MIN_BATCH_LINES :
+				pieces.append( self.convertMoveText( text, encoded, lineStarts[start], lineStarts[k] ) )
+			else :
+				for line in text[lineStarts[start]:lineStarts[k]].split('\n')[:-1] :
+					for cmd in self.digestLine(line) :
+						pieces.append(cmd + '\n')
+			if k < len(lineStarts)-1 :
+				for cmd in self.digestLine( text[lineStarts[k]:lineStarts[k+1]] ) :
+					pieces.append(cmd + '\n')
+			start = k+1
+		return ''.join(pieces)
+
+	def convertMoveText(self, text, data, begin, end):
+		# Converts a run of move, feed rate and empty lines
+		stats = self.stats
+		if stats != None : started = time.perf_counter()
+		moves = self.parseMoveData( data[begin:end] )
+		if moves == None :
+			moves = self.parseMoveText( text[begin:end] )
+		if stats != None :
+			stats.lap('parsing', started)
+			if moves != None : stats.counts['batch lines'] += text.count('\n', begin, end)
+		if moves == None :
+			# Unexpected layout somewhere in the run, use the per-line path
+			return ''.join( cmd + '\n' for line in text[begin:end].split('\n') for cmd in self.digestLine(line) )
+		return self.convertMoves( *moves )
+
+	def parseMoveData(self, data):
+		# Vectorized parse of 'G0[01] X.. Y.. Z..', 'G01 F..' and 'F..' lines given as bytes, with the same results as digestLine().
+		# Returns per line: the mode ('0' or '1', 0 for feed rate lines) and the X,Y,Z,F values (NaN when not specified).
+		# Returns None when a line has a layout only the per-line parsers handle.
+		n = len(data)
+		codes = numpy.frombuffer(data, dtype=numpy.uint8)
+		classes = numpy.frombuffer(data.translate(self.CHARACTER_CLASSES), dtype=numpy.uint8)
+		if not classes.all() : return None
+
+		# Words are a letter followed by a run of numeric characters
+		wordPos = numpy.flatnonzero(classes == self.CHAR_LETTER)
+		numericPos = numpy.flatnonzero(classes >= self.CHAR_DOT)
+		if len(wordPos) == 0 or len(numericPos) == 0 :
+			return None if len(wordPos) + len(numericPos) > 0 else (codes[:0],) + tuple( numpy.zeros(0) for k in range(4) )
+		letters = codes[wordPos]
+		if not ( (letters == ord('G')) | (letters == ord('F')) | ( (letters >= ord('X')) & (letters <= ord('Z')) ) ).all() : return None
+		runBreaks = numpy.flatnonzero( numpy.diff(numericPos) != 1 ) + 1
+		runStart = numericPos[ numpy.concatenate(( [0], runBreaks )) ]
+		runEnd = numericPos[ numpy.concatenate(( runBreaks-1, [len(numericPos)-1] )) ] + 1
+		if len(runStart) != len(wordPos) or not (runStart-1 == wordPos).all() : return None
+		runLength = runEnd - runStart
+
+		# Each line starts with a G00/G01 word followed by a single space and the coordinates in X,Y,Z order,
+		# or is a 'G01 F..' or 'F..' line
+		lineStarts = numpy.flatnonzero(classes == self.CHAR_NEWLINE) + 1
+		lineStarts = numpy.concatenate(( [0], lineStarts[ lineStarts < n ] ))
+		if not ( (codes[lineStarts] == ord('G')) | (codes[lineStarts] == ord('F')) | (codes[lineStarts] == 10) ).all() : return None
+		isHead = (codes[wordPos-1] == 10) | (wordPos == 0)
+		isG = letters == ord('G')
+		if not (isHead == (isG | (isHead & (letters == ord('F'))))).all() : return None
+		gPos = wordPos[isG]
+		if len(gPos) > 0 :
+			if gPos[-1]+4 >= n : return None
+			if not ( (runLength[isG] == 2) & (codes[gPos+1] == ord('0')) & ( (codes[gPos+2] == ord('0')) | (codes[gPos+2] == ord('1')) ) ).all() : return None
+			if not ( ( (codes[gPos+3] == ord(' ')) | (codes[gPos+3] == ord('\t')) ) & (classes[gPos+4] == self.CHAR_LETTER) ).all() : return None
+		if ( ~isHead[1:] & ~isHead[:-1] & (letters[1:] <= letters[:-1]) ).any() : return None
+		isLast = numpy.append( isHead[1:], True ) # last word of its line
+		if not isLast[ isHead & (letters == ord('F')) ].all() : return None
+		fWord = numpy.flatnonzero( (letters == ord('F')) & ~isHead )
+		if not ( isLast[fWord] & isG[fWord-1] & (wordPos[fWord-1] == wordPos[fWord]-4) & (codes[wordPos[fWord]-1] == ord(' ')) & (codes[wordPos[fWord]-2] == ord('1')) ).all() : return None
+
+		# Numbers: optional sign, digits with at most one decimal point, ending with a digit
+		if not (classes[runEnd-1] == self.CHAR_DIGIT).all() : return None
+		hasSign = classes[runStart] == self.CHAR_SIGN
+		if numpy.count_nonzero(classes == self.CHAR_SIGN) != numpy.count_nonzero(hasSign) : return None
+		dotIndex = numpy.flatnonzero( classes[numericPos] == self.CHAR_DOT )
+		dotWord = numpy.repeat( numpy.arange(len(wordPos)), runLength )[dotIndex]
+		dotCount = numpy.bincount(dotWord, minlength=len(wordPos))
+		if dotCount.max() > 1 : return None
+		fractionDigits = numpy.zeros(len(wordPos), dtype=numpy.int64)
+		fractionDigits[dotWord] = runEnd[dotWord] - 1 - numericPos[dotIndex]
+		digitCount = runLength - dotCount - hasSign
+		if digitCount.max() > 15 : return None # mantissa must stay exact
+
+		# value = mantissa / 10^fraction_digits, which rounds exactly like float()
+		digits = codes[ classes == self.CHAR_DIGIT ] - ord('0')
+		digitWord = numpy.repeat( numpy.arange(len(wordPos)), digitCount )
+		exponent = (numpy.cumsum(digitCount) - 1)[digitWord] - numpy.arange(len(digits))
+		mantissa = numpy.bincount( digitWord, weights=digits * self.POW10[exponent], minlength=len(wordPos) )
+		values = mantissa / self.POW10[fractionDigits]
+		negative = codes[runStart] == ord('-')
+		values[negative] = -values[negative]
+
+		rows = numpy.cumsum(isHead) - 1
+		modes = numpy.where( isG, codes[wordPos+2], 0 )[isHead]
+		modes[ rows[fWord] ] = 0 # 'G01 F..' only sets the feed rate
+		axes = []
+		for letter in ('X','Y','Z','F') :
+			a = numpy.full(len(modes), math.nan)
+			isLetterWord = letters == ord(letter)
+			a[ rows[isLetterWord] ] = values[isLetterWord]
+			axes.append(a)
+		return (modes,) + tuple(axes)
+
+	def parseMoveText(self, text):
+		# Regex version of parseMoveData() for moves only, None if some line does not match
+		if self.feedLineRegex.search(text) != None : return None
+		moves = self.moveBatchParseRegex.findall(text)
+		if len(moves) != len([ line for line in text.split('\n') if len(line) > 0 ]) : return None
+		if len(moves) == 0 : return None
+		modes, xs, ys, zs = zip(*moves)
+		modes = numpy.frombuffer( ''.join(modes).encode('ascii'), dtype=numpy.uint8 )
+		return (modes,) + tuple( numpy.array([ float(v) if v else math.nan for v in values ]) for values in (xs, ys, zs) ) + (numpy.full(len(modes), math.nan),)
+
+	def convertMoves(self, modes, xs, ys, zs, feeds):
+		# Vectorized equivalent of digestLine() over a run of moves and feed rate changes (mode 0).
+		# Produces exactly the same commands as the per-line path.
+		isMove = modes != 0
+		feeds = self.fillForward(feeds, self.feedrate)
+		self.feedrate = feeds[-1].item() if len(feeds) > 0 else self.feedrate
+		if not isMove.all() :
+			(modes, xs, ys, zs, feeds) = (modes[isMove], xs[isMove], ys[isMove], zs[isMove], feeds[isMove])
+		n = len(modes)
+		if n == 0 : return ''
+		stats = self.stats
+		if stats != None :
+			stats.counts['moves'] += n
+			started = time.perf_counter()
+		X = self.getBatchAxis(xs, self.X)
+		Y = self.getBatchAxis(ys, self.Y)
+		Z = self.getBatchAxis(zs, self.Z)
+		outputScale = self.OUTPUT_SCALE
+		if stats != None : started = stats.lap('parsing', started)
+		if self.levelingTolerance != None and self.levelingHeightMap != None :
+			(modes, X, Y, Z, feeds) = self.getBatchSplitMoves(modes, X, Y, Z, feeds)
+			if stats != None :
+				stats.counts['leveling splits'] += len(modes) - n
+				started = stats.lap('leveling', started)
+			n = len(modes)
+
+		# Speed changes, inserted before the move
+		speedChanges = numpy.flatnonzero(modes[1:] != modes[:-1]) + 1
+		if self.speedmode != chr(modes[0]) :
+			speedChanges = numpy.concatenate(( [0], speedChanges ))
+		speedCommands = {}
+		speedChangeCommands = []
+		feedrate = self.feedrate
+		for k in speedChanges.tolist() :
+			self.speedmode = chr(modes[k])
+			self.feedrate = feeds[k].item()
+			if (self.speedmode, self.feedrate) not in speedCommands :
+				speedCommands[(self.speedmode, self.feedrate)] = self.getSpeedCommand() + '\n'
+			speedChangeCommands.append( speedCommands[(self.speedmode, self.feedrate)] )
+		self.feedrate = feedrate
+		if stats != None : started = stats.lap('formatting', started)
+
+		# Z height correction
+		z_correction = 0.0
+		if self.levelingHeightMap != None :
+			z_correction = -self.levelingHeightMap.getHeights(X*outputScale, Y*outputScale)
+		elif self.levelingSurface != None :
+			z_correction = self.levelingSurface.getHeights(X*outputScale, Y*outputScale)
+		z_correction = numpy.broadcast_to(z_correction, (n,))
+		if stats != None : started = stats.lap('leveling', started)
+
+		# Backlash handling, with the compensation in effect after each move
+		initialCompY = self.backlash_compensation_y
+		initialCompZ = self.backlash_compensation_z
+		(lastX, changedX, compX, self.last_displacement_x, self.backlash_compensation_x) = self.getBatchBacklash(X, self.last_x, self.last_displacement_x, self.backlash_compensation_x, self.backlashX)
+		(lastY, changedY, compY, self.last_displacement_y, self.backlash_compensation_y) = self.getBatchBacklash(Y, self.last_y, self.last_displacement_y, self.backlash_compensation_y, self.backlashY)
+		(lastZ, changedZ, compZ, self.last_displacement_z, self.backlash_compensation_z) = self.getBatchBacklash(Z, self.last_z, self.last_displacement_z, self.backlash_compensation_z, self.backlashZ)
+
+		self.X = self.last_x = X[-1].item()
+		self.Y = self.last_y = Y[-1].item()
+		self.Z = self.last_z = Z[-1].item()
+
+		# Output rows sorted by key, 4 per move: the backlash moves of the X, Y and Z axes, then the move itself
+		rowKeys = numpy.arange(3, 4*n, 4)
+		xs = X*outputScale+self.offset_x+compX
+		ys = Y*outputScale+self.offset_y+compY
+		zs = Z*outputScale+compZ+z_correction
+		if changedX.any() or changedY.any() or changedZ.any() :
+			prevCompY = numpy.concatenate(( [initialCompY], compY[:-1] ))
+			prevCompZ = numpy.concatenate(( [initialCompZ], compZ[:-1] ))
+			keys, backlashXs, backlashYs, backlashZs = [rowKeys], [xs], [ys], [zs]
+			for (axis, changed, cy, cz) in ( (0, changedX, prevCompY, prevCompZ), (1, changedY, compY, prevCompZ), (2, changedZ, compY, compZ) ) :
+				# move to last position with offset in new move dir
+				k = numpy.flatnonzero(changed)
+				keys.append( 4*k + axis )
+				backlashXs.append( lastX[k]*outputScale+self.offset_x+compX[k] )
+				backlashYs.append( lastY[k]*outputScale+self.offset_y+cy[k] )
+				backlashZs.append( lastZ[k]*outputScale+cz[k]+z_correction[k] )
+			order = numpy.argsort( numpy.concatenate(keys), kind='stable' )
+			rowKeys = numpy.concatenate(keys)[order]
+			xs = numpy.concatenate(backlashXs)[order]
+			ys = numpy.concatenate(backlashYs)[order]
+			zs = numpy.concatenate(backlashZs)[order]
+			if stats != None : stats.counts['backlash corrections'] += len(rowKeys) - n
+		if stats != None : started = stats.lap('backlash', started)
+
+		# Send move commands
+		(moveText, lineStarts) = self.formatMoveText(xs, ys, zs)
+		if stats != None : stats.lap('formatting', started)
+		if len(speedChangeCommands) == 0 :
+			return moveText
+		pieces = []
+		prev = 0
+		for (row, cmd) in zip( numpy.searchsorted(rowKeys, 4*speedChanges).tolist(), speedChangeCommands ) :
+			pieces.append( moveText[lineStarts[prev]:lineStarts[row]] )
+			pieces.append( cmd )
+			prev = row
+		pieces.append( moveText[lineStarts[prev]:] )
+		return ''.join(pieces)
+
+	def getBatchSplitMoves(self, modes, X, Y, Z, feeds):
+		# Splits the feed rate moves of a run like processMoveCommand() does, the added moves get the mode and feed rate of the move they split
+		outputScale = self.OUTPUT_SCALE
+		startX = numpy.concatenate(( [self.X], X[:-1] ))
+		startY = numpy.concatenate(( [self.Y], Y[:-1] ))
+		startZ = numpy.concatenate(( [self.Z], Z[:-1] ))
+		candidates = numpy.flatnonzero( (modes == ord('1')) & self.levelingHeightMap.getSplitCandidates( startX*outputScale, startY*outputScale, X*outputScale, Y*outputScale, self.levelingTolerance ) )
+		indices = []
+		splits = []
+		segments = numpy.stack(( startX[candidates], startY[candidates], X[candidates], Y[candidates] ), axis=-1) * outputScale
+		for (k, (px0, py0, px1, py1)) in zip( candidates.tolist(), segments.tolist() ) :
+			ts = self.levelingHeightMap.getSplitParameters( px0, py0, px1, py1, self.levelingTolerance )
+			indices.extend( [k] * len(ts) )
+			splits.extend(ts)
+		if len(indices) == 0 :
+			return (modes, X, Y, Z, feeds)
+		indices = numpy.array(indices, dtype=numpy.intp)
+		t = numpy.array(splits)
+		addedX = startX[indices] + (X[indices] - startX[indices]) * t
+		addedY = startY[indices] + (Y[indices] - startY[indices]) * t
+		addedZ = startZ[indices] + (Z[indices] - startZ[indices]) * t
+		return ( numpy.insert(modes, indices, modes[indices]), numpy.insert(X, indices, addedX), numpy.insert(Y, indices, addedY), numpy.insert(Z, indices, addedZ), numpy.insert(feeds, indices, feeds[indices]) )
+
+	def getBatchAxis(self, values, current):
+		# Axis positions for a run of moves, carrying the previous position where the axis is not specified
+		return self.fillForward( values * self.inputConversionFactor, current )
+
+	def fillForward(self, values, current):
+		# Replaces NaN values by the last value before them
+		missing = numpy.isnan(values)
+		if missing.any() :
+			idx = numpy.where(missing, 0, numpy.arange(1,len(values)+1))
+			numpy.maximum.accumulate(idx, out=idx)
+			values = numpy.concatenate(( [current], values ))[idx]
+		return values
+
+	def getBatchBacklash(self, positions, last, lastDisplacement, compensation, backlash):
+		# Returns the previous positions, the moves that change direction, the compensation after each move and the final axis state
+		n = len(positions)
+		previous = numpy.concatenate(( [last], positions[:-1] ))
+		if abs(backlash) <= self.epsilon :
+			return previous, numpy.zeros(n, dtype=bool), numpy.full(n, compensation), lastDisplacement, compensation
+		delta = positions - previous
+		moving = numpy.abs(delta) > self.epsilon # non-zero move in that axis
+		idx = numpy.where(moving, numpy.arange(1,n+1), 0)
+		numpy.maximum.accumulate(idx, out=idx)
+		displacements = numpy.concatenate(( [lastDisplacement], delta ))[idx] # last non-zero displacement after each move
+		changed = moving & ( delta * numpy.concatenate(( [lastDisplacement], displacements[:-1] )) < 0 ) # direction changed
+		idx = numpy.where(changed, numpy.arange(1,n+1), 0)
+		numpy.maximum.accumulate(idx, out=idx)
+		compensations = numpy.concatenate(( [compensation], numpy.where(delta > 0, 0.0, -backlash) ))[idx]
+		return previous, changed, compensations, displacements[-1].item(), compensations[-1].item()
+
+	def formatMoveText(self, xs, ys, zs):
+		# Vectorized 'Z {:.0f},{:.0f},{:.0f}' lines, returns the text and the offset of each line in it
+		n = len(xs)
+		fields = []
+		widths = numpy.full(n, 5) # 'Z ' + ',' + ',' + '\n'
+		for values in (xs, ys, zs) :
+			r = numpy.rint(values) # round half to even, like '{:.0f}'
+			negative = numpy.signbit(r) # also gives '-0'
+			magnitude = numpy.abs(r).astype(numpy.int64)
+			digits = numpy.ones(n, dtype=numpy.int64)
+			for k in range(1,19) :
+				more = magnitude >= 10**k
+				if not more.any() : break
+				digits += more
+			fields.append( (negative, magnitude, digits) )
+			widths += digits + negative
+
+		ends = numpy.cumsum(widths)
+		lineStarts = ends - widths
+		out = numpy.empty(ends[-1], dtype=numpy.uint8)
+		out[lineStarts] = ord('Z')
+		out[lineStarts+1] = ord(' ')
+		pos = lineStarts + 2
+		for (f, (negative, magnitude, digits)) in enumerate(fields) :
+			out[pos[negative]] = ord('-')
+			fieldEnd = pos + negative + digits
+			for k in range(digits.max()) : # least significant digit first
+				m = digits > k
+				out[fieldEnd[m]-1-k] = ord('0') + magnitude[m] % 10
+				magnitude = magnitude // 10
+			out[fieldEnd] = ord(',') if f < 2 else ord('\n')
+			pos = fieldEnd + 1
+		return (out.tobytes().decode('ascii'), lineStarts.tolist() + [len(out)])
+
 	def convertFile(self,infile,outfile):
 		# TODO: Handle XY offsets
-		inputdata = open(infile)
-		outdata = self.digestStream(inputdata)
-		outfile = open(outfile,'w')
-		for cmd in outdata :
-			outfile.write(cmd)
-			outfile.write('\n')
-			#print(cmd)
+		# Streams the conversion: blocks of lines are converted and written while the input is still being read
+		# (toolpath optimization and simplification need the whole job first)
+		stats = self.stats
+		if stats != None : started = converting = time.perf_counter()
+		with open(infile) as inputdata, open(outfile,'w',buffering=self.OUTPUT_BUFFER_SIZE) as outdata :
+			simplifier = None
+			lines = None
+			if self.optimizeToolpaths or self.simplifyTolerance != None :
+				lines = inputdata.read().splitlines()
+				if self.optimizeToolpaths :
+					lines = ToolpathOptimizer(self, self.reversePaths).optimize(lines)
+					if stats != None : started = stats.lap('optimization', started)
+				if self.simplifyTolerance != None :
+					simplifier = PolylineSimplifier(self, self.simplifyTolerance)
+					(original, lines) = ( lines, simplifier.simplify(lines) )
+					sizeBefore = self.getOutputSize(original)
+					if stats != None : started = stats.lap('simplification', started)
+			# Split moves (levelingTolerance) leave intermediate positions that getChunkState() does not reconstruct
+			if self.parallelJobs != None and self.parallelJobs > 1 and self.levelingTolerance == None :
+				blocks = self.iterateParallelText( inputdata.read() if lines == None else '\n'.join(lines) + '\n' )
+			elif lines != None :
+				blocks = self.iterateStreamText(lines)
+			else :
+				blocks = ( self.convertText(block) for block in self.iterateTextBlocks(inputdata) )
+			if self.packLength != None :
+				blocks = self.iteratePackedText(blocks)
+			size = 0
+			for text in blocks :
+				outdata.write(text)
+				size += len(text)
+			if stats != None :
+				stats.counts['output bytes'] += size
+				stats.lap('total', converting)
+			if simplifier != None :
+				print('Simplification: removed {} of {} cutting moves, output {} -> {} bytes'.format( simplifier.removedCount, simplifier.moveCount, sizeBefore, size ) )
+
+	def getOutputSize(self, lines):
+		# Size of the RML output for the lines, from a copy of the converter in its current state
+		converter = copy.copy(self)
+		converter.commandHandlers = converter.getCommandHandlers()
+		converter.stats = None
+		with contextlib.redirect_stdout( io.StringIO() ) : # unrecognized commands are already reported once
+			blocks = converter.iterateStreamText(lines)
+			if self.packLength != None :
+				blocks = self.iteratePackedText(blocks)
+			return sum( len(text) for text in blocks )
+
+	def iteratePackedText(self, blocks):
+		# RML text with the commands packed, see RmlCommandPacker
+		packer = RmlCommandPacker(self.packLength)
+		for text in blocks :
+			yield packer.pack(text)
+		yield packer.flush()
+
+	def getModalState(self):
+		# Values carried from one line to the next, see iterateParallelText()
+		return dict( (name, getattr(self, name)) for name in self.MODAL_STATE )
+
+	def iterateParallelText(self, text):
+		# Converts the text in chunks on parallelJobs processes, with the same output as convertText(text).
+		# The modal state at the start of each chunk comes from getChunkState().
+		if len(text) > 0 and not text.endswith('\n') : text += '\n'
+		chunkSize = max( self.PARALLEL_CHUNK_SIZE, len(text) // (4 * self.parallelJobs) + 1 )
+		bounds = [0]
+		while bounds[-1] < len(text) :
+			end = text.find('\n', bounds[-1] + chunkSize)
+			bounds.append( len(text) if end < 0 else end + 1 )
+		if len(bounds) <= 2 :
+			yield self.convertText(text)
+			return
+
+		unitChanges = self.getUnitChanges(text)
+		tasks = []
+		for k in range(len(bounds)-1) :
+			converter = copy.copy(self)
+			converter.commandHandlers = None # rebuilt by the worker
+			converter.stats = None if self.stats == None else ConversionStats()
+			if k > 0 :
+				for (name, value) in self.getChunkState(text, bounds[k], unitChanges).items() :
+					setattr(converter, name, value)
+			tasks.append( (converter, text[bounds[k]:bounds[k+1]]) )
+		with multiprocessing.Pool(self.parallelJobs) as pool :
+			for (output, state, stats) in pool.imap(GCode2RmlConverter.convertChunk, tasks) :
+				if stats != None : self.stats.merge(stats)
+				yield output
+		for (name, value) in state.items() :
+			setattr(self, name, value)
+
+	def convertFiles(self, files, jobs=1):
+		# Converts several files (infile, outfile) with the same settings, on jobs processes.
+		# Yields a result per file, in order: see convertBatchFile().
+		tasks = []
+		for (infile, outfile) in files :
+			converter = copy.copy(self)
+			converter.commandHandlers = None # rebuilt by the worker
+			converter.parallelJobs = None # workers cannot start processes
+			converter.stats = None if self.stats == None else ConversionStats()
+			tasks.append( (converter, infile, outfile) )
+		if jobs > 1 and len(tasks) > 1 :
+			with multiprocessing.Pool( min(jobs, len(tasks)) ) as pool :
+				for result in pool.imap(GCode2RmlConverter.convertBatchFile, tasks) :
+					yield result
+		else :
+			for task in tasks :
+				yield GCode2RmlConverter.convertBatchFile(task)
+
+	@staticmethod
+	def convertBatchFile(task):
+		# Worker of convertFiles(), returns the file names, conversion time, sizes, printed messages and statistics
+		(converter, infile, outfile) = task
+		converter.commandHandlers = converter.getCommandHandlers()
+		messages = io.StringIO()
+		started = time.perf_counter()
+		with contextlib.redirect_stdout(messages) :
+			converter.convertFile(infile, outfile)
+		return { 'infile' : infile, 'outfile' : outfile, 'seconds' : time.perf_counter() - started, 'inputBytes' : os.path.getsize(infile),
+			'outputBytes' : os.path.getsize(outfile), 'messages' : messages.getvalue(), 'stats' : converter.stats }
+
+	@staticmethod
+	def convertChunk(task):
+		# Worker of iterateParallelText(), returns the RML text, the modal state at the end of the chunk and the statistics
+		(converter, text) = task
+		converter.commandHandlers = converter.getCommandHandlers()
+		return ( converter.convertText(text), converter.getModalState(), converter.stats )
+
+	def getUnitChanges(self, text):
+		# Start offsets of the lines with a G20/G21 command and the units after them
+		changes = []
+		for match in self.unitsRegex.finditer(text) :
+			start = text.rfind('\n', 0, match.start()) + 1
+			end = text.find('\n', match.start())
+			(commands, words, recognized) = self.splitWords( text[start:end] )
+			for command in commands :
+				if command == 'G20' or command == 'G21' :
+					if len(changes) > 0 and changes[-1][0] == start : changes.pop()
+					changes.append( (start, 25.4 if command == 'G20' else 1.0) )
+		return changes
+
+	def getLastWord(self, text, bound, letter, isMove=False):
+		# Value and line start of the last word with that letter before bound (on a G0/G1 line with isMove), None if there is none
+		end = bound
+		while end > 0 :
+			position = max( text.rfind(letter, 0, end), text.rfind(letter.lower(), 0, end) )
+			if position < 0 : break
+			start = text.rfind('\n', 0, position) + 1
+			(commands, words, recognized) = self.splitWords( text[start:text.find('\n', position)] )
+			if letter in words and ( not isMove or 'G0' in commands or 'G1' in commands ) :
+				return (words[letter], start)
+			end = start # in a comment or another command
+		return None
+
+	def getChunkState(self, text, bound, unitChanges):
+		# Modal state after converting text[:bound] from the current state, found by reading the lines backwards from bound
+		# until the speed mode and backlash state of each axis are known. The feed rate and the remaining positions are found by
+		# searching for their letter.
+		state = self.getModalState()
+		state['isFirstCommand'] = False
+		k = bisect.bisect_left( unitChanges, (bound,) ) - 1
+		state['inputConversionFactor'] = unitChanges[k][1] if k >= 0 else self.inputConversionFactor
+
+		axes = ('X','Y','Z')
+		backlash = dict( zip( axes, ( abs(b) > self.epsilon for b in (self.backlashX, self.backlashY, self.backlashZ) ) ) )
+		positions = {} # axis -> position at bound
+		later = {} # axis -> position after the move being read
+		displacements = {} # axis -> last displacement at bound
+		flipped = {} # axis -> direction of the last direction change, once found
+		speedmode = None
+		end = bound
+		while end > 0 :
+			start = text.rfind('\n', 0, end-1) + 1
+			(commands, words, recognized) = self.splitWords( text[start:end] )
+			end = start
+			if not ('X' in words or 'Y' in words or 'Z' in words) : continue
+			moves = [ c for c in commands if c == 'G0' or c == 'G1' ]
+			if len(moves) == 0 : continue
+			if speedmode == None : speedmode = moves[-1][1:]
+			k = bisect.bisect_right( unitChanges, (start, math.inf) ) - 1
+			units = unitChanges[k][1] if k >= 0 else self.inputConversionFactor
+			for axis in axes :
+				if axis not in words : continue
+				position = float(words[axis]) * units
+				if axis not in positions : positions[axis] = position
+				if backlash[axis] and axis in later and axis not in flipped :
+					delta = later[axis] - position
+					if abs(delta) > self.epsilon :
+						if axis not in displacements :
+							displacements[axis] = delta
+						elif delta * displacements[axis] < 0 :
+							flipped[axis] = displacements[axis]
+				later[axis] = position
+			if speedmode != None and all( a in flipped or not backlash[a] for a in axes ) :
+				break
+
+		# The first moves of the text start from the current state
+		lastPositions = { 'X':self.last_x, 'Y':self.last_y, 'Z':self.last_z }
+		lastDisplacements = { 'X':self.last_displacement_x, 'Y':self.last_displacement_y, 'Z':self.last_displacement_z }
+		for (axis, b) in zip( axes, (self.backlashX, self.backlashY, self.backlashZ) ) :
+			if backlash[axis] and axis in later and axis not in flipped :
+				delta = later[axis] - lastPositions[axis]
+				if abs(delta) > self.epsilon :
+					if axis not in displacements :
+						displacements[axis] = delta
+					elif delta * displacements[axis] < 0 :
+						flipped[axis] = displacements[axis]
+				if axis in displacements and axis not in flipped and lastDisplacements[axis] * displacements[axis] < 0 :
+					flipped[axis] = displacements[axis]
+			name = axis.lower()
+			if axis not in positions and end > 0 :
+				word = self.getLastWord(text, end, axis, True)
+				if word != None :
+					k = bisect.bisect_right( unitChanges, (word[1], math.inf) ) - 1
+					positions[axis] = float(word[0]) * ( unitChanges[k][1] if k >= 0 else self.inputConversionFactor )
+			if axis in positions :
+				state[axis] = state['last_'+name] = positions[axis]
+			if axis in displacements :
+				state['last_displacement_'+name] = displacements[axis]
+			if axis in flipped :
+				state['backlash_compensation_'+name] = 0.0 if flipped[axis] > 0 else -b
+		word = self.getLastWord(text, bound, 'F')
+		if word != None : state['feedrate'] = float(word[0])
+		if speedmode != None : state['speedmode'] = speedmode
+		return state
+
+	def iterateTextBlocks(self, inputdata):
+		# Reads a text stream in blocks of about INPUT_CHUNK_SIZE characters that end on line boundaries
+		remainder = ''
+		while True :
+			data = inputdata.read(self.INPUT_CHUNK_SIZE)
+			if len(data) == 0 : break
+			data = remainder + data
+			end = data.rfind('\n') + 1
+			remainder = data[end:]
+			if end > 0 : yield data[:end]
+		if len(remainder) > 0 :
+			yield remainder + '\n'
+
+
+##################################################
+
+
+class ConversionStats:
+	# Counters and stage timers of GCode2RmlConverter conversions (set converter.stats to collect them).
+	# Times are in seconds per stage: parsing, leveling, backlash and formatting, plus optimization, simplification and total
+	# for convertFile(). Unrecognized lines are grouped by their first unknown command, or word letter.
+
+	STAGES = ( 'parsing', 'leveling', 'backlash', 'formatting', 'optimization', 'simplification' )
+
+	def __init__(self):
+		self.counts = collections.Counter()
+		self.times = collections.Counter()
+		self.unrecognized = collections.Counter()
+
+	def lap(self, stage, started):
+		# Adds the time since started to the stage, returns the current time for the next stage
+		now = time.perf_counter()
+		self.times[stage] += now - started
+		return now
+
+	def addUnrecognized(self, line, commands, words, commandHandlers):
+		unknown = [ command for command in commands if command not in commandHandlers ]
+		if len(unknown) > 0 :
+			kind = unknown[0]
+		elif len(commands) == 0 and len(words) > 0 :
+			kind = sorted(words)[0] + ' word'
+		else :
+			kind = 'syntax'
+		self.unrecognized[kind] += 1
+
+	def merge(self, other):
+		self.counts.update(other.counts)
+		self.times.update(other.times)
+		self.unrecognized.update(other.unrecognized)
+
+	def getReport(self):
+		return { 'counts' : dict(self.counts), 'times' : dict(self.times), 'unrecognized' : dict(self.unrecognized) }
+
+	def writeJson(self, filename):
+		with open(filename, 'w') as f :
+			json.dump( self.getReport(), f, indent=1, sort_keys=True )
+
+	def printReport(self):
+		print('Conversion statistics:')
+		for name in ( 'lines', 'batch lines', 'moves', 'leveling splits', 'backlash corrections', 'output bytes' ) :
+			print('  {:<24}{:>12}'.format( name, self.counts[name] ))
+		total = self.times['total']
+		for stage in self.STAGES :
+			if stage in self.times :
+				print('  {:<24}{:>12.3f} s{:>6.0f}%'.format( stage + ' time', self.times[stage], 100.0 * self.times[stage] / total if total > 0 else 0 ))
+		if total > 0 :
+			print('  {:<24}{:>12.3f} s'.format( 'total time', total ))
+		count = sum( self.unrecognized.values() )
+		print('  {:<24}{:>12}'.format( 'unrecognized lines', count ))
+		for (kind, n) in self.unrecognized.most_common() :
+			print('    {:<22}{:>12}'.format( kind, n ))
+
+
+##################################################
+
+
+class RmlCommandPacker:
+	# Packs consecutive 'Z x,y,z' commands into multi-point 'Z x1,y1,z1,x2,y2,z2,...' commands of at most maxLength characters,
+	# and drops 'V'/'F' settings equal to the ones in effect ('^' commands like ^DF reset them).
+	# Commands are given and returned as text, one per line, the last Z command is held until the next text or flush().
+
+	def __init__(self, maxLength):
+		self.maxLength = maxLength
+		self.pending = None # Z command being built
+		self.speedCommand = None # V/F in effect
+
+	def pack(self, text):
+		output = []
+		pending = self.pending
+		for cmd in text.split('\n')[:-1] :
+			if cmd.startswith('Z ') :
+				if pending == None :
+					pending = cmd
+				elif len(pending) + len(cmd) - 1 <= self.maxLength :
+					pending += ',' + cmd[2:]
+				else :
+					output.append(pending)
+					pending = cmd
+				continue
+			if cmd.startswith('V ') :
+				if cmd == self.speedCommand : continue # same speed, the Z command can go on
+				self.speedCommand = cmd
+			elif cmd.startswith('^') :
+				self.speedCommand = None
+			if pending != None :
+				output.append(pending)
+				pending = None
+			output.append(cmd)
+		self.pending = pending
+		output.append('')
+		return '\n'.join(output)
+
+	def flush(self):
+		pending = self.pending
+		self.pending = None
+		return '' if pending == None else pending + '\n'
+
+
+##################################################
+
+
+class RmlJobSimulator:
+	# Estimates the machining time of RML-1 commands as produced by GCode2RmlConverter, without running the machine.
+	# Moves ('Z' commands, absolute, in steps) run at the 'F' speed in XY and the 'V' speed in Z, limited to the machine
+	# maximum, taking the time of the slowest of the two (no acceleration). 'W' dwells are in milliseconds and 'H' is a
+	# rapid move to the XY origin. A move is rapid when its speed is the converter's RAPID_SPEED or more.
+	# Each spindle stop ('!MC0') ends a tool: the times are reported per tool and for the whole job.
+
+	MAX_SPEED = GCode2RmlConverter.MAX_SPEED
+	DEFAULT_SPEED = GCode2RmlConverter.RAPID_SPEED # speed before any V/F command, and after ^DF
+	STEPS_PER_MM = GCode2RmlConverter.OUTPUT_SCALE
+	REPORT_FIELDS = ( 'cutTime', 'rapidTime', 'dwellTime', 'totalTime', 'cutDistance', 'rapidDistance', 'xTravel', 'yTravel', 'zTravel', 'plunges', 'moves' )
+
+	# Character classes for parseNumbers()
+	(CHAR_DIGIT, CHAR_DOT, CHAR_SIGN) = (1, 2, 3)
+	NUMBER_CLASSES = bytearray(256)
+	for c in b'0123456789' : NUMBER_CLASSES[c] = CHAR_DIGIT
+	NUMBER_CLASSES[ord('.')] = CHAR_DOT
+	NUMBER_CLASSES[ord('-')] = NUMBER_CLASSES[ord('+')] = CHAR_SIGN
+	NUMBER_CLASSES = bytes(NUMBER_CLASSES)
+
+	def __init__(self, rapidSpeed=GCode2RmlConverter.RAPID_SPEED):
+		self.rapidSpeed = rapidSpeed
+
+	def simulateFile(self, filename):
+		with open(filename) as f :
+			return self.simulateText( f.read() )
+
+	def simulateText(self, text):
+		# Returns { 'tools' : [ report per tool ], 'total' : report } with the REPORT_FIELDS (seconds, mm and counts)
+		data = text.encode('ascii','replace')
+		codes = numpy.frombuffer(data, dtype=numpy.uint8)
+		isSeparator = (codes == ord('\n')) | (codes == ord(';')) | (codes == ord('\r'))
+		cmdStarts = numpy.flatnonzero( ~isSeparator & numpy.concatenate(( [True], isSeparator[:-1] )) )
+		letters = codes[cmdStarts]
+
+		# Numbers, and the command they belong to
+		(numberStarts, values) = self.parseNumbers(data, codes)
+		isCmdStart = numpy.zeros(len(codes), dtype=numpy.int32)
+		isCmdStart[cmdStarts] = 1
+		numberCmds = numpy.cumsum(isCmdStart, dtype=numpy.int32)[numberStarts] - 1
+		numberLetters = letters[numberCmds]
+
+		# Points: the coordinates of the Z commands, and the origin at the current height for H
+		isCoordinate = numberLetters == ord('Z')
+		coordinates = values[isCoordinate]
+		if len(coordinates) % 3 != 0 or ( numpy.bincount(numberCmds[isCoordinate]) % 3 != 0 ).any() :
+			raise ValueError('Z command without 3 coordinates per point')
+		homeCmds = numpy.flatnonzero(letters == ord('H'))
+		pointCmds = numpy.concatenate(( numberCmds[isCoordinate][::3], homeCmds ))
+		points = numpy.concatenate(( coordinates.reshape(-1,3), numpy.zeros((len(homeCmds),3)) ))
+		points[len(points)-len(homeCmds):,2] = math.nan
+		order = numpy.argsort(pointCmds, kind='stable')
+		(pointCmds, points) = ( pointCmds[order], points[order] / self.STEPS_PER_MM )
+		keepZ = numpy.isnan(points[:,2])
+		if keepZ.any() :
+			index = numpy.where( keepZ, 0, numpy.arange(len(points)) )
+			points[:,2] = numpy.concatenate(( [0.0], points[:,2] ))[ numpy.maximum.accumulate(index + ~keepZ) ]
+
+		# Speeds in effect for each point
+		resetCmds = numpy.flatnonzero(letters == ord('^'))
+		(xySpeeds, zSpeeds) = ( self.getSpeeds(letter, letters, numberCmds, numberLetters, values, resetCmds, pointCmds) for letter in ('F','V') )
+		isRapid = xySpeeds >= self.rapidSpeed
+
+		# Moves from the previous point (the first one from the origin)
+		deltas = numpy.abs( numpy.diff( points, axis=0, prepend=numpy.zeros((1,3)) ) )
+		xyDistances = numpy.hypot(deltas[:,0], deltas[:,1])
+		times = numpy.maximum( xyDistances / numpy.minimum(xySpeeds, self.MAX_SPEED), deltas[:,2] / numpy.minimum(zSpeeds, self.MAX_SPEED) )
+		isPlunge = (xyDistances == 0) & ( numpy.diff( points[:,2], prepend=0.0 ) < 0 )
+		isPlunge[1:] &= ~isPlunge[:-1] # consecutive descents are one plunge
+
+		# A tool ends at a spindle stop ('^DF;!MC0'). The next one starts with the next cutting move, or the first move
+		# of the next job (a '^DF' on its own), retracts and H stay with the previous tool.
+		stopCmds = numpy.array( [ k for k in numpy.flatnonzero(letters == ord('!')).tolist() if data.startswith(b'!MC0', cmdStarts[k]) ], dtype=numpy.int64 )
+		jobCmds = numpy.array( [ k for k in numpy.flatnonzero(letters == ord('^')).tolist() if data.startswith(b'^DF', cmdStarts[k]) and k+1 not in stopCmds ], dtype=numpy.int64 )
+		cutPoints = numpy.append( numpy.flatnonzero(~isRapid), len(points) )
+		nextCuts = cutPoints[ numpy.searchsorted( pointCmds[cutPoints[:-1]], stopCmds, 'right' ) ]
+		nextJobs = numpy.append( jobCmds, len(letters) )[ numpy.searchsorted(jobCmds, stopCmds, 'right') ]
+		toolStarts = numpy.minimum( nextCuts, numpy.searchsorted(pointCmds, nextJobs, 'right') )
+		toolStarts = numpy.unique( toolStarts[ toolStarts < len(points) ] )
+		toolCount = len(toolStarts) + 1
+		pointTools = numpy.searchsorted( toolStarts, numpy.arange(len(points)), 'right' )
+		isDwell = numberLetters == ord('W')
+		dwellTools = numpy.searchsorted( pointCmds[toolStarts], numberCmds[isDwell], 'right' )
+
+		def sums(tools, weights=None):
+			return numpy.bincount(tools, weights=weights, minlength=toolCount)
+		columns = {
+			'cutTime' : sums(pointTools, numpy.where(isRapid, 0.0, times)),
+			'rapidTime' : sums(pointTools, numpy.where(isRapid, times, 0.0)),
+			'dwellTime' : sums(dwellTools, values[isDwell] / 1000.0),
+			'cutDistance' : sums(pointTools, numpy.where(isRapid, 0.0, numpy.hypot(xyDistances, deltas[:,2]))),
+			'rapidDistance' : sums(pointTools, numpy.where(isRapid, numpy.hypot(xyDistances, deltas[:,2]), 0.0)),
+			'xTravel' : sums(pointTools, deltas[:,0]),
+			'yTravel' : sums(pointTools, deltas[:,1]),
+			'zTravel' : sums(pointTools, deltas[:,2]),
+			'plunges' : sums(pointTools[isPlunge]),
+			'moves' : sums(pointTools),
+		}
+		columns['totalTime'] = columns['cutTime'] + columns['rapidTime'] + columns['dwellTime']
+		tools = [ dict( (name, columns[name][k].item()) for name in self.REPORT_FIELDS ) for k in range(toolCount) ]
+		total = dict( (name, columns[name].sum().item()) for name in self.REPORT_FIELDS )
+		return { 'tools' : tools, 'total' : total }
+
+	def parseNumbers(self, data, codes):
+		# Start offsets and values of the numbers (sign, digits and decimal point) in the text
+		classes = numpy.frombuffer(data.translate(self.NUMBER_CLASSES), dtype=numpy.uint8)
+		edges = numpy.flatnonzero( numpy.diff( (classes != 0).view(numpy.int8), prepend=0, append=0 ) )
+		(starts, ends) = ( edges[0::2], edges[1::2] )
+
+		# value = mantissa / 10^fraction_digits, as in GCode2RmlConverter.parseMoveData()
+		digitPos = numpy.flatnonzero(classes == self.CHAR_DIGIT)
+		digitRuns = numpy.searchsorted(starts, digitPos, 'right') - 1
+		digitCount = numpy.bincount(digitRuns, minlength=len(starts))
+		if len(starts) > 0 and digitCount.max() >= len(GCode2RmlConverter.POW10) :
+			raise ValueError('Number too long in RML commands')
+		exponent = (numpy.cumsum(digitCount) - 1)[digitRuns] - numpy.arange(len(digitPos))
+		mantissa = numpy.bincount( digitRuns, weights=(codes[digitPos] - ord('0')) * GCode2RmlConverter.POW10[exponent], minlength=len(starts) )
+		dotPos = numpy.flatnonzero(classes == self.CHAR_DOT)
+		dotRuns = numpy.searchsorted(starts, dotPos, 'right') - 1
+		fractionDigits = numpy.zeros(len(starts), dtype=numpy.int64)
+		fractionDigits[dotRuns] = ends[dotRuns] - 1 - dotPos
+		values = mantissa / GCode2RmlConverter.POW10[fractionDigits]
+		values[ codes[starts] == ord('-') ] *= -1.0
+		return (starts, values)
+
+	def getSpeeds(self, letter, letters, numberCmds, numberLetters, values, resetCmds, pointCmds):
+		# Speed set by the last 'letter' command (or reset by ^DF) before each point
+		isSpeed = numberLetters == ord(letter)
+		speedCmds = numpy.concatenate(( numberCmds[isSpeed], resetCmds ))
+		speeds = numpy.concatenate(( values[isSpeed], numpy.full(len(resetCmds), self.DEFAULT_SPEED) ))
+		order = numpy.argsort(speedCmds, kind='stable')
+		index = numpy.searchsorted(speedCmds[order], pointCmds, 'right') - 1
+		return numpy.where( index >= 0, numpy.concatenate(( speeds[order], [self.DEFAULT_SPEED] ))[index], self.DEFAULT_SPEED )
+
+	def printReport(self, report):
+		def formatTime(seconds):
+			return '{}:{:02d}:{:02d}'.format( int(seconds) // 3600, int(seconds) // 60 % 60, int(seconds) % 60 )
+		rows = [ ('tool {}'.format(k+1), tool) for (k, tool) in enumerate(report['tools']) ] if len(report['tools']) > 1 else []
+		for (name, r) in rows + [ ('total', report['total']) ] :
+			print( '{:<8} cut {} ({:.0f} mm)  rapid {} ({:.0f} mm)  dwell {}  total {}  plunges {}'.format( name,
+				formatTime(r['cutTime']), r['cutDistance'], formatTime(r['rapidTime']), r['rapidDistance'], formatTime(r['dwellTime']),
+				formatTime(r['totalTime']), int(r['plunges']) ) )
+
+
+##################################################
+
+
+class LevelingHeightMap:
+	# Height map compiled from the autoleveling grid (levelingData[i][j] = (x,y,height) in machine steps, i along X, j along Y).
+	# The cell of a point is found in constant time from the grid spacing, and the interpolation terms of each cell
+	# are stored, so the cost of a lookup does not depend on the grid resolution.
+	# The grid lines may also be unevenly spaced (see ProbePlanner): the cells are then found by binary search.
+
+	def __init__(self, levelingData):
+		grid = numpy.array(levelingData, dtype=numpy.float64)
+		# Cells are indexed along increasing coordinates
+		if grid[-1,0,0] < grid[0,0,0] : grid = grid[::-1,:,:]
+		if grid[0,-1,1] < grid[0,0,1] : grid = grid[:,::-1,:]
+		self.nx = grid.shape[0]
+		self.ny = grid.shape[1]
+		self.xs = grid[:,0,0].copy()
+		self.ys = grid[0,:,1].copy()
+		self.x_spacing = self.getSpacing(self.xs)
+		self.y_spacing = self.getSpacing(self.ys)
+
+		# Per cell: x0, width, y0, height, h00, h10-h00, h01, h11-h01
+		x0 = grid[:-1,:-1,0]
+		y0 = grid[:-1,:-1,1]
+		h00 = grid[:-1,:-1,2]
+		h01 = grid[:-1,1:,2]
+		self.cells = numpy.stack( ( x0, grid[1:,:-1,0] - x0, y0, grid[:-1,1:,1] - y0, h00, grid[1:,:-1,2] - h00, h01, grid[1:,1:,2] - h01 ), axis=-1 ).reshape(-1, 8)
+		self.cellList = self.cells.tolist()
+		self.xList = self.xs.tolist()
+		self.yList = self.ys.tolist()
+
+		# Grid lines and the lines halfway between them, where segments get split (see getSplitParameters)
+		self.splitXs = numpy.sort( numpy.concatenate(( self.xs, (self.xs[1:] + self.xs[:-1]) / 2 )) )
+		self.splitYs = numpy.sort( numpy.concatenate(( self.ys, (self.ys[1:] + self.ys[:-1]) / 2 )) )
+		self.splitXList = self.splitXs.tolist()
+		self.splitYList = self.splitYs.tolist()
+
+	def getSpacing(self, axis):
+		# Grid spacing, None when the lines are not evenly spaced
+		spacing = ( (axis[-1] - axis[0]) / (len(axis)-1) ) or 1.0
+		if len(axis) > 2 and numpy.abs( numpy.diff(axis) - spacing ).max() > 1e-6 * abs(spacing) :
+			return None
+		return spacing
+
+	def getCellIndex(self, p, axis, spacing):
+		# Cell i with axis[i] <= p < axis[i+1], the first or last cell for points outside of the grid
+		last = len(axis)-2
+		if spacing == None :
+			return min( max( bisect.bisect_right(axis, p) - 1, 0 ), last )
+		i = min( max( int( math.floor( (p - axis[0]) / spacing ) ), 0 ), last )
+		if i > 0 and axis[i] > p : i -= 1
+		elif i < last and axis[i+1] <= p : i += 1
+		return i
+
+	def getCellIndices(self, p, axis, spacing):
+		# Array version of getCellIndex()
+		last = len(axis)-2
+		if spacing == None :
+			return numpy.clip( numpy.searchsorted(axis, p, 'right') - 1, 0, last )
+		i = numpy.clip( numpy.floor( (p - axis[0]) / spacing ), 0, last ).astype(numpy.intp)
+		i -= (i > 0) & (axis[i] > p)
+		i += (i < last) & (axis[i+1] <= p)
+		return i
+
+	def getHeight(self, px, py):
+		i = self.getCellIndex(px, self.xList, self.x_spacing)
+		j = self.getCellIndex(py, self.yList, self.y_spacing)
+		(x0, width, y0, height, h00, dh0, h01, dh1) = self.cellList[ i*(self.ny-1) + j ]
+		fx = (px - x0) / width
+		h0 = h00 + dh0 * fx
+		h1 = h01 + dh1 * fx
+		fy = (py - y0) / height
+		return h0 + (h1 - h0) * fy
+
+	def getSplitParameters(self, px0, py0, px1, py1, tolerance):
+		# Positions (0..1) along the segment where it must be split so that the heights along each piece stay within
+		# tolerance of a straight line. Heights are sampled where the segment crosses the split lines and halfway between
+		# these crossings, the piece is split at the worst sample until all of them are within tolerance.
+		ts = [0.0, 1.0]
+		for (a, b, axis) in ( (px0, px1, self.splitXList), (py0, py1, self.splitYList) ) :
+			if a != b :
+				for c in axis[ bisect.bisect_right(axis, min(a,b)) : bisect.bisect_left(axis, max(a,b)) ] :
+					ts.append( (c - a) / (b - a) )
+		ts = sorted(set(ts))
+		ts = sorted( ts + [ (ts[k] + ts[k+1]) / 2 for k in range(len(ts)-1) ] )
+		hs = [ self.getHeight( px0 + (px1 - px0) * t, py0 + (py1 - py0) * t ) for t in ts ]
+
+		splits = []
+		pieces = [ (0, len(ts)-1) ]
+		while len(pieces) > 0 :
+			(a, b) = pieces.pop()
+			worst = tolerance
+			split = None
+			for k in range(a+1, b) :
+				deviation = abs( hs[k] - ( hs[a] + (hs[b] - hs[a]) * (ts[k] - ts[a]) / (ts[b] - ts[a]) ) )
+				if deviation > worst :
+					(worst, split) = (deviation, k)
+			if split != None :
+				splits.append( ts[split] )
+				pieces.extend( [ (a, split), (split, b) ] )
+		return sorted(splits)
+
+	def getSplitCandidates(self, px0, py0, px1, py1, tolerance):
+		# For arrays of segments, False where getSplitParameters() returns no split for sure
+		crossing = numpy.zeros( len(px0), dtype=bool )
+		for (a, b, axis) in ( (px0, px1, self.splitXs), (py0, py1, self.splitYs) ) :
+			crossing |= numpy.searchsorted( axis, numpy.minimum(a,b), 'right' ) < numpy.searchsorted( axis, numpy.maximum(a,b), 'left' )
+		h0 = self.getHeights(px0, py0)
+		h1 = self.getHeights(px1, py1)
+		hm = self.getHeights( px0 + (px1 - px0) * 0.5, py0 + (py1 - py0) * 0.5 )
+		return crossing | ( numpy.abs( hm - ( h0 + (h1 - h0) * (0.5 - 0.0) / (1.0 - 0.0) ) ) > tolerance )
+
+	def getHeights(self, px, py):
+		# Heights for arrays of points
+		px = numpy.asarray(px, dtype=numpy.float64)
+		py = numpy.asarray(py, dtype=numpy.float64)
+		i = self.getCellIndices(px, self.xs, self.x_spacing)
+		j = self.getCellIndices(py, self.ys, self.y_spacing)
+		(x0, width, y0, height, h00, dh0, h01, dh1) = self.cells[ i*(self.ny-1) + j ].T
+		fx = (px - x0) / width
+		h0 = h00 + dh0 * fx
+		h1 = h01 + dh1 * fx
+		fy = (py - y0) / height
+		return h0 + (h1 - h0) * fy
+
+
+##################################################
+
+
+class LevelingSurface:
+	# Surface fitted once to the manual leveling points ((x,y,height) in machine steps), then evaluated per point or
+	# over arrays of points. Models:
+	#  'plane': least squares plane (through the points when there are 3)
+	#  'quadratic': least squares polynomial of degree 2, from 6 points
+	#  'thinplate': thin-plate spline through every point, from 4 points
+	# With too few points for the model, a plane is used. Terms are added in the same order for single points and
+	# arrays, so both give the same heights.
+
+	MODELS = ( 'plane', 'quadratic', 'thinplate' )
+	MIN_POINTS = { 'plane' : 3, 'quadratic' : 6, 'thinplate' : 4 }
+
+	def __init__(self, points, model='plane'):
+		if model not in self.MODELS :
+			raise ValueError('Unknown leveling surface: ' + model)
+		self.model = model if len(points) >= self.MIN_POINTS[model] else 'plane'
+		p = numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+		(x, y, z) = (p[:,0], p[:,1], p[:,2])
+		if self.model == 'plane' :
+			if len(points) == 3 :
+				self.plane = self.get3PointPlane(*points)
+			else :
+				(c0, cx, cy) = numpy.linalg.lstsq( numpy.stack(( numpy.ones(len(x)), x, y ), axis=1), z, rcond=None )[0].tolist()
+				self.plane = ( -cx, -cy, 1.0, c0 ) # a*x + b*y + c*z = d
+		elif self.model == 'quadratic' :
+			self.coefficients = numpy.linalg.lstsq( numpy.stack(( numpy.ones(len(x)), x, y, x*x, x*y, y*y ), axis=1), z, rcond=None )[0].tolist()
+		else :
+			# Kernel r^2 log(r) plus an affine part, solved exactly
+			self.centers = p[:,:2].copy()
+			n = len(p)
+			kernel = self.getKernel( x[:,None] - x[None,:], y[:,None] - y[None,:] )
+			affine = numpy.stack(( numpy.ones(n), x, y ), axis=1)
+			system = numpy.block([ [ kernel, affine ], [ affine.T, numpy.zeros((3,3)) ] ])
+			solution = numpy.linalg.lstsq( system, numpy.concatenate(( z, numpy.zeros(3) )), rcond=None )[0]
+			self.weights = solution[:n].tolist()
+			self.coefficients = solution[n:].tolist()
+
+	@staticmethod
+	def get3PointPlane(p1, p2, p3):
+		x1, y1, z1 = p1
+		x2, y2, z2 = p2
+		x3, y3, z3 = p3
+		v1 = [x3 - x1, y3 - y1, z3 - z1]
+		v2 = [x2 - x1, y2 - y1, z2 - z1]
+		cp = [v1[1] * v2[2] - v1[2] * v2[1],  v1[2] * v2[0] - v1[0] * v2[2],  v1[0] * v2[1] - v1[1] * v2[0]]
+		a, b, c = cp
+		d = a * x1 + b * y1 + c * z1
+		return (a,b,c,d)
+
+	@staticmethod
+	def getKernel(dx, dy):
+		r2 = dx*dx + dy*dy
+		return 0.5 * r2 * numpy.log( numpy.where(r2 > 0.0, r2, 1.0) ) # r^2 log(r), 0 at r=0
+
+	def getHeight(self, px, py):
+		if self.model == 'plane' :
+			a, b, c, d = self.plane
+			return (d - a * px - b * py) / float(c)
+		return self.getHeights( numpy.array([px], dtype=numpy.float64), numpy.array([py], dtype=numpy.float64) )[0].item()
+
+	def getHeights(self, px, py):
+		# Heights for arrays of points
+		if self.model == 'plane' :
+			a, b, c, d = self.plane
+			return (d - a * px - b * py) / float(c)
+		if self.model == 'quadratic' :
+			(c0, cx, cy, cxx, cxy, cyy) = self.coefficients
+			return c0 + cx * px + cy * py + cxx * px * px + cxy * px * py + cyy * py * py
+		(c0, cx, cy) = self.coefficients
+		h = c0 + cx * px + cy * py
+		for ((x, y), w) in zip(self.centers.tolist(), self.weights) :
+			h = h + w * self.getKernel(px - x, py - y)
+		return h
+
+
+##################################################
+
+
+class LevelingMapFile:
+	# Leveling data saved as JSON, to reuse it for the next jobs on the same fixture: the autoleveling grid
+	# (levelingData, relative to origin) and the manual leveling points (machine steps), with the machine position of
+	# the grid origin, the grid spacing (None when uneven) and the time it was probed.
+
+	VERSION = 1
+
+	@staticmethod
+	def save(filename, levelingData, manualLevelingPoints, origin):
+		data = { 'version' : LevelingMapFile.VERSION, 'time' : time.time(), 'origin' : list(origin), 'spacing' : None, 'xs' : None, 'ys' : None, 'heights' : None,
+			'manualPoints' : [ list(p) for p in manualLevelingPoints ] if manualLevelingPoints != None else None }
+		if levelingData != None :
+			heightMap = LevelingHeightMap(levelingData)
+			data['spacing'] = [ heightMap.x_spacing, heightMap.y_spacing ]
+			data['xs'] = [ float(column[0][0]) for column in levelingData ]
+			data['ys'] = [ float(p[1]) for p in levelingData[0] ]
+			data['heights'] = [ [ float(p[2]) for p in column ] for column in levelingData ]
+		temppath = filename + '.tmp'
+		with open(temppath, 'w') as f :
+			json.dump(data, f, separators=(',',':'))
+		os.replace(temppath, filename)
+
+	@staticmethod
+	def load(filename):
+		# Returns (levelingData, manualLevelingPoints, origin, time)
+		with open(filename, 'r') as f :
+			data = json.load(f)
+		if data.get('version') != LevelingMapFile.VERSION :
+			raise ValueError('Unsupported leveling map file: ' + filename)
+		levelingData = None
+		if data['heights'] != None :
+			levelingData = [ [ (x, y, h) for (y, h) in zip(data['ys'], column) ] for (x, column) in zip(data['xs'], data['heights']) ]
+		manualLevelingPoints = [ tuple(p) for p in data['manualPoints'] ] if data['manualPoints'] != None else None
+		return ( levelingData, manualLevelingPoints, tuple(data['origin']), data['time'] )
+
+	@staticmethod
+	def getShiftedLevelingData(levelingData, dx, dy):
+		# The grid moved by (dx,dy) steps
+		return [ [ (x + dx, y + dy, h) for (x, y, h) in column ] for column in levelingData ]
+
+
+##################################################
+
+
+class PointGrid:
+	# Uniform grid of 2D points for nearest neighbour queries. Points are stored with an id and some data,
+	# removing an id removes all its points.
+
+	def __init__(self, points):
+		# points: list of (x, y, id, data)
+		self.cells = {}
+		self.idCells = {}
+		self.liveCount = len(points)
+		if len(points) == 0 :
+			self.cellSize = 1.0
+			return
+		xs = [ p[0] for p in points ]
+		ys = [ p[1] for p in points ]
+		area = (max(xs) - min(xs)) * (max(ys) - min(ys))
+		self.cellSize = math.sqrt( 2.0 * area / len(points) ) or max( max(xs) - min(xs), max(ys) - min(ys), 1.0 ) # about 2 points per cell
+		for p in points :
+			cell = self.getCell(p)
+			self.cells.setdefault( cell, [] ).append(p)
+			self.idCells.setdefault( p[2], [] ).append(cell)
+
+	def getCell(self, p):
+		return ( int( math.floor( p[0] / self.cellSize ) ), int( math.floor( p[1] / self.cellSize ) ) )
+
+	def getRing(self, cx, cy, r):
+		# Cells at a chebyshev distance of r from (cx,cy)
+		if r == 0 : return [ (cx, cy) ]
+		ring = [ (cx+k, cy-r) for k in range(-r, r+1) ] + [ (cx+k, cy+r) for k in range(-r, r+1) ]
+		ring += [ (cx-r, cy+k) for k in range(-r+1, r) ] + [ (cx+r, cy+k) for k in range(-r+1, r) ]
+		return ring
+
+	def remove(self, id):
+		for cell in self.idCells.pop(id, []) :
+			points = self.cells.get(cell)
+			if points == None : continue
+			remaining = [ q for q in points if q[2] != id ]
+			self.liveCount -= len(points) - len(remaining)
+			if len(remaining) > 0 :
+				self.cells[cell] = remaining
+			else :
+				del self.cells[cell]
+
+	def nearest(self, p, count=1):
+		# Up to count nearest points, as (distance, x, y, id, data) sorted by distance
+		(cx, cy) = self.getCell(p)
+		count = min( count, self.liveCount )
+		found = []
+		r = 0
+		while count > 0 :
+			ring = self.getRing(cx, cy, r)
+			if len(ring) > len(self.cells) :
+				# Fewer cells left than in the ring, look at all of them
+				found = [ (math.hypot( q[0]-p[0], q[1]-p[1] ),) + q for points in self.cells.values() for q in points ]
+				break
+			for cell in ring :
+				points = self.cells.get(cell)
+				if points != None :
+					found.extend( (math.hypot( q[0]-p[0], q[1]-p[1] ),) + q for q in points )
+			if len(found) >= count :
+				found.sort()
+				if found[count-1][0] <= r * self.cellSize : break # points further out are at least that far
+			r += 1
+		found.sort()
+		return found[:count]
+
+
+class GCodeLineFilter:
+	# Base of the passes that rewrite the gcode lines of a whole job before conversion
+
+	def __init__(self, converter):
+		self.converter = converter # for its gcode tokenizer
+
+	def parseLine(self, line):
+		# Returns the kind of line ('blank', 'move', 'feed' or 'other'), the command words and the other words
+		(commands, words, recognized) = self.converter.splitWords(line)
+		if not recognized :
+			kind = 'other'
+		elif len(commands) == 0 :
+			kind = 'blank' if len(words) == 0 else 'feed' if list(words) == ['F'] else 'other'
+		elif len(commands) == 1 and (commands[0] == 'G0' or commands[0] == 'G1') and all( w in 'XYZF' for w in words ) :
+			kind = 'move'
+		else :
+			kind = 'other'
+		return (kind, commands, words)
+
+	def updateState(self, state, parsedLine):
+		# state: units, X, Y, Z (mm), feed rate, as tracked by the converter
+		(kind, commands, words) = parsedLine
+		if kind == 'other' :
+			if 'G20' in commands : state[0] = 25.4
+			if 'G21' in commands : state[0] = 1.0
+			return
+		for (k, axis) in ( (1,'X'), (2,'Y'), (3,'Z') ) :
+			if axis in words : state[k] = float(words[axis]) * state[0]
+		if 'F' in words : state[4] = float(words['F'])
+
+
+class ToolpathGroup:
+	# Lines of one plunge-cut-retract group: a rapid XY move above the surface, moves down to the surface and back up.
+
+	def __init__(self, lines, entry, exit):
+		self.lines = lines
+		self.entry = entry # XY position after the first move (mm)
+		self.exit = exit # XY position at the end of the group (mm)
+		self.closed = entry == exit
+		self.reversedLines = None # same cuts in the opposite direction, None if the group cannot be reversed
+
+	def appendLine(self, line):
+		self.lines.append(line)
+		if self.reversedLines != None : self.reversedLines.append(line)
+
+	def getLines(self, flipped):
+		if flipped and not self.closed and self.reversedLines != None :
+			return self.reversedLines
+		return self.lines
+
+
+class ToolpathOptimizer(GCodeLineFilter):
+	# Reorders the plunge-cut-retract groups of a gcode job to shorten the rapid travel between them.
+	# Consecutive groups that only contain moves and that start and end in the same state (units, Z, feed rate)
+	# are reordered with a nearest neighbour tour improved by 2-opt, all other lines stay in place.
+	# Paths are only run backwards if reversePaths is set, as it changes the milling direction.
+
+	NEIGHBOUR_COUNT = 8 # candidate groups per group for 2-opt
+	FULL_SEARCH_GROUPS = 200 # up to this many groups, 2-opt tries all pairs
+	MAX_PASSES = 20 # limit of 2-opt checks, per group
+
+	def __init__(self, converter, reversePaths=False):
+		GCodeLineFilter.__init__(self, converter)
+		self.reversePaths = reversePaths
+		self.groupCount = 0
+		self.travelBefore = 0.0 # mm
+		self.travelAfter = 0.0 # mm
+
+	def optimize(self, lines):
+		# Returns the reordered lines
+		output = []
+		for (kind, items, start, end) in self.splitGroups(lines) :
+			if kind == 'lines' :
+				output.extend(items)
+				continue
+			order = list( range(len(items)) )
+			flips = [False] * len(items)
+			before = self.getTravelDistance(items, order, flips, start, end)
+			(newOrder, newFlips) = self.getOrder(items, start, end)
+			after = self.getTravelDistance(items, newOrder, newFlips, start, end)
+			if after < before :
+				(order, flips) = (newOrder, newFlips)
+			else :
+				after = before
+			for (k, flipped) in zip(order, flips) :
+				output.extend( items[k].getLines(flipped) )
+			self.groupCount += len(items)
+			self.travelBefore += before
+			self.travelAfter += after
+
+		saved = self.travelBefore - self.travelAfter
+		speed = min(self.converter.RAPID_SPEED, self.converter.MAX_SPEED) # what RmlJobSimulator assumes
+		print('Toolpath optimization: {} paths, rapid travel {:.1f} mm -> {:.1f} mm, saved {:.1f} mm (about {:.1f} s at {:.0f} mm/s)'.format(
+			self.groupCount, self.travelBefore, self.travelAfter, saved, saved / speed, speed ) )
+		return output
+
+	def splitGroups(self, lines):
+		# Returns a list of ('lines', lines, None, None) and ('groups', groups, start, end) items,
+		# start and end are the XY positions before and after the groups (end is None when not known)
+		parsed = [ self.parseLine(line) for line in lines ]
+		state = [1.0, 0.0, 0.0, 0.0, 0.0]
+		items = []
+		fixed = []
+		run = []
+		i = 0
+		while i < len(lines) :
+			(kind, commands, words) = parsed[i]
+			if kind == 'move' and commands[0] == 'G0' and 'X' in words and 'Y' in words and state[3] > 0 :
+				# Rapid move above the surface, start of a group
+				target = ( float(words['X']) * state[0], float(words['Y']) * state[0] )
+				position = ( state[1], state[2] )
+				before = ( state[0], state[3], state[4] )
+				(group, j) = self.readGroup(lines, parsed, i, state)
+				reorderable = group != None and before == ( state[0], state[3], state[4] )
+				if len(run) > 0 and not (reorderable and before == runState) :
+					items.append( ('groups', run, runStart, target) )
+					run = []
+				if reorderable :
+					if len(run) == 0 :
+						if len(fixed) > 0 : items.append( ('lines', fixed, None, None) )
+						(fixed, runState, runStart) = ( [], before, position )
+					run.append(group)
+				else :
+					fixed.extend( lines[i:j] )
+				i = j
+				continue
+
+			# Line outside of a group, only empty lines and comments can follow a group without ending the run
+			if len(run) > 0 and kind != 'blank' :
+				items.append( ('groups', run, runStart, self.getNextPosition(parsed, i, state[0])) )
+				run = []
+			if len(run) > 0 :
+				run[-1].appendLine(lines[i])
+			else :
+				fixed.append(lines[i])
+			self.updateState(state, parsed[i])
+			i += 1
+
+		if len(run) > 0 : items.append( ('groups', run, runStart, None) )
+		if len(fixed) > 0 : items.append( ('lines', fixed, None, None) )
+		return items
+
+	def readGroup(self, lines, parsed, i, state):
+		# Reads the group starting at line i, up to the move back above the surface.
+		# Returns the group (None if other commands come first) and the index of the line after it.
+		entry = None
+		plunged = False
+		j = i
+		while j < len(lines) :
+			(kind, commands, words) = parsed[j]
+			if kind == 'other' : return (None, j)
+			self.updateState(state, parsed[j])
+			j += 1
+			if entry == None : entry = ( state[1], state[2] )
+			if kind == 'move' :
+				if state[3] <= 0 :
+					plunged = True
+				elif plunged :
+					group = ToolpathGroup( lines[i:j], entry, ( state[1], state[2] ) )
+					group.reversedLines = self.getReversedLines( lines[i:j], parsed[i:j] )
+					return (group, j)
+		return (None, j)
+
+	def isZOnly(self, parsedLine):
+		(kind, commands, words) = parsedLine
+		return kind == 'blank' or kind == 'feed' or kind == 'move' and not ('X' in words or 'Y' in words)
+
+	def getReversedLines(self, lines, parsed):
+		# Groups made of the rapid move, Z moves, XY cuts and Z moves can be cut backwards, the numbers are copied as written
+		n = len(lines)
+		words = parsed[0][2]
+		if 'Z' in words or 'F' in words : return None
+		points = [ ( words['X'], words['Y'] ) ]
+		k = 1
+		while k < n and self.isZOnly(parsed[k]) : k += 1
+		cutStart = k
+		while k < n and parsed[k][0] == 'move' and parsed[k][1][0] == 'G1' and not self.isZOnly(parsed[k]) and 'Z' not in parsed[k][2] and 'F' not in parsed[k][2] :
+			words = parsed[k][2]
+			points.append( ( words.get('X', points[-1][0]), words.get('Y', points[-1][1]) ) )
+			k += 1
+		cutEnd = k
+		while k < n and self.isZOnly(parsed[k]) : k += 1
+		if k < n or cutEnd == cutStart : return None
+		reversedLines = [ 'G00 X{} Y{}'.format(*points[-1]) ] + lines[1:cutStart]
+		reversedLines += [ 'G01 X{} Y{}'.format(*p) for p in points[-2::-1] ]
+		return reversedLines + lines[cutEnd:]
+
+	def getNextPosition(self, parsed, i, units):
+		# XY position of the next move that changes X or Y, None if it does not set both
+		for (kind, commands, words) in parsed[i:] :
+			if 'G20' in commands : units = 25.4
+			if 'G21' in commands : units = 1.0
+			if kind == 'move' and ('X' in words or 'Y' in words) :
+				if 'X' in words and 'Y' in words :
+					return ( float(words['X']) * units, float(words['Y']) * units )
+				return None
+		return None
+
+	def getTravelDistance(self, groups, order, flips, start, end):
+		# Rapid XY travel from start, between the groups and to end (mm)
+		distance = 0.0
+		position = start
+		for (k, flipped) in zip(order, flips) :
+			(entry, exit) = ( groups[k].exit, groups[k].entry ) if flipped else ( groups[k].entry, groups[k].exit )
+			distance += math.hypot( entry[0]-position[0], entry[1]-position[1] )
+			position = exit
+		if end != None :
+			distance += math.hypot( end[0]-position[0], end[1]-position[1] )
+		return distance
+
+	def getOrder(self, groups, start, end):
+		# Nearest neighbour tour from start improved by 2-opt, returns the group order and which groups run backwards
+		m = len(groups)
+		flippable = [ g.closed or (self.reversePaths and g.reversedLines != None) for g in groups ]
+		points = []
+		for (k, g) in enumerate(groups) :
+			points.append( ( g.entry[0], g.entry[1], k, False ) )
+			if flippable[k] and not g.closed :
+				points.append( ( g.exit[0], g.exit[1], k, True ) )
+
+		grid = PointGrid(points)
+		order = []
+		flips = []
+		position = start
+		while len(order) < m :
+			(distance, x, y, k, flipped) = grid.nearest(position)[0]
+			grid.remove(k)
+			order.append(k)
+			flips.append(flipped)
+			position = groups[k].entry if flipped else groups[k].exit
+
+		# Candidate groups near each group, and near the start
+		grid = PointGrid( [ ( g.entry[0], g.entry[1], k, None ) for (k, g) in enumerate(groups) ] + [ ( g.exit[0], g.exit[1], k, None ) for (k, g) in enumerate(groups) if not g.closed ] )
+		count = 2*m if m <= self.FULL_SEARCH_GROUPS else self.NEIGHBOUR_COUNT
+		neighbours = []
+		for g in groups :
+			found = grid.nearest(g.exit, count) + grid.nearest(g.entry, count)
+			neighbours.append( list( dict.fromkeys( f[3] for f in found ) ) )
+		neighbours.append( list( dict.fromkeys( f[3] for f in grid.nearest(start, count) ) ) ) # last one for the start
+
+		# 2-opt: running order[i..j] backwards (each group reversed) replaces the travel before i and after j.
+		# Only groups that can be reversed take part, their positions do not change so the count before each position stays valid.
+		# The travel after each queued group (m for the start) is checked until no move improves it.
+		positions = [0] * m
+		for (p, k) in enumerate(order) : positions[k] = p
+		blocked = [0]
+		for k in order : blocked.append( blocked[-1] + (0 if flippable[k] else 1) )
+		entries = [ g.entry for g in groups ]
+		exits = [ g.exit for g in groups ]
+		def getReversalGain(u, v) :
+			# Travel saved by running order[u..v] backwards
+			before = start if u == 0 else ( entries[order[u-1]] if flips[u-1] else exits[order[u-1]] )
+			after = end if v+1 == m else ( exits[order[v+1]] if flips[v+1] else entries[order[v+1]] )
+			begin = exits[order[u]] if flips[u] else entries[order[u]]
+			finish = entries[order[v]] if flips[v] else exits[order[v]]
+			gain = math.hypot( before[0]-begin[0], before[1]-begin[1] ) - math.hypot( before[0]-finish[0], before[1]-finish[1] )
+			if after != None :
+				gain += math.hypot( finish[0]-after[0], finish[1]-after[1] ) - math.hypot( begin[0]-after[0], begin[1]-after[1] )
+			return gain
+		queue = collections.deque( [m] + order )
+		queued = set(queue)
+		checks = self.MAX_PASSES * (m+1)
+		while len(queue) > 0 and checks > 0 :
+			checks -= 1
+			g = queue.popleft()
+			queued.discard(g)
+			p = -1 if g == m else positions[g]
+			for k in neighbours[g] :
+				# Reverse the groups between g and its neighbour k, so that they end up next to each other
+				j = positions[k]
+				(u, v) = (p+1, j) if j > p else (j+1, p)
+				if u > v or blocked[v+1] - blocked[u] > 0 : continue
+				if getReversalGain(u, v) > 1e-9 :
+					order[u:v+1] = order[u:v+1][::-1]
+					flips[u:v+1] = [ not f for f in flips[u:v+1][::-1] ]
+					for q in range(u, v+1) : positions[order[q]] = q
+					for changed in ( g, order[u], order[v] ) + ( (order[u-1],) if u > 0 else () ) :
+						if changed not in queued :
+							queue.append(changed)
+							queued.add(changed)
+					break
+		return (order, flips)
+
+
+class PolylineSimplifier(GCodeLineFilter):
+	# Removes points of the cutting paths: collinear points first, then Douglas-Peucker with the tolerance in steps.
+	# Only runs of consecutive G01 moves in XY are simplified, so points are never merged across a Z or feed rate change.
+	# Kept lines are copied as written, unless they relied on an axis value of a removed line.
+
+	COLLINEAR_EPSILON = 1e-9 # mm
+
+	def __init__(self, converter, tolerance):
+		GCodeLineFilter.__init__(self, converter)
+		self.tolerance = tolerance # steps
+		self.moveCount = 0
+		self.removedCount = 0
+
+	def simplify(self, lines):
+		# Returns the simplified lines
+		output = []
+		run = [] # (line, words, point, axis texts) of the moves in the current run
+		state = [1.0, 0.0, 0.0, 0.0, 0.0]
+		texts = {'X':'0', 'Y':'0'} # axis values as written
+		for line in lines :
+			parsedLine = self.parseLine(line)
+			(kind, commands, words) = parsedLine
+			isCut = kind == 'move' and commands[0] == 'G1' and ('X' in words or 'Y' in words) and not ('Z' in words or 'F' in words)
+			if len(run) > 0 and not isCut :
+				output.extend( self.simplifyRun(run) )
+				run = []
+			if isCut and len(run) == 0 :
+				run.append( (None, None, (state[1], state[2]), (texts['X'], texts['Y'])) ) # start of the path
+			self.updateState(state, parsedLine)
+			if 'G20' in commands or 'G21' in commands :
+				texts = { 'X':'{:.6f}'.format(state[1] / state[0]), 'Y':'{:.6f}'.format(state[2] / state[0]) }
+			if kind == 'move' :
+				for axis in ('X','Y') :
+					if axis in words : texts[axis] = words[axis]
+			if isCut :
+				run.append( (line, words, (state[1], state[2]), (texts['X'], texts['Y'])) )
+			else :
+				output.append(line)
+		output.extend( self.simplifyRun(run) )
+		return output
+
+	def simplifyRun(self, run):
+		if len(run) == 0 : return []
+		points = [ r[2] for r in run ]
+		keep = self.getKeptPoints(points)
+		self.moveCount += len(run) - 1
+		self.removedCount += len(run) - len(keep)
+		output = []
+		previous = 0
+		for k in keep[1:] :
+			(line, words, point, (x, y)) = run[k]
+			if k > previous+1 and not ('X' in words and 'Y' in words) :
+				line = 'G01 X{} Y{}'.format(x, y)
+			output.append(line)
+			previous = k
+		return output
+
+	def getKeptPoints(self, points):
+		# Indices of the points to keep, the first and last ones are always kept
+		n = len(points)
+		if n <= 2 : return list(range(n))
+
+		# Collinear points along the direction of travel
+		kept = [0]
+		for k in range(1, n-1) :
+			(a, b, c) = ( points[kept[-1]], points[k], points[k+1] )
+			cross = (b[0]-a[0]) * (c[1]-a[1]) - (b[1]-a[1]) * (c[0]-a[0])
+			dot = (b[0]-a[0]) * (c[0]-b[0]) + (b[1]-a[1]) * (c[1]-b[1])
+			if abs(cross) > self.COLLINEAR_EPSILON * math.hypot( c[0]-a[0], c[1]-a[1] ) or dot < 0 :
+				kept.append(k)
+		kept.append(n-1)
+
+		# Douglas-Peucker, with the distance to the segment as paths can go back on themselves
+		tolerance = self.tolerance / self.converter.OUTPUT_SCALE
+		keep = [False] * len(kept)
+		keep[0] = keep[-1] = True
+		pieces = [ (0, len(kept)-1) ]
+		while len(pieces) > 0 :
+			(i, j) = pieces.pop()
+			worst = tolerance
+			split = None
+			for k in range(i+1, j) :
+				distance = self.getSegmentDistance( points[kept[k]], points[kept[i]], points[kept[j]] )
+				if distance > worst :
+					(worst, split) = (distance, k)
+			if split != None :
+				keep[split] = True
+				pieces.extend( [ (i, split), (split, j) ] )
+		return [ index for (index, kept) in zip(kept, keep) if kept ]
+
+	def getSegmentDistance(self, p, a, b):
+		dx = b[0] - a[0]
+		dy = b[1] - a[1]
+		length2 = dx*dx + dy*dy
+		t = 0.0 if length2 == 0 else min( max( ( (p[0]-a[0])*dx + (p[1]-a[1])*dy ) / length2, 0.0 ), 1.0 )
+		return math.hypot( p[0] - a[0] - dx*t, p[1] - a[1] - dy*t )
+
+
+##################################################
+
+
+class ConversionCache:
+	# Converted RML files stored under a hash of the gcode file and of every converter setting that affects the output.
+	# The least recently used files are removed when the cache grows over maxSize bytes.
+
+	def __init__(self, folder, maxSize):
+		self.folder = folder
+		self.maxSize = maxSize
+
+	def getKey(self, infile, converter):
+		h = hashlib.sha256()
+		h.update( repr( converter.getOutputSettings() ).encode('utf-8') )
+		try :
+			with open(__file__, 'rb') as f : # conversion code
+				h.update( f.read() )
+		except (NameError, IOError) :
+			pass
+		with open(infile, 'rb') as f :
+			for block in iter( lambda: f.read(1 << 20), b'' ) :
+				h.update(block)
+		return h.hexdigest()
+
+	def getPath(self, key):
+		return os.path.join(self.folder, key + '.prn')
+
+	def get(self, key, outfile):
+		# Copies the cached output to outfile, returns False if there is none
+		path = self.getPath(key)
+		if not os.path.isfile(path) : return False
+		shutil.copyfile(path, outfile)
+		os.utime(path, None) # most recently used
+		return True
+
+	def put(self, key, outfile):
+		if not os.path.isdir(self.folder) : os.makedirs(self.folder)
+		temppath = self.getPath(key) + '.tmp'
+		shutil.copyfile(outfile, temppath)
+		os.replace(temppath, self.getPath(key))
+		self.evict()
+
+	def getEntries(self):
+		# (last use time, size, path) of the cached files, oldest first
+		if not os.path.isdir(self.folder) : return []
+		entries = []
+		for name in os.listdir(self.folder) :
+			if name.endswith('.prn') :
+				path = os.path.join(self.folder, name)
+				st = os.stat(path)
+				entries.append( (st.st_mtime, st.st_size, path) )
+		return sorted(entries)
+
+	def evict(self):
+		entries = self.getEntries()
+		size = sum( e[1] for e in entries )
+		for (mtime, filesize, path) in entries :
+			if size <= self.maxSize : break
+			os.remove(path)
+			size -= filesize
+
+	def clear(self):
+		for (mtime, filesize, path) in self.getEntries() :
+			os.remove(path)
+
+
+##################################################
+
+
+class SerialCommandWriter:
+	# Keeps the serial port open and writes queued commands from a background thread.
+	# Jog commands are coalesced: a jog queued behind another one that is not written yet replaces it, so only the latest
+	# target is sent. The delay from queuing a command to the end of its write is recorded as the latency.
+	# The port can be a device name, a pyserial URL (e.g. 'loop://' or a pty path for testing) or an open port object with
+	# the same write(), flush() and cts (e.g. mdx15_emulator.VirtualSerialPort).
+
+	LATENCY_SAMPLES = 1000 # latencies kept for the report
+
+	def __init__(self, port, baudrate=9600):
+		self.port = port
+		self.ser = serial.serial_for_url(port, baudrate, rtscts=True) if isinstance(port, str) else port
+		self.queue = collections.deque() # (command, queued time, is jog)
+		self.condition = threading.Condition()
+		self.busy = False # a command is being written
+		self.writeStarted = None # time when the write of the last command started
+		self.running = True
+		self.error = None
+		self.latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+		self.coalesced = 0
+		self.thread = threading.Thread(target=self.writeLoop, daemon=True)
+		self.thread.start()
+
+	def send(self, cmd, jog=False):
+		with self.condition :
+			if jog and len(self.queue) > 0 and self.queue[-1][2] :
+				# Replace the pending jog, the latency still counts from the older keypress
+				self.queue[-1] = ( cmd, self.queue[-1][1], True )
+				self.coalesced += 1
+			else :
+				self.queue.append( ( cmd, time.perf_counter(), jog ) )
+			self.condition.notify_all()
+
+	def writeLoop(self):
+		while True :
+			with self.condition :
+				while self.running and len(self.queue) == 0 :
+					self.condition.wait()
+				if len(self.queue) == 0 : break
+				(cmd, queued, jog) = self.queue.popleft()
+				self.busy = True
+				self.writeStarted = time.perf_counter()
+				self.condition.notify_all() # see waitStarted()
+			try :
+				self.ser.write( (cmd + '\n').encode('ascii') )
+				self.ser.flush()
+			except serial.serialutil.SerialException as e :
+				self.error = e
+			with self.condition :
+				self.latencies.append( time.perf_counter() - queued )
+				self.busy = False
+				self.condition.notify_all()
+
+	def getByteTime(self):
+		# Seconds to send a byte (8N1), 0 when unknown
+		baudrate = getattr(self.ser, 'baudrate', None)
+		return 10.0 / baudrate if baudrate else 0.0
+
+	def waitStarted(self, timeout=None):
+		# Blocks until the write of every queued command has started, see writeStarted
+		with self.condition :
+			return self.condition.wait_for( lambda : len(self.queue) == 0, timeout )
+
+	def waitSent(self, timeout=None):
+		# Blocks until every queued command is written
+		with self.condition :
+			return self.condition.wait_for( lambda : len(self.queue) == 0 and not self.busy, timeout )
+
+	def close(self):
+		# Writes the remaining commands, then closes the port
+		with self.condition :
+			self.running = False
+			self.condition.notify_all()
+		self.thread.join()
+		self.ser.close()
+
+	def getLatencyReport(self):
+		# Latencies in milliseconds
+		with self.condition :
+			latencies = sorted( 1000.0 * t for t in self.latencies )
+		if len(latencies) == 0 :
+			return { 'count' : 0, 'coalesced' : self.coalesced }
+		return { 'count' : len(latencies), 'coalesced' : self.coalesced, 'mean' : sum(latencies) / len(latencies),
+			'median' : latencies[len(latencies)//2], 'p95' : latencies[ min( len(latencies)-1, int(0.95*len(latencies)) ) ], 'max' : latencies[-1] }
+
+	def printLatencyReport(self):
+		r = self.getLatencyReport()
+		if r['count'] > 0 :
+			print('Command latency: {count} writes, {coalesced} jogs coalesced, mean {mean:.1f} ms, median {median:.1f} ms, 95% {p95:.1f} ms, max {max:.1f} ms'.format(**r))
+
+
+##################################################
+
+
+class RmlSender:
+	# Streams an RML file to the MDX-15 over a serial port with RTS/CTS flow control, instead of the Windows spooler.
+	# The file is read line by line and written in chunks of whole commands of about CHUNK_SIZE bytes, so the machine
+	# starts on the first commands right away. A chunk waits for CTS, then is written and drained before the next one.
+	# cancel() (or CTRL-C during sendFile) stops between chunks.
+	# The lines written so far are recorded in a checkpoint journal next to the file (removed once the job is sent), from
+	# which an interrupted job can be resumed, see getResumePoint().
+	# The port is opened as in SerialCommandWriter.
+
+	CHUNK_SIZE = 512 # bytes, well under the machine's input buffer
+	CTS_POLL_INTERVAL = 0.01 # seconds
+	PROGRESS_INTERVAL = 0.5 # seconds between progress reports
+	RATE_WINDOW = 10.0 # seconds of history for the transfer rate
+	CHECKPOINT_INTERVAL = 1.0 # seconds between checkpoint journal updates
+	RESUME_BACKTRACK = 2048 # bytes sent again before the checkpoint on resume, for the commands still in the machine's buffer
+
+	def __init__(self, port, baudrate=9600):
+		self.port = port
+		self.ser = serial.serial_for_url(port, baudrate, rtscts=True) if isinstance(port, str) else port
+		self.cancelled = threading.Event()
+		self.bytesSent = 0
+		self.commandsSent = 0
+		try :
+			self.ser.cts
+			self.hasModemLines = True
+		except (OSError, serial.serialutil.SerialException) :
+			self.hasModemLines = False # e.g. a pty, rely on the driver
+
+	def cancel(self):
+		self.cancelled.set()
+
+	def close(self):
+		self.ser.close()
+
+	def iterateChunks(self, f):
+		# Data of about CHUNK_SIZE bytes made of whole lines, with its number of lines
+		lines = []
+		size = 0
+		for line in f :
+			lines.append(line)
+			size += len(line)
+			if size >= self.CHUNK_SIZE :
+				yield ( b''.join(lines), len(lines) )
+				lines = []
+				size = 0
+		if len(lines) > 0 :
+			yield ( b''.join(lines), len(lines) )
+
+	def waitForClearToSend(self):
+		# False if cancelled while the machine holds CTS off
+		while self.hasModemLines and not self.ser.cts :
+			if self.cancelled.wait(self.CTS_POLL_INTERVAL) :
+				return False
+		return not self.cancelled.is_set()
+
+	def sendFile(self, filename, progress=None, resumePoint=None):
+		# Returns True when the whole file was sent, False if cancelled.
+		# progress(bytesSent, totalBytes, bytesPerSecond, secondsLeft) is called during the transfer, by default printProgress().
+		# resumePoint, from getResumePoint(), starts with its commands restoring the machine state, then the file from its line.
+		if progress == None : progress = self.printProgress
+		total = os.path.getsize(filename)
+		(line, offset, preamble) = resumePoint if resumePoint != None else (0, 0, '')
+		self.bytesSent = offset
+		self.commandsSent = line
+		started = time.perf_counter()
+		samples = collections.deque( [ (started, offset) ] )
+		reported = checkpointed = started
+		try :
+			with open(filename, 'rb') as f :
+				f.seek(offset)
+				chunks = self.iterateChunks(f)
+				if len(preamble) > 0 :
+					chunks = itertools.chain( [ (preamble.encode('ascii'), 0) ], chunks )
+				for (data, lineCount) in chunks :
+					if not self.waitForClearToSend() :
+						break
+					self.ser.write(data)
+					self.ser.flush()
+					if lineCount > 0 : self.bytesSent += len(data)
+					self.commandsSent += lineCount
+
+					now = time.perf_counter()
+					if now - checkpointed >= self.CHECKPOINT_INTERVAL :
+						checkpointed = now
+						self.writeCheckpoint(filename)
+					samples.append( (now, self.bytesSent) )
+					while len(samples) > 2 and samples[1][0] < now - self.RATE_WINDOW :
+						samples.popleft()
+					if now - reported >= self.PROGRESS_INTERVAL :
+						reported = now
+						rate = (self.bytesSent - samples[0][1]) / (now - samples[0][0]) if now > samples[0][0] else 0.0
+						progress( self.bytesSent, total, rate, (total - self.bytesSent) / rate if rate > 0 else None )
+		except KeyboardInterrupt :
+			self.cancel()
+		except serial.serialutil.SerialException :
+			self.writeCheckpoint(filename) # e.g. the cable was pulled
+			raise
+
+		if self.cancelled.is_set() :
+			self.writeCheckpoint(filename)
+			self.ser.reset_output_buffer()
+			print('')
+			print('Cancelled after {} commands ({} of {} bytes), use --resume to continue.'.format(self.commandsSent, self.bytesSent, total))
+			return False
+		self.removeCheckpoint(filename)
+		elapsed = time.perf_counter() - started
+		progress( self.bytesSent, total, (self.bytesSent - offset) / elapsed if elapsed > 0 else 0.0, 0.0 )
+		print('')
+		return True
+
+	def printProgress(self, sent, total, rate, secondsLeft):
+		eta = '--:--:--' if secondsLeft == None else '{}:{:02d}:{:02d}'.format( int(secondsLeft) // 3600, int(secondsLeft) // 60 % 60, int(secondsLeft) % 60 )
+		sys.stdout.write( '\r{:5.1f}%  {} / {} bytes  {:.0f} bytes/s  ETA {}  '.format( 100.0 * sent / total if total > 0 else 100.0, sent, total, rate, eta ) )
+		sys.stdout.flush()
+
+	@staticmethod
+	def getCheckpointPath(filename):
+		return filename + '.checkpoint'
+
+	def writeCheckpoint(self, filename):
+		# Lines and bytes of the file written to the port, with the file size and time to detect a changed file
+		info = os.stat(filename)
+		checkpoint = { 'line' : self.commandsSent, 'bytes' : self.bytesSent, 'size' : info.st_size, 'mtime' : info.st_mtime, 'time' : time.time() }
+		path = self.getCheckpointPath(filename)
+		with open(path + '.tmp', 'w') as f :
+			json.dump(checkpoint, f)
+		os.replace(path + '.tmp', path)
+
+	def removeCheckpoint(self, filename):
+		if os.path.exists( self.getCheckpointPath(filename) ) :
+			os.remove( self.getCheckpointPath(filename) )
+
+	@staticmethod
+	def getResumePoint(filename):
+		# (line, byte offset, commands) to continue the job from its checkpoint, None without a valid checkpoint.
+		# The job goes back RESUME_BACKTRACK bytes before the checkpoint. The commands restore the state at that line, assuming
+		# the tool was raised when the machine was stopped (VIEW button):
+		# defaults, spindle, a rapid move above the last position at the highest Z of the job so far, the V/F speeds in effect
+		# and the move down to the last position.
+		try :
+			with open(RmlSender.getCheckpointPath(filename)) as f :
+				checkpoint = json.load(f)
+		except (OSError, ValueError) :
+			return None
+		info = os.stat(filename)
+		if checkpoint['size'] != info.st_size or checkpoint['mtime'] != info.st_mtime :
+			print('The checkpoint does not match {}, it was changed since.'.format(filename))
+			return None
+
+		target = max( 0, checkpoint['bytes'] - RmlSender.RESUME_BACKTRACK )
+		(line, offset) = (0, 0)
+		speeds = {}
+		spindle = '1'
+		position = None
+		safeZ = None
+		with open(filename, 'rb') as f :
+			for data in f :
+				if offset + len(data) > target : break
+				for cmd in data.decode('ascii','replace').strip().split(';') :
+					if cmd.startswith('V') or cmd.startswith('F') :
+						speeds[cmd[0]] = cmd
+					elif cmd.startswith('!MC') :
+						spindle = cmd[3:4]
+					elif cmd.startswith('Z') :
+						values = cmd[1:].split(',')
+						position = values[-3:]
+						z = float(values[2])
+						for k in range(5, len(values), 3) : z = max( z, float(values[k]) )
+						safeZ = z if safeZ == None else max(safeZ, z)
+					elif cmd.startswith('^DF') :
+						speeds = {}
+				line += 1
+				offset += len(data)
+		if line == 0 :
+			return (0, 0, '')
+		commands = [ '^DF', '!MC{}'.format(spindle) ]
+		if position != None :
+			(x, y, z) = ( position[0].strip(), position[1].strip(), float(position[2]) )
+			commands.append( 'V {0:.2f};F {0:.2f}'.format(GCode2RmlConverter.RAPID_SPEED) )
+			commands.append( 'Z {},{},{:.0f}'.format( x, y, max(safeZ, z) ) )
+			commands.extend( [ speeds[k] for k in ('V','F') if k in speeds ] )
+			commands.append( 'Z {},{},{:.0f}'.format( x, y, z ) )
+		else :
+			commands.extend( [ speeds[k] for k in ('V','F') if k in speeds ] )
+		return ( line, offset, '\n'.join(commands) + '\n' )
+
+
+##################################################
+
+
+class MotionModel:
+	# Time taken by the machine to run a move (positions in steps, speeds in mm per second).
+	# XY moves are interpolated along the line and Z runs on its own, each one accelerating at the given rate up to its
+	# speed (limited to the machine maximum) and decelerating to a stop: the move ends when the slowest of the two ends.
+	# The MDX-15 cannot report its position over the serial line, so this is how long to wait for a move to complete.
+
+	ACCELERATION = 100.0 # mm per second squared
+	SETTLE_TIME = 0.002 # seconds, after the motors stop
+
+	def __init__(self, acceleration=ACCELERATION, settleTime=SETTLE_TIME):
+		self.acceleration = acceleration
+		self.settleTime = settleTime
+
+	def getAxisTime(self, distance, speed):
+		# Trapezoidal speed profile, or triangular when the move is too short to reach the speed
+		distance = abs(distance) / RmlJobSimulator.STEPS_PER_MM
+		speed = min(speed, RmlJobSimulator.MAX_SPEED)
+		if distance == 0.0 : return 0.0
+		if self.acceleration <= 0.0 : return distance / speed
+		if distance * self.acceleration >= speed * speed :
+			return distance / speed + speed / self.acceleration
+		return 2.0 * math.sqrt( distance / self.acceleration )
+
+	def getMoveTime(self, dx, dy, dz, xySpeed=RmlJobSimulator.DEFAULT_SPEED, zSpeed=RmlJobSimulator.DEFAULT_SPEED):
+		t = max( self.getAxisTime( math.hypot(dx,dy), xySpeed ), self.getAxisTime( dz, zSpeed ) )
+		return t + self.settleTime if t > 0.0 else 0.0
+
+	def getAxisDistance(self, distance, speed, t):
+		# Distance covered t seconds after the start of a move along an axis, with the sign of distance
+		d = abs(distance) / RmlJobSimulator.STEPS_PER_MM
+		speed = min(speed, RmlJobSimulator.MAX_SPEED)
+		total = self.getAxisTime(distance, speed)
+		if t <= 0.0 or d == 0.0 : return 0.0
+		if t >= total : return distance
+		if self.acceleration <= 0.0 :
+			covered = speed * t
+		else :
+			ramp = min( speed / self.acceleration, total / 2.0 ) # acceleration time
+			if t < ramp :
+				covered = 0.5 * self.acceleration * t * t
+			elif t > total - ramp :
+				covered = d - 0.5 * self.acceleration * (total - t) * (total - t)
+			else :
+				covered = 0.5 * self.acceleration * ramp * ramp + speed * (t - ramp)
+		return math.copysign( covered * RmlJobSimulator.STEPS_PER_MM, distance )
+
+
+##################################################
+
+
+class FocusSearch:
+	# Finds the height rank (0 to count-1, from the top) with the sharpest focus, measure(rank) giving the focus value.
+	# A coarse pass samples every coarseStep ranks going down, and stops early once the focus falls below
+	# earlyStopRatio of the best value seen, provided that best value is at least peakRatio times the first (out of focus)
+	# sample, so that noise before the peak does not stop it. A golden-section search then narrows the bracket around the
+	# coarse peak, moving the bracket on while the peak lands on its edge, and a parabola through the best rank and its
+	# neighbours gives the fractional peak rank. atEdge tells when the peak is at the first or last rank: the focus may
+	# then be outside the searched heights.
+	# Samples are cached, so no rank is measured twice.
+
+	COARSE_STEP = 5
+	EARLY_STOP_RATIO = 0.5
+	PEAK_RATIO = 1.5
+	GOLDEN_RATIO = 0.6180339887
+
+	def __init__(self, measure, count, coarseStep=COARSE_STEP, earlyStopRatio=EARLY_STOP_RATIO, peakRatio=PEAK_RATIO):
+		self.measure = measure
+		self.count = count
+		self.coarseStep = coarseStep
+		self.earlyStopRatio = earlyStopRatio
+		self.peakRatio = peakRatio
+		self.samples = {}
+		self.atEdge = False
+
+	def getSample(self, rank):
+		if rank not in self.samples :
+			self.samples[rank] = self.measure(rank)
+		return self.samples[rank]
+
+	def search(self):
+		best = self.searchCoarse()
+		while True :
+			(lo, hi) = ( max(0, best - self.coarseStep), min(self.count - 1, best + self.coarseStep) )
+			refined = self.searchGolden(lo, hi)
+			onEdge = ( refined == lo and lo > 0 ) or ( refined == hi and hi < self.count - 1 )
+			if not onEdge or self.getSample(refined) <= self.getSample(best) :
+				break
+			best = refined # the peak may be past the bracket
+		best = max( self.samples, key=self.samples.get )
+		self.atEdge = best == 0 or best == self.count - 1
+		return best + self.getPeakOffset(best)
+
+	def searchCoarse(self):
+		ranks = list( range(0, self.count, self.coarseStep) )
+		if ranks[-1] != self.count - 1 :
+			ranks.append(self.count - 1)
+		best = ranks[0]
+		for rank in ranks :
+			v = self.getSample(rank)
+			if v > self.samples[best] :
+				best = rank
+			elif v < self.earlyStopRatio * self.samples[best] and self.samples[best] >= self.peakRatio * self.samples[ranks[0]] :
+				break # past the peak
+		return best
+
+	def searchGolden(self, lo, hi):
+		# The focus is assumed unimodal in [lo,hi]
+		while hi - lo > 2 :
+			a = lo + int(round( (hi - lo) * (1.0 - self.GOLDEN_RATIO) ))
+			b = lo + int(round( (hi - lo) * self.GOLDEN_RATIO ))
+			if self.getSample(a) < self.getSample(b) :
+				lo = a
+			else :
+				hi = b
+		return max( range(lo, hi+1), key=self.getSample )
+
+	def getPeakOffset(self, rank):
+		# Vertex of the parabola through the neighbours, between -0.5 and 0.5 when rank is the maximum
+		if rank == 0 or rank == self.count - 1 :
+			return 0.0
+		(f0, f1, f2) = ( self.getSample(rank-1), self.getSample(rank), self.getSample(rank+1) )
+		curvature = f0 - 2.0 * f1 + f2
+		if curvature >= 0.0 :
+			return 0.0
+		return min( 0.5, max( -0.5, 0.5 * (f0 - f2) / curvature ) )
+
+	@staticmethod
+	def fitPeak(positions, values, window=3.0):
+		# Position of the focus peak from samples at arbitrary positions: vertex of the parabola fitted by least squares
+		# to the samples within window of the best one, or the best position when the fit has no maximum there
+		positions = numpy.asarray(positions, dtype=numpy.float64)
+		values = numpy.asarray(values, dtype=numpy.float64)
+		best = positions[ numpy.argmax(values) ].item()
+		near = numpy.abs(positions - best) <= window
+		if len( numpy.unique(positions[near]) ) < 3 :
+			return best
+		(a, b, c) = numpy.polyfit( positions[near] - best, values[near], 2 )
+		if a >= 0.0 :
+			return best
+		return best + min( window, max( -window, -b.item() / (2.0 * a.item()) ) )
+
+
+##################################################
+
+
+class ProbePlanner:
+	# Plans the leveling probes over the rectangle between (x1,y1) and (x2,y2), measure(x,y) giving the height at a point.
+	# A coarse grid of segments x segments cells is probed first. With a tolerance, the center of each cell is probed
+	# next, and cells where it departs from the bilinear interpolation of the corners by more than the tolerance are
+	# split in four, down to maxDepth levels. Each pass visits its points in serpentine order (along Y, alternating the
+	# direction at each X), so there are no full-width return moves, and starts from the end nearest the last probed point.
+	# run() returns the grid over every probed X and Y (levelingData for LevelingHeightMap, ordered from (x1,y1)),
+	# the nodes that were not probed being interpolated in their cell.
+
+	MAX_DEPTH = 2
+
+	def __init__(self, measure, x1, y1, x2, y2, segments=1, tolerance=None, maxDepth=MAX_DEPTH):
+		self.measure = measure
+		(self.x1, self.y1, self.x2, self.y2) = (x1, y1, x2, y2)
+		self.segments = segments
+		self.tolerance = tolerance
+		self.maxDepth = maxDepth
+		self.heights = {} # (x,y) -> height
+		self.cells = [] # cells not split, (xa,ya,xb,yb)
+		self.last = None # last probed point
+
+	def getSerpentineOrder(self, points, start=None):
+		# From (x1,y1), or from the corner nearest start
+		columns = collections.defaultdict(list)
+		for (x, y) in points :
+			columns[x].append(y)
+		orders = []
+		for (reverseX, reverseY) in ( (self.x2 < self.x1, self.y2 < self.y1), (self.x2 < self.x1, self.y2 >= self.y1), (self.x2 >= self.x1, self.y2 < self.y1), (self.x2 >= self.x1, self.y2 >= self.y1) ) :
+			order = []
+			for (k, x) in enumerate( sorted( columns, reverse=reverseX ) ) :
+				order.extend( (x, y) for y in sorted( columns[x], reverse=reverseY != (k % 2 == 1) ) )
+			if start == None or len(order) == 0 :
+				return order
+			orders.append(order)
+		return min( orders, key=lambda order : math.hypot( order[0][0] - start[0], order[0][1] - start[1] ) )
+
+	def probe(self, points):
+		for p in self.getSerpentineOrder( set( p for p in points if p not in self.heights ), self.last ) :
+			self.heights[p] = self.measure(*p)
+			self.last = p
+
+	def getCellHeight(self, cell, x, y):
+		(xa, ya, xb, yb) = cell
+		fx = (x - xa) / (xb - xa) if xb != xa else 0.0
+		fy = (y - ya) / (yb - ya) if yb != ya else 0.0
+		h0 = self.heights[(xa,ya)] + ( self.heights[(xb,ya)] - self.heights[(xa,ya)] ) * fx
+		h1 = self.heights[(xa,yb)] + ( self.heights[(xb,yb)] - self.heights[(xa,yb)] ) * fx
+		return h0 + (h1 - h0) * fy
+
+	def run(self):
+		n = self.segments
+		xs = [ self.x1 + (self.x2 - self.x1) * (float(i) / n) for i in range(n+1) ]
+		ys = [ self.y1 + (self.y2 - self.y1) * (float(j) / n) for j in range(n+1) ]
+		self.probe( [ (x,y) for x in xs for y in ys ] )
+		cells = [ (xs[i], ys[j], xs[i+1], ys[j+1]) for i in range(n) for j in range(n) ]
+		self.cells = []
+		if self.tolerance != None :
+			for depth in range(self.maxDepth) :
+				centers = [ ( (xa+xb)/2, (ya+yb)/2 ) for (xa, ya, xb, yb) in cells ]
+				self.probe(centers)
+				subcells = []
+				for (cell, (xm, ym)) in zip(cells, centers) :
+					if abs( self.heights[(xm,ym)] - self.getCellHeight(cell, xm, ym) ) <= self.tolerance :
+						self.cells.append(cell)
+					else :
+						(xa, ya, xb, yb) = cell
+						subcells.extend( [ (xa, ya, xm, ym), (xm, ya, xb, ym), (xa, ym, xm, yb), (xm, ym, xb, yb) ] )
+				cells = subcells
+				self.probe( [ (x,y) for (xa, ya, xb, yb) in cells for (x,y) in ( (xa,ya), (xb,ya), (xa,yb), (xb,yb) ) ] )
+		self.cells.extend(cells)
+		return self.getLevelingData()
+
+	def getLevelingData(self):
+		xs = sorted( set( x for (x, y) in self.heights ), reverse=self.x2 < self.x1 )
+		ys = sorted( set( y for (x, y) in self.heights ), reverse=self.y2 < self.y1 )
+		grid = []
+		for x in xs :
+			column = []
+			for y in ys :
+				if (x,y) in self.heights :
+					column.append( (x, y, self.heights[(x,y)]) )
+				else :
+					cell = next( c for c in self.cells if min(c[0],c[2]) <= x <= max(c[0],c[2]) and min(c[1],c[3]) <= y <= max(c[1],c[3]) )
+					column.append( (x, y, self.getCellHeight(cell, x, y)) )
+			grid.append(column)
+		return grid
 
 
 ##################################################
@@ -269,13 +2502,18 @@ class ModelaZeroControl:
 	Z_INCREMENTS_MED = 10
 	Z_INCREMENTS_LARGE = 100
 	Z_DEFAULT_OFFSET = -1300.0
-	FAST_TRAVEL_RATE = 600.0
+	MOVE_SPEED = GCode2RmlConverter.MAX_SPEED # mm per second, the V speed of sendMoveCommand(), XY runs at the default speed
+	SWEEP_SPEED = 0.5 # mm per second, Z speed of the focus sweeps
+	MOVE_LOG_SIZE = 1000
 
 	Y_MAX = 4064.0
 	X_MAX = 6096.0
 
 	comport = None
-	ser = None
+	writer = None
+	motionModel = None
+	motionEnd = 0.0 # estimated time when the machine is done with the moves sent so far
+	moveLog = None # estimated (start time, end time, start position, target position, Z speed) of the last moves
 
 	z_offset = 0.0
 	x = 0.0
@@ -297,31 +2535,33 @@ class ModelaZeroControl:
 
 	def __init__(self,comport):
 		self.comport = comport
+		self.motionModel = MotionModel()
+		self.moveLog = collections.deque(maxlen=self.MOVE_LOG_SIZE)
 		try :
-			self.ser = serial.Serial(self.comport,9600,rtscts=1)
-			self.ser.close()
-			self.ser = None
+			self.writer = SerialCommandWriter(self.comport) # stays open until close()
 			self.connected = True
 		except serial.serialutil.SerialException as e :
-			print('Could not open '+comport)
+			print('Could not open {}'.format(comport))
 			self.connected = False
 			#sys.exit(1)
 
-	def sendCommand(self,cmd):
+	def close(self):
+		if self.writer != None :
+			self.writer.close()
+			self.writer = None
+
+	def sendCommand(self,cmd,jog=False):
 		#print(cmd)
-		try :
-			self.ser = serial.Serial(self.comport,9600,rtscts=1)
-			txt = cmd + '\n'
-			self.ser.write(txt.encode('ascii'))
-			self.ser.close()
-			self.ser = None
-		except serial.serialutil.SerialException as e :
-			#print(e)
-			print('Error writing to '+self.comport)
+		if self.writer == None :
+			return
+		if self.writer.error != None :
+			#print(self.writer.error)
+			print('Error writing to {}'.format(self.comport))
 			self.connected = False
-			#sys.exit(1)
+			self.writer.error = None
+		self.writer.send(cmd, jog)
 
-	def sendMoveCommand(self,wait=False):
+	def sendMoveCommand(self,wait=False,speed=None):
 		if self.x < 0.0 : self.x = 0.0
 		if self.x > self.X_MAX : self.x = self.X_MAX 
 		if self.y < 0.0 : self.y = 0.0
@@ -329,20 +2569,33 @@ class ModelaZeroControl:
 		#print('Moving to {:.0f},{:.0f},{:.0f}'.format(self.x,self.y,self.z))
 
 		spindle = '1' if self.spindleEnabled else '0'
+		speed = speed if speed != None else self.MOVE_SPEED
 		# The esoteric syntax was borrowed from https://github.com/Craftweeks/MDX-LabPanel
-		self.sendCommand('^DF;!MC{0};!PZ0,0;V15.0;Z{1:.3f},{2:.3f},{3:.3f};!MC{0};;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;'.format(spindle,self.x,self.y,self.z))
+		# Moves without wait are jogs: a newer one replaces it if it is not sent yet
+		command = '^DF;!MC{0};!PZ0,0;V{4:.1f};Z{1:.3f},{2:.3f},{3:.3f};!MC{0};;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;'.format(spindle,self.x,self.y,self.z,speed)
+		self.sendCommand(command, jog=not wait)
 
 		# Optional wait for move complete
+		start = (self.last_x, self.last_y, self.last_z)
 		dx = self.x - self.last_x
 		self.last_x = self.x
 		dy = self.y - self.last_y
 		self.last_y = self.y
 		dz = self.z - self.last_z
 		self.last_z = self.z
-		traveldist = math.sqrt(dx*dx+dy*dy+dz*dz)
+		travelTime = self.motionModel.getMoveTime( dx, dy, dz, zSpeed=speed )
+		sent = time.perf_counter()
+		if wait and self.writer != None :
+			self.writer.waitStarted()
+			# The machine starts the move once the Z command has arrived, the padding that follows it is still being sent
+			zEnd = command.index(';', command.index(';Z') + 1) + 1
+			sent = self.writer.writeStarted + zEnd * self.writer.getByteTime()
+		# The move starts once its command is received and the previous moves are done
+		startTime = max( sent, self.motionEnd )
+		self.motionEnd = startTime + travelTime
+		self.moveLog.append( ( startTime, self.motionEnd, start, (self.x, self.y, self.z), speed ) )
 		if wait :
-			travelTime = traveldist / self.FAST_TRAVEL_RATE 
-			time.sleep(travelTime)
+			time.sleep( max( 0.0, self.motionEnd - time.perf_counter() ) )
 			#print('move done')
 
 	def run(self):
@@ -372,21 +2625,22 @@ class ModelaZeroControl:
 		self.xy_zero = (0.0,0.0)
 		
 		while True : #self.connected :
-			c = msvcrt.getwche()
+			c = readKey(True)
 			n = 0
 			#print(c)
 			if c == '\xe0' or c == '\x00' :
-				c = msvcrt.getwche()
+				c = readKey(True)
 				n = ord(c)
 				#print(c,n)
 
 			if ( c == 'q' and n == 0 ) :
 				if not self.hasZeroBeenSet :
 					print('Would you like to set the current position as the Zero (y/n)?')
-					c = msvcrt.getwch()
+					c = readKey()
 					if c == 'y' or c == 'Y' :
 						self.setZeroHere()
 				print('Done') 
+				if self.writer != None : self.writer.printLatencyReport()
 				return self.xy_zero
 
 			elif c == 'h' :
@@ -500,13 +2754,33 @@ class ModelaZeroControl:
 	def getManualLevelingPoints(self):
 		return self.manual_leveling_points
 
-	def moveTo(self,x,y,z,wait=False):
+	def moveTo(self,x,y,z,wait=False,speed=None):
 		self.x = x
 		self.y = y
 		self.z = z
-		self.sendMoveCommand(wait)
-
-	def getAutolevelingData(self, cam, steps=1, heightpoints=50) :
+		self.sendMoveCommand(wait,speed)
+
+	def getZAt(self, t):
+		# Estimated Z position at the given time.perf_counter() time, from the move log
+		for (startTime, endTime, start, target, speed) in reversed(self.moveLog) :
+			if startTime <= t :
+				return start[2] + self.motionModel.getAxisDistance( target[2] - start[2], speed, t - startTime )
+		return self.moveLog[0][2][2] if len(self.moveLog) > 0 else self.z
+
+	def sweepFocus(self, cam, px, py, top, bottom, speed=SWEEP_SPEED):
+		# Moves down from top to bottom in one slow move, and matches the focus samples taken meanwhile with the
+		# Z positions at their time. Returns the height of the sharpest focus and the number of samples.
+		self.moveTo(px,py,top,wait=True)
+		started = time.perf_counter()
+		self.moveTo(px,py,bottom,wait=True,speed=speed)
+		cam.getFocusValue( newerThan=time.perf_counter() ) # the last frames of the sweep are measured
+		samples = cam.getFocusSamples(started, self.motionEnd)
+		if len(samples) == 0 :
+			return (top, 0)
+		heights = [ self.getZAt(t) for (t, v) in samples ]
+		return ( FocusSearch.fitPeak( heights, [ v for (t, v) in samples ] ), len(samples) )
+
+	def getAutolevelingData(self, cam, steps=1, heightpoints=50, tolerance=None, maxDepth=ProbePlanner.MAX_DEPTH, sweep=False) :
 		if self.microscope_leveling_startpoint != None and  self.microscope_leveling_endpoint != None :
 			print(self.microscope_leveling_startpoint,self.microscope_leveling_endpoint)
 			(x1,y1,z1) = self.microscope_leveling_startpoint
@@ -515,55 +2789,42 @@ class ModelaZeroControl:
 			startingHeight = z1 + heightpoints/2
 
 			self.moveTo(x1,y1,z1,wait=True) # Go to start
-			
-			#print(p1,p2)
-			heights = [[(0,0,0) for i in range(steps+1)] for j in range(steps+1)]
-
-			for i in range(steps+1) :
-				for j in range(steps+1) :
-					#print(i,j)
-					fx = float(i) / (steps)
-					fy = float(j) / (steps)
-					px = x1 + (x2-x1) * fx
-					py = y1 + (y2-y1) * fy 
-					#print(px,py)
-					#print(i,j,interpolatedPosition)
-					focusValues = []
-					self.moveTo(px,py,startingHeight+5,wait=True)
-					for k in range(heightpoints):
-						h = startingHeight - k * 1.0
-						self.moveTo(px,py,h,wait=False)
-						time.sleep(0.033) # Take some time for focus value to settle
-						focusval = cam.getFocusValue()
-						#print(focusval)
-						focusValues.append( focusval )
-
-					#print(focusValues)
-					maxrank = numpy.argmax(focusValues)
-
-					self.moveTo(px,py,startingHeight-maxrank*1.0,wait=True)
-
-					# # TODO: Find max focus height position using curve fit 
-					# poly_rank = 7
-					# focusValues_indexes = range(len(focusValues))
-					# polynomial = numpy.poly1d(numpy.polyfit(focusValues_indexes,focusValues,poly_rank))
-					# numpts = 500
-					# maxrank_high = numpy.argmax(polynomial(numpy.linspace(0, steps, numpts)))
-					# maxrank = ( maxrank_high / (numpts-1) ) * steps
-					# print(px,py,maxrank_high,maxrank)
-					
-					heights[i][j] = ( px,py, maxrank)
+
+			sampleCount = 0
+			started = time.perf_counter()
+			def measureHeight(px, py) :
+				nonlocal sampleCount
+				self.moveTo(px,py,startingHeight+5,wait=True)
+				if sweep :
+					(h, count) = self.sweepFocus(cam, px, py, startingHeight, startingHeight-(heightpoints-1))
+					sampleCount += count
+					self.moveTo(px,py,h,wait=True)
+					return startingHeight - h
+				def measure(rank) :
+					self.moveTo(px,py,startingHeight-rank,wait=True)
+					return cam.getFocusValue( newerThan=time.perf_counter(), raw=True ) # from a frame taken after the move
+				focusSearch = FocusSearch(measure, heightpoints)
+				maxrank = focusSearch.search()
+				sampleCount += len(focusSearch.samples)
+				if focusSearch.atEdge :
+					print('Warning: the sharpest focus at ({:.0f},{:.0f}) is at the end of the {} searched heights, the surface may be out of range.'.format(px,py,heightpoints))
+				self.moveTo(px,py,startingHeight-maxrank,wait=True)
+				return maxrank
+
+			planner = ProbePlanner(measureHeight, x1, y1, x2, y2, steps, tolerance, maxDepth)
+			heights = planner.run()
 
 			# Bias results relative to initial point, at origin
 			(x0,y0,home_rank) = heights[0][0]
-			for i in range(steps+1) :
-					for j in range(steps+1) :
+			for i in range(len(heights)) :
+					for j in range(len(heights[i])) :
 						(x,y,r) = heights[i][j]
 						x = x - x0
 						y = y - y0
 						r = r - home_rank
 						heights[i][j] = (x,y,r)
 
+			print('Leveling: {} points probed in {:.1f} s ({} focus samples), {}x{} grid'.format(len(planner.heights),time.perf_counter()-started,sampleCount,len(heights),len(heights[0])))
 			#print(heights)
 			for col in heights :
 				print(col)
@@ -574,19 +2835,69 @@ class ModelaZeroControl:
 
 ##################################################
 
+class LatestFrameSlot:
+	# Single-slot buffer between two stages: put() replaces an item not taken yet (counted as dropped), so the consumer
+	# always gets the latest one. get() waits for a new item, returns None once closed or after the timeout.
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.item = None
+		self.dropped = 0
+		self.closed = False
+
+	def put(self, item):
+		with self.condition :
+			if self.item != None :
+				self.dropped += 1
+			self.item = item
+			self.condition.notify_all()
+
+	def get(self, timeout=None):
+		with self.condition :
+			self.condition.wait_for( lambda : self.item != None or self.closed, timeout )
+			item = self.item
+			self.item = None
+			return item
+
+	def close(self):
+		with self.condition :
+			self.closed = True
+			self.condition.notify_all()
+
+##################################################
+
 class MicroscopeFeed:
+	# Capture, focus measure and display run in their own threads, connected by LatestFrameSlot buffers: a slow stage
+	# drops stale frames instead of holding the others back. Frames go through the slots as (request time, frame).
+	# The focus measure is the variance of the Laplacian over the center of the frame, smoothed over the frames.
+	# In headless mode there is no display stage and no GUI call.
+
+	STAGES = ('capture', 'focus', 'display')
+	ROI_SIZE = 0.20 # fraction of the frame width
+	FOCUS_SMOOTHING = 0.50
+	FOCUS_TIMEOUT = 1.0 # seconds
+	FRAME_TIMEOUT = 0.1 # seconds, to check for the end of the loop
+	FOCUS_HISTORY = 1000 # raw focus samples kept for getFocusSamples()
 
-	loopthread = None
 	threadlock = None
 	endLoopRequest = False
 	focusValue = 0.0
+	focusTime = 0.0 # when the frame of focusValue was requested
+	lastFocusSample = 0.0 # unsmoothed
 	vidcap = None
 	connected = False
 
-	def __init__(self,channel):
+	def __init__(self,channel,headless=False):
 		self.channel = channel
-		self.threadlock = threading.Lock()
-		self.loopthread = threading.Thread(target=self.loopThread)
+		self.headless = headless
+		self.threadlock = threading.Condition()
+		self.focusSlot = LatestFrameSlot()
+		self.displaySlot = None if headless else LatestFrameSlot()
+		self.frameCounts = collections.Counter()
+		self.focusSamples = collections.deque(maxlen=self.FOCUS_HISTORY) # (frame request time, raw focus value)
+		self.startTime = None
+		stages = [ self.captureThread, self.focusThread ] + ( [] if headless else [ self.displayThread ] )
+		self.threads = [ threading.Thread(target=stage) for stage in stages ]
 		self.vidcap = cv2.VideoCapture(self.channel)
 		if self.vidcap.isOpened() :
 			self.connected = True
@@ -597,85 +2908,205 @@ class MicroscopeFeed:
 		return self.connected
 
 	def startLoop(self):
-		self.loopthread.start()
-
-	def loopThread(self):
 		if not self.vidcap.isOpened() : return
+		self.startTime = time.perf_counter()
+		for thread in self.threads :
+			thread.start()
+
+	def getRoi(self, frame):
+		height, width = frame.shape[:2]
+		sz = self.ROI_SIZE * width
+		x0 = int(width/2 - sz/2)
+		x1 = int(width/2 + sz/2)
+		y0 = int(height/2 - sz/2)
+		y1 = int(height/2 + sz/2)
+		return (x0, y0, x1, y1)
+
+	def countFrame(self, stage):
+		with self.threadlock :
+			self.frameCounts[stage] += 1
+
+	def captureThread(self):
+		while not self.endLoopRequest :
+			frameTime = time.perf_counter()
+			chk,frame = self.vidcap.read()
+			if not chk : continue
+			self.countFrame('capture')
+			self.focusSlot.put( (frameTime, frame) )
+			if self.displaySlot != None :
+				self.displaySlot.put( (frameTime, frame) )
+		self.vidcap.release()
+		self.focusSlot.close()
+		if self.displaySlot != None :
+			self.displaySlot.close()
+
+	def focusThread(self):
 		smoothed_laplacian_variance = 0.0
 		while True :
-			chk,frame = self.vidcap.read()
-
-			height, width = frame.shape[:2]
-			sz = 0.20 * width
-			x0 = int(width/2 - sz/2)
-			x1 = int(width/2 + sz/2)
-			y0 = int(height/2 - sz/2)
-			y1 = int(height/2 + sz/2)
-			center_frame = frame[ y0:y1, x0:x1 ]
-			center_gray = cv2.cvtColor(center_frame, cv2.COLOR_BGR2GRAY)
-			#cv2.imshow('center',center_gray)
-
-			laplacian = cv2.Laplacian(center_gray,cv2.CV_64F)
-			#cv2.imshow('laplacian',laplacian)
-			v = laplacian.var()
-			#smoothed_v_factor = 0.25
-			smoothed_v_factor = 0.50
-			smoothed_laplacian_variance = v * smoothed_v_factor +  smoothed_laplacian_variance * (1.0-smoothed_v_factor)
-			#print('{:.0f} - {:.0f}'.format(v,smoothed_laplacian_variance))
+			item = self.focusSlot.get(self.FRAME_TIMEOUT)
+			if item == None :
+				if self.focusSlot.closed : break
+				continue
+			(frameTime, frame) = item
+			(x0, y0, x1, y1) = self.getRoi(frame)
+			center_gray = cv2.cvtColor(frame[ y0:y1, x0:x1 ], cv2.COLOR_BGR2GRAY) # only the center is converted
+			laplacian = cv2.Laplacian(center_gray,cv2.CV_16S) # exact for 8 bit pixels
+			v = float( cv2.meanStdDev(laplacian)[1][0,0] ) ** 2
+			smoothed_laplacian_variance = v * self.FOCUS_SMOOTHING + smoothed_laplacian_variance * (1.0-self.FOCUS_SMOOTHING)
+			with self.threadlock :
+				self.frameCounts['focus'] += 1
+				self.lastFocusSample = v
+				self.focusSamples.append( (frameTime, v) )
+				self.focusValue = smoothed_laplacian_variance
+				self.focusTime = frameTime
+				self.threadlock.notify_all()
 
+	def displayThread(self):
+		cv2.namedWindow('vidcap', cv2.WINDOW_NORMAL)
+		while True :
+			item = self.displaySlot.get(self.FRAME_TIMEOUT)
+			if item == None :
+				if self.displaySlot.closed : break
+				continue
+			frame = item[1].copy() # the focus stage may still be reading it
+			(x0, y0, x1, y1) = self.getRoi(frame)
+			with self.threadlock :
+				(v, smoothed) = (self.lastFocusSample, self.focusValue)
 			cv2.rectangle(frame, (x0, y0), (x1, y1),(0,255,0), 2)
-			#textpos = (x0, y0)
 			textpos = (10, 20)
-			cv2.putText(frame, 'v = {:.2f} {:.2f}'.format(v,smoothed_laplacian_variance),textpos,cv2.FONT_HERSHEY_DUPLEX,0.8,(225,0,0))
-
-			cv2.namedWindow('vidcap', cv2.WINDOW_NORMAL)
+			cv2.putText(frame, 'v = {:.2f} {:.2f}'.format(v,smoothed),textpos,cv2.FONT_HERSHEY_DUPLEX,0.8,(225,0,0))
 			cv2.imshow('vidcap',frame)
 			cv2.waitKey(1) # Required for video to be displayed
-			with self.threadlock :
-				self.focusValue = smoothed_laplacian_variance
-				if self.endLoopRequest :
-					self.vidcap.release()
-					cv2.destroyAllWindows() 
-					break
+			self.countFrame('display')
+		cv2.destroyAllWindows()
 
 	def endLoop(self):
 		with self.threadlock :
 			self.endLoopRequest = True
-		self.loopthread.join()
-
-	def getFocusValue(self):
+			self.threadlock.notify_all()
+		for thread in self.threads :
+			if thread.is_alive() :
+				thread.join()
+
+	def getFocusValue(self, newerThan=None, raw=False):
+		# Optionally waits for a frame requested after the given time.perf_counter() time.
+		# The raw value is the one of the last frame only, without smoothing.
 		f = 0.0
 		with self.threadlock :
-			f = self.focusValue
+			if newerThan != None :
+				self.threadlock.wait_for( lambda : self.focusTime >= newerThan or self.endLoopRequest, self.FOCUS_TIMEOUT )
+			f = self.lastFocusSample if raw else self.focusValue
 		return f
 
+	def getFocusSamples(self, start, end=None):
+		# Raw focus samples of the frames requested between the given time.perf_counter() times
+		with self.threadlock :
+			return [ (t, v) for (t, v) in self.focusSamples if t >= start and ( end == None or t <= end ) ]
+
+	def getStageRates(self):
+		# Frames per second through each stage, and frames dropped before the focus and display stages
+		elapsed = time.perf_counter() - self.startTime if self.startTime != None else 0.0
+		with self.threadlock :
+			rates = { stage : self.frameCounts[stage] / elapsed if elapsed > 0.0 else 0.0 for stage in self.STAGES }
+		rates['focusDropped'] = self.focusSlot.dropped
+		rates['displayDropped'] = self.displaySlot.dropped if self.displaySlot != None else 0
+		return rates
+
+	def printStageRates(self):
+		r = self.getStageRates()
+		print('Microscope: capture {capture:.1f} fps, focus {focus:.1f} fps ({focusDropped} dropped), display {display:.1f} fps ({displayDropped} dropped)'.format(**r))
+
 
 ##################################################
 
+def convertBatch(converter, infiles, jobs, cache):
+	# Converts each input file to <file>.prn with the same converter settings, on jobs processes, and prints a summary.
+	# Cached outputs are used when there are no statistics to collect.
+	started = time.perf_counter()
+	files = []
+	results = []
+	for infile in infiles :
+		outfile = infile + '.prn'
+		key = cache.getKey(infile, converter) if cache != None else None
+		if key != None and converter.stats == None and cache.get(key, outfile) :
+			results.append( { 'infile' : infile, 'outfile' : outfile, 'seconds' : 0.0, 'inputBytes' : os.path.getsize(infile), 'outputBytes' : os.path.getsize(outfile), 'cached' : True } )
+		else :
+			files.append( (infile, outfile, key) )
+	print('Converting {} files ({} cached) on {} processes'.format( len(infiles), len(infiles) - len(files), max(1, min(jobs, len(files))) ))
+	for (result, (infile, outfile, key)) in zip( converter.convertFiles( [ (infile, outfile) for (infile, outfile, key) in files ], jobs ), files ) :
+		sys.stdout.write(result['messages'])
+		if result['stats'] != None : converter.stats.merge(result['stats'])
+		if key != None : cache.put(key, outfile)
+		results.append(result)
+	elapsed = time.perf_counter() - started
+
+	results.sort( key=lambda r : infiles.index(r['infile']) )
+	width = max( len(r['infile']) for r in results )
+	for r in results :
+		print('  {:<{}}  {:>8.2f} s  {:>10} -> {:>10} bytes{}'.format( r['infile'], width, r['seconds'], r['inputBytes'], r['outputBytes'], ' (cached)' if r.get('cached') else '' ))
+	conversionTime = sum( r['seconds'] for r in results )
+	print('Converted {} files in {:.2f} s ({:.2f} s of conversion{})'.format( len(results), elapsed, conversionTime, ', {:.1f}x'.format(conversionTime / elapsed) if conversionTime > 0.0 else '' ))
+	return results
+
+
 def main():
 	
 	import optparse	
 	parser = optparse.OptionParser('usage%prog -i <input file>')
 	parser.add_option('-i', '--infile', dest='infile', default='', help='The input gcode file, as exported by FlatCam.')
+	parser.add_option('-b', '--batch', dest='batch', default='', help='Convert every gcode file matching these comma separated names or patterns (e.g. "board-*.nc") to <file>.prn, with the same zero and leveling, on --jobs processes.')
 	parser.add_option('-o', '--outfile', dest='outfile', default='', help='The output RML-1 file.')
 	parser.add_option("-z", '--zero', dest='zero', action="store_true", default=False, help='Zero the print head on the work surface.')
-	#parser.add_option('-s', '--serialport', dest='serialport', default='', help='The com port for the MDX-15. (Default: obtained from the printer driver)')
+	parser.add_option('-s', '--serialport', dest='serialport', default='', help='The com port for the MDX-15. Printing streams the RML-1 data to it directly instead of using the printer driver. (Default: obtained from the printer driver)')
 	parser.add_option("-p", '--print', dest='print', action="store_true", default=False, help='Prints the RML-1 data.')
 	parser.add_option('-n', '--printerName', dest='printerName', default='Roland MODELA MDX-15', help='The windows printer name. (Default: Roland MODELA MDX-15)')
 	parser.add_option('-f', '--feedspeedfactor', dest='feedspeedfactor', default=1.0, help='Feed rate scaling factor (Default: 1.0)')
 	parser.add_option('--backlashX', dest='backlashX', default=0.0, help='Backlash compensation in X direction (in steps).')
 	parser.add_option('--backlashY', dest='backlashY', default=0.0, help='Backlash compensation in y direction (in steps).')
 	parser.add_option('--backlashZ', dest='backlashZ', default=0.0, help='Backlash compensation in z direction (in steps).')
+	parser.add_option('--optimize', dest='optimize', action="store_true", default=False, help='Reorder the cutting paths to shorten the rapid travel between them.')
+	parser.add_option('--reversepaths', dest='reversepaths', action="store_true", default=False, help='Allow the optimization to cut paths backwards (changes the milling direction).')
+	parser.add_option('--simplify', dest='simplify', default='', help='Simplify the cutting paths, removing points within this distance of the result (in steps, e.g. 0.5).')
+	parser.add_option('--pack', dest='pack', default='', help='Pack consecutive moves into Z commands of up to this many characters, and drop repeated speed settings (e.g. 128).')
+	parser.add_option('--nocache', dest='nocache', action="store_true", default=False, help='Always convert, without using or updating the conversion cache.')
+	parser.add_option('--clearcache', dest='clearcache', action="store_true", default=False, help='Remove all files from the conversion cache.')
+	parser.add_option('--cachesize', dest='cachesize', default=200, help='Maximum size of the conversion cache in MB. (Default: 200)')
+	parser.add_option('--stats', dest='stats', action="store_true", default=False, help='Print conversion statistics: counts, time per stage and unrecognized commands.')
+	parser.add_option('--statsjson', dest='statsjson', default='', help='Write the conversion statistics to this JSON file.')
+	parser.add_option('--resume', dest='resume', action="store_true", default=False, help='Continue an interrupted print (-p with -s) from its checkpoint, restoring the speeds, spindle and Z height.')
+	parser.add_option('--estimate', dest='estimate', action="store_true", default=False, help='Estimate the machining time of the RML-1 output file.')
+	parser.add_option('-j', '--jobs', dest='jobs', default=1, help='Number of processes for the conversion of large files. (Default: 1)')
 	parser.add_option('--levelingsegments', dest='levelingsegments', default=1, help='Number of segments to split the work area for microscope-based leveling. (Default: 1)')
+	parser.add_option('--probetolerance', dest='probetolerance', default='', help='Probe more leveling points where the surface departs from a flat cell by more than this (in steps, e.g. 2).')
+	parser.add_option('--levelingsurface', dest='levelingsurface', default='plane', help='Surface fitted to the manual leveling points: plane, quadratic or thinplate. (Default: plane)')
+	parser.add_option('--levelingmap', dest='levelingmap', default='', help='Use the leveling data saved in this file instead of probing.')
+	parser.add_option('--shiftlevelingmap', dest='shiftlevelingmap', action="store_true", default=False, help='Keep the loaded leveling map at the machine position where it was probed, relative to the current zero.')
+	parser.add_option('--savelevelingmap', dest='savelevelingmap', default='', help='Save the leveling data to this file, for --levelingmap.')
+	parser.add_option('--focussweep', dest='focussweep', action="store_true", default=False, help='Find the focus of each leveling point in one continuous Z sweep instead of stepping.')
+	parser.add_option('--probedepth', dest='probedepth', default=ProbePlanner.MAX_DEPTH, help='Number of times a leveling cell can be split by --probetolerance. (Default: {})'.format(ProbePlanner.MAX_DEPTH))
+	parser.add_option('--levelingtolerance', dest='levelingtolerance', default='', help='Split cutting moves where the leveled surface deviates more than this from a straight line (in steps, e.g. 1).')
 	parser.add_option('-m','--microscope', dest='microscope', default=False, help='Enable microscope on channel N')
+	parser.add_option('--headless', dest='headless', action="store_true", default=False, help='Run the microscope without showing its video.')
 	(options,args) = parser.parse_args()
 	#print(options)
 
+	if options.resume and options.serialport == '' :
+		print('Error: --resume needs the serial port (-s), the printer driver cannot resume a job.')
+		sys.exit(1)
+
 	debugmode = False
 
+	# Conversion cache
+	cache = ConversionCache( os.path.join( os.path.expanduser('~'), '.mdx15_print_gerber', 'cache' ), float(options.cachesize) * 1e6 )
+	if options.clearcache :
+		cache.clear()
+		print('Conversion cache cleared.')
+	if options.nocache :
+		cache = None
+
 	# Find serial port number using the printer driver.
-	serialport = ''
-	if options.zero : # Printer driver is only required if we want to set the zero
+	serialport = options.serialport
+	if options.zero and serialport == '' : # Printer driver is only required if we want to set the zero
 		import subprocess
 		shelloutput = subprocess.check_output('powershell -Command "(Get-WmiObject Win32_Printer -Filter \\"Name=\'{}\'\\").PortName"'.format(options.printerName))
 		if len(shelloutput)>0 :
@@ -692,7 +3123,7 @@ def main():
 	# Start microscope feed if requested
 	mic = None
 	if options.microscope != False :
-		mic = MicroscopeFeed( int(options.microscope) )
+		mic = MicroscopeFeed( int(options.microscope), options.headless )
 		mic.startLoop()
 
 	#msvcrt.getwch()
@@ -712,34 +3143,120 @@ def main():
 				(x_offset,y_offset) = modelaZeroControl.run()
 				manualLevelingPoints = modelaZeroControl.getManualLevelingPoints()
 				if modelaZeroControl.exitRequested :
+					modelaZeroControl.close()
 					print('Terminating program.')
 					sys.exit(1)
 			else :
 				print('Could not connect to the printer to set the zero.')
 
-		# Find bed level using microscope focus
+		# Find bed level using microscope focus, or use the saved leveling data
 		levelingData = None
-		if mic != None and mic.isConnected() and modelaZeroControl != None :
+		levelingOrigin = (x_offset, y_offset)
+		if options.levelingmap != '' :
+			(levelingData, savedPoints, savedOrigin, savedTime) = LevelingMapFile.load(options.levelingmap)
+			print('Using the leveling map from {} probed on {}'.format(options.levelingmap, time.strftime('%Y-%m-%d %H:%M', time.localtime(savedTime))))
+			if manualLevelingPoints == None :
+				manualLevelingPoints = savedPoints
+			if levelingData != None and options.shiftlevelingmap :
+				# Keep the map at the same machine position relative to the current zero
+				(dx, dy) = (savedOrigin[0] - x_offset, savedOrigin[1] - y_offset)
+				print('Shifting the leveling map by {:.0f},{:.0f} steps'.format(dx, dy))
+				levelingData = LevelingMapFile.getShiftedLevelingData(levelingData, dx, dy)
+			levelingOrigin = savedOrigin
+		elif mic != None and mic.isConnected() and modelaZeroControl != None :
 			try:
-				levelingData = modelaZeroControl.getAutolevelingData(mic, steps=int(options.levelingsegments) )
+				levelingData = modelaZeroControl.getAutolevelingData(mic, steps=int(options.levelingsegments), tolerance=float(options.probetolerance) if options.probetolerance != '' else None, maxDepth=int(options.probedepth), sweep=options.focussweep )
 			except KeyboardInterrupt :
 				print('Leveling cancelled, terminating program.')
+				modelaZeroControl.close()
 				sys.exit(1)
-
-		# gcode to rml conversion
-		if options.infile != '' :
-			if options.outfile == '' : options.outfile = options.infile + '.prn'
-			print('Converting {} to {}'.format(options.infile,options.outfile))
+			if modelaZeroControl.microscope_leveling_startpoint != None :
+				levelingOrigin = modelaZeroControl.microscope_leveling_startpoint[:2]
+		if modelaZeroControl != None :
+			modelaZeroControl.close() # sends the remaining commands
+		if options.savelevelingmap != '' :
+			if levelingData != None or manualLevelingPoints != None :
+				LevelingMapFile.save(options.savelevelingmap, levelingData, manualLevelingPoints, levelingOrigin)
+				print('Leveling map saved to ' + options.savelevelingmap)
+			else :
+				print('No leveling data to save.')
+
+		# Batch of input files, each to <file>.prn
+		batchFiles = []
+		if options.batch != '' :
+			for pattern in options.batch.split(',') :
+				matches = sorted( glob.glob(pattern.strip()) )
+				if len(matches) == 0 :
+					print('No file matches ' + pattern)
+				batchFiles.extend( f for f in matches if f not in batchFiles )
+
+		# gcode to rml conversion (not when resuming a job, which continues with the same output)
+		if options.infile != '' and options.outfile == '' : options.outfile = options.infile + '.prn'
+		if options.resume and os.path.exists( RmlSender.getCheckpointPath(options.outfile) ) :
+			print('Resuming {}, keeping the converted output.'.format(options.outfile))
+		elif options.infile != '' or len(batchFiles) > 0 :
 			converter = GCode2RmlConverter(x_offset, y_offset, float(options.feedspeedfactor), float(options.backlashX), float(options.backlashY), float(options.backlashZ), levelingData, manualLevelingPoints )
-			converter.convertFile( options.infile, options.outfile )
-
+			converter.optimizeToolpaths = options.optimize
+			if options.pack != '' : converter.packLength = int(options.pack)
+			if options.simplify != '' : converter.simplifyTolerance = float(options.simplify)
+			if options.levelingtolerance != '' : converter.levelingTolerance = float(options.levelingtolerance)
+			converter.setLevelingSurfaceModel(options.levelingsurface)
+			converter.reversePaths = options.reversepaths
+			converter.parallelJobs = int(options.jobs)
+			if options.stats or options.statsjson != '' :
+				converter.stats = ConversionStats()
+			if len(batchFiles) > 0 :
+				convertBatch(converter, batchFiles, int(options.jobs), cache)
+			else :
+				print('Converting {} to {}'.format(options.infile,options.outfile))
+				if cache != None :
+					key = cache.getKey(options.infile, converter)
+				if cache != None and converter.stats == None and cache.get(key, options.outfile) : # statistics need a conversion
+					print('Using the cached conversion.')
+				else :
+					converter.convertFile( options.infile, options.outfile )
+					if cache != None : cache.put(key, options.outfile)
+			if options.stats :
+				converter.stats.printReport()
+			if options.statsjson != '' :
+				converter.stats.writeJson(options.statsjson)
+
+		# Machining time of the RML code
+		if options.estimate and len(batchFiles) > 0 :
+			simulator = RmlJobSimulator()
+			for infile in batchFiles :
+				print(infile + '.prn:')
+				simulator.printReport( simulator.simulateFile(infile + '.prn') )
+		elif options.estimate :
+			if options.outfile != '' and os.path.exists(options.outfile) :
+				simulator = RmlJobSimulator()
+				simulator.printReport( simulator.simulateFile(options.outfile) )
+			else :
+				print('Error: No file to be estimated.')
 
 		# Send RML code to the printer driver.
-		if options.print :
+		if options.print and len(batchFiles) > 0 :
+			print('Batch outputs are not printed, print them one at a time with -p.')
+		elif options.print :
 			if options.outfile != '' :
 				print('Are you ready to print (y/n)?')
-				c = msvcrt.getwch()
-				if c == 'y' or c == 'Y' :
+				c = readKey()
+				if ( c == 'y' or c == 'Y' ) and options.serialport != '' :
+					# Stream directly to the serial port
+					print('Sending {} to {} (CTRL-C to cancel)'.format(options.outfile,options.serialport))
+					resumePoint = None
+					if options.resume :
+						resumePoint = RmlSender.getResumePoint(options.outfile)
+						if resumePoint == None :
+							raise Exception('No checkpoint to resume {} from.'.format(options.outfile))
+						print('Resuming from command {} ({} bytes).'.format(resumePoint[0], resumePoint[1]))
+					sender = RmlSender(options.serialport)
+					try :
+						if not sender.sendFile(options.outfile, resumePoint=resumePoint) :
+							print('The machine may still run the commands in its buffer: press the VIEW button, then both the UP and DOWN buttons to clear it.')
+					finally :
+						sender.close()
+				elif c == 'y' or c == 'Y' :
 					print('Printing: '+options.outfile)
 					os.system('RawFileToPrinter.exe "{}" "{}"'.format(options.outfile,options.printerName)) 
 
@@ -753,8 +3270,8 @@ def main():
 
 				if mic != None and mic.isConnected() :
 					# Don't exit now if the camera is connected, in case we want visual feedback
-					print('Press any key to exit.')
-					msvcrt.getwch()
+					print('Press any key to exit.' if msvcrt != None else 'Press ENTER to exit.')
+					readKey()
 
 
 			else :
@@ -767,6 +3284,8 @@ def main():
 	# Release video stream
 	if mic != None :
 		mic.endLoop()
+		if mic.isConnected() :
+			mic.printStageRates()
 
 
 